@@ -0,0 +1,108 @@
+import os
+import json
+import torch
+
+# messages of the RuntimeErrors raised when an allocation fails, by other backends than CUDA (e.g. MPS) and by the CPU allocator
+OOM_MESSAGES = ["out of memory", "not enough memory", "can't allocate memory", "defaultcpuallocator"]
+
+def is_oom_error(error:BaseException)-> bool:
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    return isinstance(error, RuntimeError) and any(message in str(error).lower() for message in OOM_MESSAGES)
+
+def get_budget_key(model_id:str, device, mode:str)-> str:
+    # the memory needed per token depends on the model (and quantisation), the device and the inference mode
+    return f"{model_id}|{device}|{mode}"
+
+class TokenBudgetScheduler:
+    '''
+    Batch scheduler that forms batches of prompts under a budget of (padded) tokens, counting the prompt tokens and the
+    new tokens to generate, instead of using a fixed number of prompts per batch.
+    When a batch runs out of memory, the budget is lowered to half of the tokens of the failing batch and the failing prompts
+    are rescheduled in smaller batches. A budget lowered after running out of memory is recorded in a json file (if given),
+    such that later runs with the same model, device and mode start from a budget that fits in memory. Budgets that did not
+    run out of memory are not recorded, as they are no ceiling for later runs with a larger budget.
+    Args:
+    max_batch_tokens: Maximum number of tokens per batch, the recorded budget is used instead if it is lower
+    budget_file: Path to a json file with the recorded budgets by budget key (see get_budget_key). Budgets are not recorded if None.
+    budget_key: Key of the budget in budget_file
+    '''
+    def __init__(self, max_batch_tokens:int, budget_file:str=None, budget_key:str=None):
+        self.max_batch_tokens = max_batch_tokens
+        self.budget_file = budget_file
+        self.budget_key = budget_key
+        self.num_oom = 0
+        self.num_batches = 0
+        recorded = self.read_budgets().get(budget_key) if budget_file is not None else None
+        # only budgets lowered after running out of memory are used as a ceiling
+        if recorded is not None and recorded.get("source") == "oom" and recorded["max_batch_tokens"] < max_batch_tokens:
+            print(f"Starting from the recorded token budget of {recorded['max_batch_tokens']} tokens per batch for '{budget_key}'.")
+            self.max_batch_tokens = recorded["max_batch_tokens"]
+
+    def read_budgets(self)-> dict:
+        if not os.path.exists(self.budget_file):
+            return {}
+        with open(self.budget_file, "r") as f:
+            return json.load(f)
+
+    def record_budget(self)-> None:
+        # a budget is only recorded when running out of memory lowered it
+        if self.budget_file is None or self.num_oom == 0:
+            return
+        budgets = self.read_budgets()
+        budgets[self.budget_key] = {"max_batch_tokens": self.max_batch_tokens, "num_oom": self.num_oom, "source": "oom"}
+        # written to a temporary file first, such that a killed run does not leave a broken file
+        tmp_path = self.budget_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(budgets, f, indent=2)
+        os.replace(tmp_path, self.budget_file)
+
+    def get_batch_size(self, lengths:list, start:int, num_new_tokens:int)-> int:
+        '''
+        Function to get the number of prompts, from start on, that fit in the budget when padded to the longest one
+        '''
+        batch_size = 1
+        max_length = lengths[start]
+        while start + batch_size < len(lengths):
+            max_length = max(max_length, lengths[start + batch_size])
+            if (batch_size + 1)*(max_length + num_new_tokens) > self.max_batch_tokens:
+                break
+            batch_size += 1
+        return batch_size
+
+    def run(self, lengths:list, run_batch, num_new_tokens:int=0):
+        '''
+        Function to run all prompts in batches under the token budget, in the given order (sort the prompts by length to reduce padding)
+        Args:
+        lengths: Number of prompt tokens of each prompt
+        run_batch: Function running a batch, given as a list of prompt indices, and returning a list with the output for each prompt
+        num_new_tokens: Maximum number of tokens generated per prompt
+        Yields the output of each prompt, in order
+        '''
+        start = 0
+        while start < len(lengths):
+            batch_size = self.get_batch_size(lengths, start, num_new_tokens)
+            batch = list(range(start, start + batch_size))
+            try:
+                outputs = run_batch(batch)
+            except Exception as error:
+                if not is_oom_error(error):
+                    raise
+                if batch_size == 1:
+                    raise RuntimeError(f"A single prompt of {lengths[start]} tokens does not fit in memory.") from error
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                self.num_oom += 1
+                # the failing batch is split, as the lowered budget fits at most half of its prompts
+                batch_tokens = batch_size*(max(lengths[start:start + batch_size]) + num_new_tokens)
+                self.max_batch_tokens = batch_tokens // 2
+                print(f"Out of memory for a batch of {batch_size} prompts ({batch_tokens} tokens), lowered the token budget to {self.max_batch_tokens}.")
+                self.record_budget()
+                continue
+            self.num_batches += 1
+            for output in outputs:
+                yield output
+            start += batch_size
+
+    def get_stats(self)-> dict:
+        return {"max_batch_tokens": self.max_batch_tokens, "batches": self.num_batches, "oom_backoffs": self.num_oom}
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+import transformers
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, GPTNeoXConfig, GPTNeoXForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from src.get_model_predictions.get_model_predictions import (enforce_reproducibility, select_samples, get_eos_token_ids, get_logit_ixs,
+                                                             get_generation_config, get_pipe_kwargs, get_result)
+from src.get_model_predictions.utils import TextWithLogitsGenerationPipeline
+from src.get_model_predictions.prompts import PROMPT_DICT
+from src.get_model_predictions.prompt_store import get_prompt_dataset, PromptIdsDataset
+from src.get_model_predictions.prefix_cache import RadixPrefixCache
+from src.get_model_predictions.quantization import QUANTIZATIONS, quantize_model, get_model_size_mb
+
+CLAIMANTS = ["Viral post", "Facebook post", "Donald Trump", "Joe Biden", "Instagram post", "Bloggers", "Tweets", "Narendra Modi"]
+LABEL_WORDS = ["True", "False", "None", "Support", "Refute", "Insufficient"]
+
+def build_tokenizer(vocab_size:int=2000)-> PreTrainedTokenizerFast:
+    '''
+    Function to train a small byte-level BPE tokenizer on the prompt templates, such that no tokenizer needs to be downloaded
+    '''
+    corpus = list(PROMPT_DICT.values()) + [" ".join(LABEL_WORDS + [" " + word for word in LABEL_WORDS]) + " \n \n\n \n\n\n"]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>")
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+def build_tiny_model(arch:str, tokenizer:PreTrainedTokenizerFast, hidden_size:int=64, num_layers:int=2):
+    '''
+    Function to build a tiny randomly initialised model with the architecture of the evaluated models
+    Args:
+    arch: 'pythia' (GPT-NeoX) or 'llama'
+    '''
+    config_kwargs = {"vocab_size": len(tokenizer),
+                     "hidden_size": hidden_size,
+                     "num_hidden_layers": num_layers,
+                     "num_attention_heads": 4,
+                     "intermediate_size": 4*hidden_size,
+                     "max_position_embeddings": 4096,
+                     "eos_token_id": tokenizer.eos_token_id,
+                     "bos_token_id": tokenizer.bos_token_id}
+    if arch == "pythia":
+        model = GPTNeoXForCausalLM(GPTNeoXConfig(**config_kwargs))
+    elif arch == "llama":
+        model = LlamaForCausalLM(LlamaConfig(num_key_value_heads=2, **config_kwargs))
+    else:
+        raise ValueError(f"Unknown architecture '{arch}', expected 'pythia' or 'llama'.")
+    return model.eval()
+
+def make_synthetic_data(num_claims:int, evidence_per_claim:int=5, seed:int=1000)-> pd.DataFrame:
+    '''
+    Function to generate synthetic claim and evidence rows in the format of the prediction data, with log-normal length distributions
+    close to those of the collected claims (median ~17 words) and evidence snippets (median ~110 words, up to three paragraphs).
+    '''
+    rng = np.random.default_rng(seed)
+    words = " ".join(PROMPT_DICT.values()).split()
+    rows = []
+    for claim_ix in range(num_claims):
+        num_claim_words = int(np.clip(rng.lognormal(np.log(17), 0.45), 4, 80))
+        claim = " ".join(rng.choice(words, num_claim_words))
+        claimant = rng.choice(CLAIMANTS)
+        for evidence_ix in range(evidence_per_claim):
+            num_evidence_words = int(np.clip(rng.lognormal(np.log(110), 0.7), 10, 600))
+            rows.append({"id": f"synthetic_{claim_ix}_{evidence_ix}",
+                         "claim_id": f"synthetic_{claim_ix}",
+                         "claim": claim,
+                         "claimant": claimant,
+                         "evidence": " ".join(rng.choice(words, num_evidence_words))})
+    return pd.DataFrame(rows).set_index("id")
+
+def get_peak_rss_mb()-> float:
+    # ru_maxrss is given in KB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss/1024**2 if platform.system() == "Darwin" else peak_rss/1024
+
+def benchmark_config(arch:str, mode:str, batch_size:int, prompt_name:str, num_claims:int, evidence_per_claim:int=5,
+                     prefix_cache_mb:int=None, num_threads:int=None, seed:int=1000, quantization:str="fp32")-> dict:
+    '''
+    Function to measure the prediction throughput and latency for one model architecture, inference mode and batch size.
+    The latency of a prompt is the time of the batch it is in. Runs in its own process, such that the peak RSS is per configuration.
+    '''
+    enforce_reproducibility(seed)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    use_evidence = "<evidence>" in PROMPT_DICT[prompt_name]
+    tokenizer = build_tokenizer()
+    model = quantize_model(build_tiny_model(arch, tokenizer), quantization)
+    data = select_samples(make_synthetic_data(num_claims, evidence_per_claim, seed), use_evidence)
+    use_prefix_cache = prefix_cache_mb is not None and batch_size == 1
+    pipe = TextWithLogitsGenerationPipeline(model=model, tokenizer=tokenizer,
+                                            prefix_cache=RadixPrefixCache(prefix_cache_mb) if use_prefix_cache else None)
+    logit_ixs = get_logit_ixs(tokenizer)
+    pipe_kwargs = get_pipe_kwargs(tokenizer, mode, get_generation_config(get_eos_token_ids(tokenizer)), logit_ixs)
+
+    start_time = time.perf_counter()
+    prompt_dataset = get_prompt_dataset(data, tokenizer, prompt_name, use_evidence)
+    tokenisation_time = time.perf_counter() - start_time
+    num_tokens = np.array(prompt_dataset["num_tokens"])
+    # same length sorting as in run_predictions
+    order = np.argsort(num_tokens, kind="stable")[::-1] if batch_size > 1 else np.arange(len(num_tokens))
+    batches = [order[ix:ix+batch_size].tolist() for ix in range(0, len(order), batch_size)]
+
+    # warm-up batch, not timed
+    list(pipe(PromptIdsDataset(prompt_dataset.select(batches[0])), batch_size=batch_size, **pipe_kwargs))
+    latencies = []
+    num_generated_tokens = 0
+    start_time = time.perf_counter()
+    for batch in batches:
+        batch_start_time = time.perf_counter()
+        outputs = list(pipe(PromptIdsDataset(prompt_dataset.select(batch)), batch_size=batch_size, **pipe_kwargs))
+        # the outputs are parsed as in run_predictions, such that this is included in the timing
+        for out in outputs:
+            get_result(out, mode, logit_ixs)
+        latencies.extend([time.perf_counter() - batch_start_time]*len(batch))
+        if mode != "score":
+            num_generated_tokens += sum(len(tokenizer.encode(out[0]["generated_text"], add_special_tokens=False)) for out in outputs)
+    total_time = time.perf_counter() - start_time
+
+    latencies = np.array(latencies)*1000
+    return {"arch": arch,
+            "quantization": quantization,
+            "model_size_mb": get_model_size_mb(model),
+            "mode": mode,
+            "batch_size": batch_size,
+            "prefix_cache_mb": prefix_cache_mb if use_prefix_cache else None,
+            "prompt_name": prompt_name,
+            "num_prompts": len(num_tokens),
+            "num_prompt_tokens": int(num_tokens.sum()),
+            "num_generated_tokens": num_generated_tokens,
+            "mean_prompt_tokens": float(num_tokens.mean()),
+            "tokenisation_sec": tokenisation_time,
+            "total_sec": total_time,
+            "prompts_per_sec": len(num_tokens)/total_time,
+            "tokens_per_sec": (num_tokens.sum() + num_generated_tokens)/total_time,
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+            "peak_rss_mb": get_peak_rss_mb(),
+            "num_threads": torch.get_num_threads()}
+
+def get_git_commit()-> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(output_path:str, archs:list, modes:list, batch_sizes:list, prompt_name:str, num_claims:int, evidence_per_claim:int=5,
+                  prefix_cache_mb:int=None, num_threads:int=None, seed:int=1000, quantizations:list=None)-> dict:
+    '''
+    Function to benchmark all combinations of architectures, inference modes and batch sizes and save the results as json
+    Args:
+    output_path: Path to the json file to save the results to
+    num_claims: Number of synthetic claims, each with evidence_per_claim evidence rows
+    prefix_cache_mb: Memory limit (in MB) for the prefix cache, only used for a batch size of 1. No prefix cache is used if None.
+    quantizations: Model quantisations to benchmark, only 'fp32' if None
+    '''
+    if quantizations is None:
+        quantizations = ["fp32"]
+    configs = [(arch, quantization, mode, batch_size) for arch in archs for quantization in quantizations for mode in modes for batch_size in batch_sizes]
+    results = []
+    # a fresh process per configuration, such that the peak RSS of one configuration does not carry over to the next
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=1, maxtasksperchild=1) as pool:
+        for arch, quantization, mode, batch_size in configs:
+            result = pool.apply(benchmark_config, (arch, mode, batch_size, prompt_name, num_claims, evidence_per_claim, prefix_cache_mb, num_threads, seed, quantization))
+            print(f"{arch} {quantization} {mode} batch size {batch_size}: {result['prompts_per_sec']:.2f} prompts/sec, {result['tokens_per_sec']:.1f} tokens/sec, "
+                  f"p50 latency {result['latency_ms_p50']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+            results.append(result)
+
+    benchmark = {"git_commit": get_git_commit(),
+                 "torch_version": torch.__version__,
+                 "transformers_version": transformers.__version__,
+                 "platform": platform.platform(),
+                 "cpu_count": os.cpu_count(),
+                 "results": results}
+    with open(output_path, "w") as f:
+        json.dump(benchmark, f, indent=2)
+    print(f"Saved benchmark results to '{output_path}'.")
+    return benchmark
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the prediction throughput with tiny randomly initialised models, without downloading any model.")
+    parser.add_argument("--output_file", type=str, default="benchmark_results.json", help="Path to the json file to save the results to")
+    parser.add_argument("--archs", type=str, nargs="+", default=['pythia','llama'], choices=['pythia','llama'], help="Model architectures to benchmark")
+    parser.add_argument("--quantizations", type=str, nargs="+", default=['fp32'], choices=[quantization for quantization in QUANTIZATIONS if quantization != "bnb_4bit"], help="Model quantisations to benchmark")
+    parser.add_argument("--modes", type=str, nargs="+", default=['generate','score'], choices=['generate','score','constrained'], help="Inference modes to benchmark")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1,4,16], help="Batch sizes to benchmark")
+    parser.add_argument("--prompt_name", type=str, default="pythia_evidence_prompt_3_shot", help="Prompt to use, evidence is included if the prompt has an evidence placeholder")
+    parser.add_argument("--num_claims", type=int, default=20, help="Number of synthetic claims")
+    parser.add_argument("--evidence_per_claim", type=int, default=5, help="Number of synthetic evidence rows per claim")
+    parser.add_argument("--prefix_cache_mb", type=int, default=None, help="Use the prefix cache with this memory limit in MB for a batch size of 1. Disabled by default.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of torch threads, the torch default if not set")
+    parser.add_argument("--seed", type=int, default=1000, help="Seed for the synthetic data and model weights")
+
+    args = parser.parse_args()
+    print(args)
+    print()
+
+    run_benchmark(output_path=args.output_file,
+                  archs=args.archs,
+                  modes=args.modes,
+                  batch_sizes=args.batch_sizes,
+                  prompt_name=args.prompt_name,
+                  num_claims=args.num_claims,
+                  evidence_per_claim=args.evidence_per_claim,
+                  prefix_cache_mb=args.prefix_cache_mb,
+                  num_threads=args.num_threads,
+                  seed=args.seed,
+                  quantizations=args.quantizations)
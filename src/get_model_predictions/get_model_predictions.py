@@ -2,27 +2,28 @@ import os
 import torch
 import argparse
 import random
+import multiprocessing
 import numpy as np
 import transformers
 import pandas as pd
 from tqdm import tqdm
 
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, GenerationConfig
-from datasets import Dataset
-from transformers.pipelines.pt_utils import KeyDataset
-from torch.nn.functional import softmax
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
 
 from src.get_model_predictions.utils import TextWithLogitsGenerationPipeline
 from src.get_model_predictions.prompts import PROMPT_DICT
+from src.get_model_predictions.prompt_store import get_prompt_dataset, PromptIdsDataset
+from src.get_model_predictions.prefix_cache import RadixPrefixCache
+from src.get_model_predictions.journal import PredictionJournal, get_journal_path
+from src.get_model_predictions.prediction_cache import PredictionCache, get_model_revision
+from src.get_model_predictions.quantization import QUANTIZATIONS, get_bnb_config, quantize_model, get_model_size_mb
+from src.get_model_predictions.batch_scheduler import TokenBudgetScheduler, get_budget_key
+from src.logprob_store import LogprobStoreWriter
+from src.model_worker import submit_job
 
 torch.backends.cuda.enable_mem_efficient_sdp(False)
 torch.backends.cuda.enable_flash_sdp(False)
 
-bnb_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_quant_type="nf4",
-    bnb_4bit_use_double_quant=True,
-)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 def enforce_reproducibility(seed=1000):
@@ -36,76 +37,49 @@ def enforce_reproducibility(seed=1000):
     random.seed(seed)
     np.random.seed(seed)
 
-def get_prompt(row, prompt_template, use_evidence):
-    prompt = prompt_template.replace("<claim>", row['claim'])
-    if "<claimant>" in prompt:
-        prompt = prompt.replace("<claimant>", row['claimant'])
-        
-    if use_evidence:
-        prompt = prompt.replace("<evidence>", row['evidence'])
-    return prompt
-
-def predict_veracity(file_path:str, save_folder:str, use_evidence:str, model_code:str, prompt_name:str, cache_folder:str)-> None:
-    '''
-    Function to predict the stance for claim, evidence pairs read from a file
-    Args:
-    file_path: Path to the file containing the claims and evidence
-    '''
+def load_model_and_tokenizer(model_code:str, cache_folder:str, quantization:str="fp32"):
     tokenizer = AutoTokenizer.from_pretrained(model_code, cache_dir=cache_folder)
     model = AutoModelForCausalLM.from_pretrained(model_code,
-            # quantization_config=bnb_config,
-            # torch_dtype=torch.bfloat16,
+            quantization_config=get_bnb_config() if quantization == "bnb_4bit" else None,
+            torch_dtype=torch.bfloat16 if quantization == "bf16" else None,
             device_map="auto",
             trust_remote_code=True,
             cache_dir=cache_folder)
+    if quantization not in ["fp32", "bnb_4bit"]:
+        model = quantize_model(model, quantization)
+        print(f"Quantized the model to {quantization}, model size {get_model_size_mb(model):.1f} MB.")
     tokenizer.pad_token = tokenizer.eos_token
-    
+    # left padding such that the generated tokens directly follow the prompts in a batch
+    tokenizer.padding_side = "left"
+    return model, tokenizer
+
+def load_data(file_path:str)-> pd.DataFrame:
     if file_path.endswith(".tsv"):
         data = pd.read_csv(file_path, sep="\t").set_index("id")
     elif file_path.endswith(".csv"):
         data = pd.read_csv(file_path).set_index("id")
     else:
         raise ValueError(f"Can only handle .tsv or .csv files, got '{file_path}'.")
-    prompt_template = PROMPT_DICT[prompt_name]
-    
-    if use_evidence == 'yes':
-        assert "<evidence>" in prompt_template
-        print("Using evidence")
-        use_evidence = True
-    else:
-        assert "<evidence>" not in prompt_template
-        print("Not using evidence")
-        use_evidence = False
-        # if we are not considering evidence, we just need to run the model on the unique claims
-        data = data.drop_duplicates(subset=["claim_id"])
-        
-    data["prompt"] = data.apply(lambda row: get_prompt(row, prompt_template, use_evidence), axis=1)
-    dataset = Dataset.from_pandas(data[["claim_id", "prompt"]])
-    
-    # pipe = transformers.pipeline(model=model, tokenizer=tokenizer, task='text-generation')
-    pipe = TextWithLogitsGenerationPipeline(model=model, tokenizer=tokenizer)
-    eos_token_ids = [tokenizer.eos_token_id, 
-                     tokenizer.encode("\n", add_special_tokens=False)[0], 
-                     tokenizer.encode(" \n", add_special_tokens=False)[0], 
-                     tokenizer.encode("\n ", add_special_tokens=False)[0], 
-                     tokenizer.encode(" \n ", add_special_tokens=False)[0],
-                     tokenizer.encode("\n\n", add_special_tokens=False)[0], 
-                     tokenizer.encode(" \n\n", add_special_tokens=False)[0], 
-                     tokenizer.encode("\n\n\n", add_special_tokens=False)[0], 
-                     tokenizer.encode(" \n\n\n", add_special_tokens=False)[0], 
-                     ]
-    print(f"Using the following EOS token IDs for the generation: {eos_token_ids}")
-    config = GenerationConfig(
-        eos_token_id=eos_token_ids,
-        max_new_tokens=10,
-        output_logits=True,
-        return_dict_in_generate=True,
-    )
-    
+    return data
+
+def get_eos_token_ids(tokenizer):
+    return [tokenizer.eos_token_id, 
+            tokenizer.encode("\n", add_special_tokens=False)[0], 
+            tokenizer.encode(" \n", add_special_tokens=False)[0], 
+            tokenizer.encode("\n ", add_special_tokens=False)[0], 
+            tokenizer.encode(" \n ", add_special_tokens=False)[0],
+            tokenizer.encode("\n\n", add_special_tokens=False)[0], 
+            tokenizer.encode(" \n\n", add_special_tokens=False)[0], 
+            tokenizer.encode("\n\n\n", add_special_tokens=False)[0], 
+            tokenizer.encode(" \n\n\n", add_special_tokens=False)[0], 
+            ]
+
+LABEL_TOKENS = ["True", "False", "None", "Support", "Refute"]
+
+def get_logit_ixs(tokenizer):
     # get logits for the following tokens
-    logit_tokens = ["True", "False", "None", "Support", "Refute"]
     logit_ixs = {}
-    for tok in logit_tokens:
+    for tok in LABEL_TOKENS:
         tok_ix = tokenizer.encode(tok, add_special_tokens=False)
         if len(tok_ix) > 1:
             print(f"Warning: token {tok} corresponds to multiple token IDs ({tok_ix}), will record logits for the first ID.")
@@ -117,55 +91,522 @@ def predict_veracity(file_path:str, save_folder:str, use_evidence:str, model_cod
         # record logits for tokens for which the space does not add an extra token ID
         if len(tok_w_space_ix) == len(tok_ix):
             logit_ixs[tok_w_space] = tok_w_space_ix[0]
+    return logit_ixs
+
+def get_label_token_ids(tokenizer)-> list:
+    '''
+    Function to get the token ids of the labels, with and without a preceding space, for label-constrained decoding.
+    Labels may consist of several tokens.
+    '''
+    label_token_ids = []
+    for tok in LABEL_TOKENS:
+        for label in [tok, " " + tok]:
+            token_ids = tokenizer.encode(label, add_special_tokens=False)
+            if token_ids not in label_token_ids:
+                label_token_ids.append(token_ids)
+    return label_token_ids
+
+def get_generation_config(eos_token_ids:list)-> GenerationConfig:
+    return GenerationConfig(
+        eos_token_id=eos_token_ids,
+        max_new_tokens=10,
+        return_dict_in_generate=True,
+    )
+
+def get_pipe_kwargs(tokenizer, mode:str, config:GenerationConfig, logit_ixs:dict, top_k:int=0)-> dict:
+    if mode == "score":
+        return {"score_token_ids": list(logit_ixs.values()), "score_top_k": top_k}
+    pipe_kwargs = {"pad_token_id": tokenizer.pad_token_id, 
+                   "return_full_text": False,
+                   "generation_config": config,
+                   # only keep the logits of the tracked tokens (and the top-k) instead of the full-vocabulary logits
+                   "capture_token_ids": list(logit_ixs.values()),
+                   "capture_top_k": top_k}
+    if mode == "constrained":
+        pipe_kwargs["label_token_ids"] = get_label_token_ids(tokenizer)
+    return pipe_kwargs
+
+def get_result(out:list, mode:str, logit_ixs:dict, top_k:int=0)-> dict:
+    '''
+    Function to get the prediction and the probabilities of the tracked tokens from the pipeline output for one prompt
+    Args:
+    top_k: Also get the top-k token ids and log-probabilities at the answer position (first predicted token) if > 0
+    '''
+    if mode == "score":
+        # the prediction is the label with the highest probability, " True" and "True" both map to "True"
+        token_probs = out[0]["token_probs"]
+        pred = list(logit_ixs.keys())[token_probs.argmax().item()].strip()
+        tok_probs = dict(zip(logit_ixs.keys(), token_probs.tolist()))
+        if top_k > 0:
+            top_k_ids, top_k_logprobs = out[0]["top_k_ids"], out[0]["top_k_logprobs"]
+    else:
+        pred = out[0]["generated_text"].strip()
+        # get normalized logits of interest for first predicted token - TODO: check that this is not the BOS token
+        # captured logits hold the log-softmax normaliser followed by the logits of the tracked tokens (and the top-k logits)
+        first_step_logits = out[0]["captured_logits"][0][0]
+        probs = (first_step_logits[1:len(logit_ixs)+1] - first_step_logits[0]).exp()
+        tok_probs = dict(zip(logit_ixs.keys(), probs.tolist()))
+        if top_k > 0:
+            top_k_ids = out[0]["captured_top_k_ids"][0][0]
+            top_k_logprobs = first_step_logits[len(logit_ixs)+1:] - first_step_logits[0]
+    result = {"prediction": pred, "probs": tok_probs}
+    if top_k > 0:
+        result["top_k"] = {"token_ids": top_k_ids.tolist(), "logprobs": top_k_logprobs.tolist()}
+    return result
+
+def get_predictions_filename(model_code:str, use_evidence:bool, prompt_name:str, quantization:str="fp32")-> str:
+    MODEL_NICKNAME = model_code.split('/')[1].split('-')[0]
+    # quantised runs get their own files, such that they can be compared against the fp32 run
+    quantization_suffix = "" if quantization == "fp32" else f"_{quantization}"
+    return f'{MODEL_NICKNAME}_preds_use_evidence_{use_evidence}_prompt_{prompt_name}{quantization_suffix}.tsv'
+
+def get_paired_predictions_filename(model_code:str, claim_prompt_name:str, evidence_prompt_name:str, quantization:str="fp32")-> str:
+    MODEL_NICKNAME = model_code.split('/')[1].split('-')[0]
+    quantization_suffix = "" if quantization == "fp32" else f"_{quantization}"
+    return f'{MODEL_NICKNAME}_preds_paired_prompts_{claim_prompt_name}_{evidence_prompt_name}{quantization_suffix}.tsv'
+
+def get_logprob_store_path(logprob_store_folder:str, results_path:str)-> str:
+    # one store per results file, named after it
+    return os.path.join(logprob_store_folder, os.path.splitext(os.path.basename(results_path))[0])
+
+def save_logprob_store(store_path:str, results:dict, sample_ids:list)-> None:
+    '''
+    Function to save the answer-position top-k token ids and log-probabilities of the results (see get_result) to a logprob store
+    '''
+    writer = LogprobStoreWriter(store_path)
+    missing_ids = []
+    for sample_id in sample_ids:
+        if "top_k" not in results[sample_id]:
+            # e.g. predictions resumed from a journal of a run without export
+            missing_ids.append(sample_id)
+            continue
+        writer.add(sample_id, {"top_k_ids": np.array(results[sample_id]["top_k"]["token_ids"], dtype=np.int32),
+                               "top_k_logprobs": np.array(results[sample_id]["top_k"]["logprobs"], dtype=np.float32)})
+    writer.close()
+    if len(missing_ids) > 0:
+        print(f"Warning: no top-k log-probabilities for {len(missing_ids)} samples, they are not in the logprob store.")
+
+def get_model_id(model_code:str, quantization:str="fp32")-> str:
+    # quantised models give different predictions, so they are cached separately
+    return model_code if quantization == "fp32" else f"{model_code}:{quantization}"
+
+def select_samples(data:pd.DataFrame, use_evidence:bool)-> pd.DataFrame:
+    if not use_evidence:
+        # if we are not considering evidence, we just need to run the model on the unique claims
+        data = data.drop_duplicates(subset=["claim_id"])
+    return data.copy()
+
+def add_prediction_columns(data:pd.DataFrame, results:dict, use_evidence:bool)-> pd.DataFrame:
+    '''
+    Function to add the predictions and token probabilities, stored by sample id in results, as columns to data
+    '''
+    if use_evidence:
+        suffix = "w_evidence"
+    else:
+        suffix = "wo_evidence"
+    data[f"prediction_{suffix}"] = [results[sample_id]["prediction"] for sample_id in data.index]
+    logit_tokens = list(results[data.index[0]]["probs"].keys()) if len(data) > 0 else []
+    for tok in logit_tokens:
+        data[f"p_{tok.replace(' ', '_')}"] = [results[sample_id]["probs"][tok] for sample_id in data.index]
+    return data
+
+def add_scaled_p_diffs(data:pd.DataFrame, tokens:list=["True", "False", "None"])-> pd.DataFrame:
+    '''
+    Function to add the change in token probability from without to with evidence, scaled by how much the probability can move
+    (diff_p_<token>_scaled columns, as in prepare_data.ipynb)
+    '''
+    for tok in tokens:
+        p_w = data[f"p_{tok}_w_evidence"]
+        p_wo = data[f"p_{tok}_wo_evidence"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data[f"diff_p_{tok}_scaled"] = np.where(p_w < p_wo, (p_w-p_wo)/p_wo, (p_w-p_wo)/(1-p_wo))
+    return data
+
+def merge_paired_predictions(w_evidence_preds:pd.DataFrame, wo_evidence_preds:pd.DataFrame)-> pd.DataFrame:
+    '''
+    Function to broadcast the claim-level predictions without evidence to all samples with evidence for the same claim,
+    and add the scaled probability differences
+    '''
+    w_p_cols = [col for col in w_evidence_preds.columns if col.startswith("p_")]
+    wo_p_cols = [col for col in wo_evidence_preds.columns if col.startswith("p_")]
+    data = w_evidence_preds.rename(columns={col: f"{col}_w_evidence" for col in w_p_cols})
+    claim_preds = wo_evidence_preds.set_index("claim_id")[["prediction_wo_evidence"] + wo_p_cols]
+    data = data.join(claim_preds.rename(columns={col: f"{col}_wo_evidence" for col in wo_p_cols}), on="claim_id")
+    return add_scaled_p_diffs(data)
+
+def get_shard(data:pd.DataFrame, shard_ix:int, num_shards:int)-> pd.DataFrame:
+    # samples are sharded by claim, such that all evidence for a claim (sharing a prompt prefix) ends up in the same shard
+    claim_shards = {claim_id: ix % num_shards for ix, claim_id in enumerate(data.claim_id.unique())}
+    return data[data.claim_id.map(claim_shards) == shard_ix]
+
+def get_shard_results_path(results_path:str, shard_ix:int, num_shards:int)-> str:
+    return os.path.splitext(results_path)[0] + f".shard_{shard_ix}_of_{num_shards}.jsonl"
+
+def run_predictions(data:pd.DataFrame, pipe:TextWithLogitsGenerationPipeline, prompt_name:str, use_evidence:bool, mode:str="generate", batch_size:int=1, journal_path:str=None, prediction_cache:PredictionCache=None, prompt_store_folder:str=None, top_k:int=0, batch_scheduler:TokenBudgetScheduler=None)-> pd.DataFrame:
+    '''
+    Function to get the predictions of an already loaded model for one prompt
+    Args:
+    data: Samples with claims and evidence, indexed by id
+    pipe: Pipeline with the model and tokenizer to use
+    journal_path: Path to a journal to which each prediction is written directly. Samples already found in the journal are not rerun.
+    prediction_cache: Persistent cache of predictions. Only prompts not found in the cache are run.
+    prompt_store_folder: Folder with the stored tokenised prompts, shared between models with the same tokenizer. Prompts are not stored if None.
+    top_k: Number of most probable tokens at the answer position to keep in the results (under 'top_k'), none if 0.
+    batch_scheduler: Scheduler forming batches under a token budget, used instead of batch_size if given.
+    Returns the samples with the prediction and token probability columns added
+    '''
+    tokenizer = pipe.tokenizer
+    prompt_template = PROMPT_DICT[prompt_name]
+    
+    if use_evidence:
+        assert "<evidence>" in prompt_template
+        print("Using evidence")
+    else:
+        assert "<evidence>" not in prompt_template
+        print("Not using evidence")
+    data = select_samples(data, use_evidence)
+    
+    eos_token_ids = get_eos_token_ids(tokenizer)
+    print(f"Using the following EOS token IDs for the generation: {eos_token_ids}")
+    config = get_generation_config(eos_token_ids)
+    
+    logit_ixs = get_logit_ixs(tokenizer)
     print("Will record logits for the following tokens with token ids:")
     print(logit_ixs)
     print()
         
-    pred_list = []
-    probs_list = {key: [] for key in logit_ixs.keys()}
-    for out in tqdm(pipe(KeyDataset(dataset, "prompt"), 
-                         pad_token_id=tokenizer.pad_token_id, 
-                         return_full_text=False,
-                         generation_config=config,),
-                    total=len(data)):
-        pred_list.append(out[0]["generated_text"].strip())
+    pipe_kwargs = get_pipe_kwargs(tokenizer, mode, config, logit_ixs, top_k)
+    # everything apart from the prompt that affects the predictions, used to key the prediction cache
+    cache_settings = {"mode": mode, "generation_config": config.to_diff_dict(), "logit_ixs": logit_ixs}
+    if top_k > 0:
+        cache_settings["top_k"] = top_k
+    
+    journal = PredictionJournal(journal_path) if journal_path is not None else None
+    results = journal.read() if journal is not None else {}
+    if len(results) > 0:
+        print(f"Found predictions for {len(results)} samples in '{journal_path}', will only run the remaining samples.")
+    # prompts are rendered and tokenised once for all samples, and loaded from the prompt store if it holds them already
+    prompt_dataset = get_prompt_dataset(data, tokenizer, prompt_name, use_evidence, prompt_store_folder)
+    todo_mask = ~data.index.isin(list(results.keys()))
+    todo_data = data[todo_mask].copy()
+    todo_data["prompt"] = np.array(prompt_dataset["prompt"], dtype=object)[todo_mask]
+    todo_data["num_tokens"] = np.array(prompt_dataset["num_tokens"])[todo_mask]
+    todo_data["row_ix"] = np.flatnonzero(todo_mask)
+    
+    def add_result(prompt, result):
+        # all samples with the same prompt get the same result
+        for sample_id in prompt_ids[prompt]:
+            results[sample_id] = result
+            if journal is not None:
+                journal.write(sample_id, result)
+    
+    prompt_ids = {prompt: list(ids) for prompt, ids in todo_data.groupby("prompt", sort=False).groups.items()}
+    if prediction_cache is not None:
+        cached_results = prediction_cache.lookup(prompt_template, cache_settings, todo_data["prompt"].tolist())
+        for prompt, result in cached_results.items():
+            add_result(prompt, result)
+        print(f"Prediction cache statistics: {prediction_cache.get_stats()}")
+        todo_data = todo_data[~todo_data["prompt"].isin(list(cached_results.keys()))]
+    # the model only needs to be run once per unique prompt
+    todo_data = todo_data.drop_duplicates(subset=["prompt"])
         
-        # get normalized logits of interest for first predicted token - TODO: check that this is not the BOS token
-        probs = softmax(out[0]["logits"][0][0], dim=0)
-        for tok, tok_id in logit_ixs.items():
-            probs_list[tok].append(probs[tok_id].detach().item())
+    # sort the prompts by length such that prompts of similar lengths are batched together
+    if (batch_size > 1 or batch_scheduler is not None) and len(todo_data) > 0:
+        order = np.argsort(todo_data["num_tokens"].values, kind="stable")[::-1]
+    else:
+        order = np.arange(len(todo_data))
+    todo_data = todo_data.iloc[order]
+    # the pipeline gets the stored input ids, such that the prompts are not tokenised again
+    dataset = PromptIdsDataset(prompt_dataset.select(todo_data["row_ix"].tolist()))
     
-    if use_evidence:
-        suffix = "w_evidence"
+    if batch_scheduler is not None:
+        # the budget counts the prompt tokens and the tokens to generate, nothing is generated in score mode
+        num_new_tokens = 0 if mode == "score" else config.max_new_tokens
+        def run_batch(batch):
+            return list(pipe(PromptIdsDataset(dataset.dataset.select(batch)), batch_size=len(batch), **pipe_kwargs))
+        outputs = batch_scheduler.run(todo_data["num_tokens"].tolist(), run_batch, num_new_tokens)
     else:
-        suffix = "wo_evidence"
-    data[f"prediction_{suffix}"] = pred_list
-    for tok in logit_ixs.keys():
-        data[f"p_{tok.replace(' ', '_')}"] = probs_list[tok]
+        outputs = pipe(dataset, batch_size=batch_size, **pipe_kwargs) if len(dataset) > 0 else []
+    # the outputs are in the same order as the dataset, results are stored by id to get back the original order
+    for prompt, out in zip(todo_data["prompt"], tqdm(outputs, total=len(dataset))):
+        result = get_result(out, mode, logit_ixs, top_k)
+        add_result(prompt, result)
+        if prediction_cache is not None:
+            prediction_cache.store(prompt_template, cache_settings, prompt, result)
+    if journal is not None:
+        journal.close()
+    if prediction_cache is not None:
+        prediction_cache.commit()
+    if pipe.prefix_cache is not None:
+        print(f"Prefix cache statistics: {pipe.prefix_cache.get_stats()}")
+    if batch_scheduler is not None:
+        print(f"Batch scheduler statistics: {batch_scheduler.get_stats()}")
     
-    data = data.drop(columns=["prompt"])
-    MODEL_NICKNAME = model_code.split('/')[1].split('-')[0]
-    filename = f'{MODEL_NICKNAME}_preds_use_evidence_{use_evidence}_prompt_{prompt_name}.tsv'
-    data.to_csv(os.path.join(save_folder, filename), sep='\t')
+    return add_prediction_columns(data, results, use_evidence)
+
+def collect_predictions(file_path:str, use_evidence:bool, model_code:str, prompt_name:str, cache_folder:str, journal_path:str, prefix_cache_mb:int=None, mode:str="generate", batch_size:int=1, prediction_cache_path:str=None, prompt_store_folder:str=None, quantization:str="fp32", top_k:int=0, max_batch_tokens:int=None, budget_file:str=None, shard_ix:int=0, num_shards:int=1, model=None, tokenizer=None)-> pd.DataFrame:
+    if model is None:
+        model, tokenizer = load_model_and_tokenizer(model_code, cache_folder, quantization)
+    batch_scheduler = TokenBudgetScheduler(max_batch_tokens, budget_file, get_budget_key(get_model_id(model_code, quantization), model.device, mode)) if max_batch_tokens else None
+    prediction_cache = PredictionCache(prediction_cache_path, get_model_id(model_code, quantization), get_model_revision(model)) if prediction_cache_path else None
+    data = get_shard(load_data(file_path), shard_ix, num_shards)
+    
+    # pipe = transformers.pipeline(model=model, tokenizer=tokenizer, task='text-generation')
+    prefix_cache = RadixPrefixCache(prefix_cache_mb) if prefix_cache_mb else None
+    pipe = TextWithLogitsGenerationPipeline(model=model, tokenizer=tokenizer, prefix_cache=prefix_cache)
+    data = run_predictions(data, pipe, prompt_name, use_evidence, mode=mode, batch_size=batch_size, journal_path=journal_path, prediction_cache=prediction_cache, prompt_store_folder=prompt_store_folder, top_k=top_k, batch_scheduler=batch_scheduler)
+    if prediction_cache is not None:
+        prediction_cache.close()
+    return data
+
+def predict_shard(results_path:str, shard_ix:int, num_shards:int, num_threads:int=None, **predict_kwargs)-> None:
+    '''
+    Function to collect the predictions for one shard of the samples, used by the worker processes and for runs spread over several nodes.
+    The shard predictions are journaled and the journal is moved to the shard results path once the shard is done.
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    shard_results_path = get_shard_results_path(results_path, shard_ix, num_shards)
+    if os.path.exists(shard_results_path):
+        print(f"Shard {shard_ix}/{num_shards} is already done ('{shard_results_path}').")
+        return
+    journal_path = get_journal_path(shard_results_path)
+    collect_predictions(journal_path=journal_path, shard_ix=shard_ix, num_shards=num_shards, **predict_kwargs)
+    if not os.path.exists(journal_path):
+        # empty shard
+        open(journal_path, "w").close()
+    os.replace(journal_path, shard_results_path)
+
+def merge_shards(results_path:str, file_path:str, use_evidence:bool, num_shards:int, logprob_store_folder:str=None)-> bool:
+    '''
+    Function to merge the shard predictions to the results file, with the same sample order as for an unsharded run.
+    The top-k log-probabilities are saved to a logprob store in logprob_store_folder, if given.
+    Shards finishing at the same time (e.g. on several nodes) may both try to merge, the merge is claimed with a lock file
+    such that only one of them merges.
+    Returns False if not all shards are done yet or another process merges them.
+    '''
+    shard_results_paths = [get_shard_results_path(results_path, shard_ix, num_shards) for shard_ix in range(num_shards)]
+    missing_shards = [path for path in shard_results_paths if not os.path.exists(path)]
+    if len(missing_shards) > 0:
+        print(f"{len(missing_shards)} of {num_shards} shards are not done yet, the results will be merged once all shards are done.")
+        return False
+    lock_path = results_path + ".merge_lock"
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        print(f"The shards are being merged by another process (remove '{lock_path}' if it was killed).")
+        return False
+    try:
+        if any(not os.path.exists(path) for path in shard_results_paths):
+            # merged by another process between the check and the claim
+            print(f"The shards were already merged to '{results_path}'.")
+            return False
+        results = {}
+        for path in shard_results_paths:
+            results.update(PredictionJournal(path).read())
+        data = select_samples(load_data(file_path), use_evidence)
+        data = add_prediction_columns(data, results, use_evidence)
+        # written to a temporary file first, such that a killed merge does not leave a partial results file
+        data.to_csv(results_path + ".tmp", sep='\t')
+        os.replace(results_path + ".tmp", results_path)
+        if logprob_store_folder is not None:
+            save_logprob_store(get_logprob_store_path(logprob_store_folder, results_path), results, data.index.tolist())
+        for path in shard_results_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    finally:
+        os.remove(lock_path)
+    print(f"Merged the predictions of {num_shards} shards to '{results_path}'.")
+    return True
+
+def predict_veracity(file_path:str, save_folder:str, use_evidence:str, model_code:str, prompt_name:str, cache_folder:str, prefix_cache_mb:int=None, mode:str="generate", batch_size:int=1, prediction_cache_path:str=None, prompt_store_folder:str=None, quantization:str="fp32", num_workers:int=1, shard:str=None, logprob_store_folder:str=None, logprob_top_k:int=10, max_batch_tokens:int=None, budget_file:str=None, model=None, tokenizer=None)-> None:
+    '''
+    Function to predict the stance for claim, evidence pairs read from a file
+    Args:
+    file_path: Path to the file containing the claims and evidence
+    prefix_cache_mb: Memory limit (in MB) for the cache of past key values of shared prompt prefixes. No prefix cache is used if None.
+    mode: 'generate' to generate the answer, 'score' to only run one forward pass and predict the tracked label token with the highest probability,
+          'constrained' to restrict the generation to the labels and stop once a full label is generated
+    batch_size: Number of prompts per batch. Prompts are sorted by length before batching to reduce padding.
+    prediction_cache_path: Path to a SQLite database with cached predictions, shared across runs. No prediction cache is used if None.
+    prompt_store_folder: Folder in which the tokenised prompts are stored, shared between runs and models with the same tokenizer. Prompts are not stored if None.
+    quantization: Quantisation of the model, e.g. 'int8_dynamic' or 'int4_weight' for CPU inference or 'bnb_4bit' for GPUs. The model is not quantised for 'fp32'.
+    num_workers: Number of worker processes, each loading the model and processing one shard of the claims
+    shard: Only process one shard of the claims, given as 'i/N' for shard i (0-indexed) out of N, e.g. to spread a run over several nodes.
+           The shards are merged to the results file when the last shard is done.
+    logprob_store_folder: Folder to save the token ids and log-probabilities of the logprob_top_k most probable tokens at the answer position to,
+                          in a binary store named after the results file (see src/logprob_store.py). Not saved if None.
+    max_batch_tokens: Form batches under a budget of prompt and generated tokens instead of using batch_size, lowered when running out of memory
+    budget_file: Path to a json file in which the token budgets that fit in memory are recorded for later runs
+    model, tokenizer: Already loaded model and tokenizer of model_code (e.g. in a model worker, see src/model_worker.py), loaded if None
+    '''
+    if prefix_cache_mb and (batch_size > 1 or max_batch_tokens):
+        raise ValueError("The prefix cache can only be used with a batch size of 1.")
+    if num_workers > 1 and shard is not None:
+        raise ValueError("Use either several workers or a shard, not both.")
+    if num_workers > 1 and model is not None:
+        raise ValueError("Several workers load their own model, a loaded model can only be used in one process.")
+    use_evidence = use_evidence == 'yes'
+    results_path = os.path.join(save_folder, get_predictions_filename(model_code, use_evidence, prompt_name, quantization))
+    predict_kwargs = {"file_path": file_path, 
+                      "use_evidence": use_evidence, 
+                      "model_code": model_code, 
+                      "prompt_name": prompt_name, 
+                      "cache_folder": cache_folder, 
+                      "prefix_cache_mb": prefix_cache_mb, 
+                      "mode": mode, 
+                      "batch_size": batch_size, 
+                      "prediction_cache_path": prediction_cache_path,
+                      "prompt_store_folder": prompt_store_folder,
+                      "quantization": quantization,
+                      "top_k": logprob_top_k if logprob_store_folder is not None else 0,
+                      "max_batch_tokens": max_batch_tokens,
+                      "budget_file": budget_file}
+    
+    if num_workers > 1:
+        # split the cores between the workers, as intra-op threading scales badly for small batches
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        print(f"Starting {num_workers} workers with {num_threads} threads each.")
+        ctx = multiprocessing.get_context("spawn")
+        workers = [ctx.Process(target=predict_shard, 
+                               args=(results_path, shard_ix, num_workers, num_threads), 
+                               kwargs=predict_kwargs) for shard_ix in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed_shards = [shard_ix for shard_ix, worker in enumerate(workers) if worker.exitcode != 0]
+        if len(failed_shards) > 0:
+            raise RuntimeError(f"Workers for shards {failed_shards} failed, rerun to resume them.")
+        merge_shards(results_path, file_path, use_evidence, num_workers, logprob_store_folder)
+    elif shard is not None:
+        shard_ix, num_shards = [int(val) for val in shard.split("/")]
+        if not 0 <= shard_ix < num_shards:
+            raise ValueError(f"Shard should be given as 'i/N' with 0 <= i < N, got '{shard}'.")
+        predict_shard(results_path, shard_ix, num_shards, model=model, tokenizer=tokenizer, **predict_kwargs)
+        merge_shards(results_path, file_path, use_evidence, num_shards, logprob_store_folder)
+    else:
+        # predictions are journaled per sample, such that a killed run can be resumed, and compacted to the results file at the end
+        journal_path = get_journal_path(results_path)
+        data = collect_predictions(journal_path=journal_path, model=model, tokenizer=tokenizer, **predict_kwargs)
+        data.to_csv(results_path, sep='\t')
+        if logprob_store_folder is not None:
+            save_logprob_store(get_logprob_store_path(logprob_store_folder, results_path), PredictionJournal(journal_path).read(), data.index.tolist())
+        PredictionJournal(journal_path).remove()
+
+def predict_paired(file_path:str, save_folder:str, model_code:str, claim_prompt_name:str, evidence_prompt_name:str, cache_folder:str, prefix_cache_mb:int=None, mode:str="generate", batch_size:int=1, prediction_cache_path:str=None, prompt_store_folder:str=None, quantization:str="fp32", logprob_store_folder:str=None, logprob_top_k:int=10, max_batch_tokens:int=None, budget_file:str=None, model=None, tokenizer=None)-> None:
+    '''
+    Function to collect the predictions without and with evidence with one model load, and save them to one file
+    together with the scaled probability differences (diff_p_<token>_scaled)
+    Args:
+    claim_prompt_name: Prompt used for the unique claims without evidence
+    evidence_prompt_name: Prompt used for the samples with evidence
+    The remaining arguments are the same as for predict_veracity.
+    '''
+    if prefix_cache_mb and (batch_size > 1 or max_batch_tokens):
+        raise ValueError("The prefix cache can only be used with a batch size of 1.")
+    results_path = os.path.join(save_folder, get_paired_predictions_filename(model_code, claim_prompt_name, evidence_prompt_name, quantization))
+    if model is None:
+        model, tokenizer = load_model_and_tokenizer(model_code, cache_folder, quantization)
+    prediction_cache = PredictionCache(prediction_cache_path, get_model_id(model_code, quantization), get_model_revision(model)) if prediction_cache_path else None
+    prefix_cache = RadixPrefixCache(prefix_cache_mb) if prefix_cache_mb else None
+    pipe = TextWithLogitsGenerationPipeline(model=model, tokenizer=tokenizer, prefix_cache=prefix_cache)
+    # the token budget is shared between the two settings, such that a budget lowered for one is kept for the other
+    batch_scheduler = TokenBudgetScheduler(max_batch_tokens, budget_file, get_budget_key(get_model_id(model_code, quantization), model.device, mode)) if max_batch_tokens else None
+    data = load_data(file_path)
+    
+    preds = {}
+    journal_paths = {}
+    for use_evidence, prompt_name in [(False, claim_prompt_name), (True, evidence_prompt_name)]:
+        journal_paths[use_evidence] = os.path.splitext(results_path)[0] + f".use_evidence_{use_evidence}.journal.jsonl"
+        preds[use_evidence] = run_predictions(data, pipe, prompt_name, use_evidence, mode=mode, batch_size=batch_size, journal_path=journal_paths[use_evidence], prediction_cache=prediction_cache, prompt_store_folder=prompt_store_folder, top_k=logprob_top_k if logprob_store_folder is not None else 0, batch_scheduler=batch_scheduler)
+        if logprob_store_folder is not None:
+            store_path = get_logprob_store_path(logprob_store_folder, results_path) + f".use_evidence_{use_evidence}"
+            save_logprob_store(store_path, PredictionJournal(journal_paths[use_evidence]).read(), preds[use_evidence].index.tolist())
+    if prediction_cache is not None:
+        prediction_cache.close()
+    
+    merge_paired_predictions(preds[True], preds[False]).to_csv(results_path, sep='\t')
+    for journal_path in journal_paths.values():
+        PredictionJournal(journal_path).remove()
+    print(f"Saved paired predictions to '{results_path}'.")
 
 if __name__ == '__main__':
     enforce_reproducibility()
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_file", type=str, help="Path to the data file")
     parser.add_argument("--save_folder", type=str, help="Path to folder to save results to")
-    parser.add_argument("--use_evidence", type=str, default="no", choices=['yes','no'], help="Whether to use evidence or not")
+    parser.add_argument("--use_evidence", type=str, default="no", choices=['yes','no','paired'], help="Whether to use evidence or not. 'paired' runs the claims without evidence (with --claim_prompt_name) and the samples with evidence (with --prompt_name) with one model load.")
     parser.add_argument("--model_name", type=str, default="no", help="Path to Huggingface model")
     parser.add_argument("--prompt_name", type=str, required=True, help="What prompt to use for the evaluation.")
+    parser.add_argument("--claim_prompt_name", type=str, default=None, help="Prompt to use for the claims without evidence with --use_evidence paired.")
     parser.add_argument("--cache_folder", type=str, default=None, help="Path to cache folder")
+    parser.add_argument("--prefix_cache_mb", type=int, default=None, help="Reuse the past key values of shared prompt prefixes (e.g. few-shot examples), with a memory limit in MB. Disabled by default.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of prompts per batch. Prompts are sorted by length to reduce padding.")
+    parser.add_argument("--max_batch_tokens", type=int, default=None, help="Form batches under a budget of prompt and generated tokens instead of using --batch_size. The budget is lowered when a batch runs out of memory.")
+    parser.add_argument("--budget_file", type=str, default=None, help="Path to a json file recording the token budgets that fit in memory per model, device and mode, used as the starting budget of later runs.")
+    parser.add_argument("--prediction_cache", type=str, default=None, help="Path to a SQLite database caching predictions across runs and datasets. Disabled by default.")
+    parser.add_argument("--prompt_store", type=str, default=None, help="Path to a folder storing the tokenised prompts, shared between runs and models with the same tokenizer. Disabled by default.")
+    parser.add_argument("--quantization", type=str, default="fp32", choices=QUANTIZATIONS, help="Quantisation of the model. 'int8_dynamic', 'int8_weight', 'int4_weight' and 'bf16' run on CPUs, 'bnb_4bit' needs a GPU. Not quantised by default.")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of worker processes, each loading the model and processing one shard of the claims with a share of the CPU cores.")
+    parser.add_argument("--shard", type=str, default=None, help="Only process one shard of the claims, given as 'i/N' (0-indexed), e.g. to spread a run over several nodes. The shards are merged when the last one is done.")
+    parser.add_argument("--logprob_store", type=str, default=None, help="Path to a folder to save the top-k token ids and log-probabilities at the answer position to, in a memory-mapped binary store per results file. Disabled by default.")
+    parser.add_argument("--logprob_top_k", type=int, default=10, help="Number of most probable tokens at the answer position to save with --logprob_store.")
+    parser.add_argument("--mode", type=str, default="generate", choices=['generate','score','constrained'], help="'generate' to generate the answer, 'score' to only run one forward pass per prompt and predict the tracked label token with the highest probability, 'constrained' to only generate the labels and stop once a full label is generated.")
+    parser.add_argument("--worker", type=str, default=None, help="Path to the Unix socket of a model worker (src/model_worker.py) with the model already loaded, to run the predictions on instead of loading the model.")
     
     args = parser.parse_args()
     os.makedirs(args.save_folder, exist_ok=True)
     print(args)
     print()
     
-    predict_veracity(file_path=args.data_file, 
-                     save_folder=args.save_folder, 
-                     use_evidence=args.use_evidence, 
-                     model_code=args.model_name, 
-                     prompt_name=args.prompt_name,
-                     cache_folder=args.cache_folder)
\ No newline at end of file
+    if args.worker is not None and args.num_workers > 1:
+        parser.error("--num_workers is not supported with --worker, the model worker runs one job at a time.")
+    if args.use_evidence == "paired":
+        if args.claim_prompt_name is None:
+            parser.error("--claim_prompt_name is required with --use_evidence paired.")
+        if args.num_workers > 1 or args.shard is not None:
+            parser.error("--num_workers and --shard are not supported with --use_evidence paired.")
+        job_kwargs = dict(file_path=args.data_file,
+                          save_folder=args.save_folder,
+                          model_code=args.model_name,
+                          claim_prompt_name=args.claim_prompt_name,
+                          evidence_prompt_name=args.prompt_name,
+                          cache_folder=args.cache_folder,
+                          prefix_cache_mb=args.prefix_cache_mb,
+                          mode=args.mode,
+                          batch_size=args.batch_size,
+                          prediction_cache_path=args.prediction_cache,
+                          prompt_store_folder=args.prompt_store,
+                          quantization=args.quantization,
+                          logprob_store_folder=args.logprob_store,
+                          logprob_top_k=args.logprob_top_k,
+                          max_batch_tokens=args.max_batch_tokens,
+                          budget_file=args.budget_file)
+        if args.worker is not None:
+            submit_job(args.worker, "paired", **job_kwargs)
+        else:
+            predict_paired(**job_kwargs)
+    else:
+        job_kwargs = dict(file_path=args.data_file, 
+                          save_folder=args.save_folder, 
+                          use_evidence=args.use_evidence, 
+                          model_code=args.model_name, 
+                          prompt_name=args.prompt_name,
+                          cache_folder=args.cache_folder,
+                          prefix_cache_mb=args.prefix_cache_mb,
+                          mode=args.mode,
+                          batch_size=args.batch_size,
+                          prediction_cache_path=args.prediction_cache,
+                          prompt_store_folder=args.prompt_store,
+                          quantization=args.quantization,
+                          num_workers=args.num_workers,
+                          shard=args.shard,
+                          logprob_store_folder=args.logprob_store,
+                          logprob_top_k=args.logprob_top_k,
+                          max_batch_tokens=args.max_batch_tokens,
+                          budget_file=args.budget_file)
+        if args.worker is not None:
+            submit_job(args.worker, "predict", **job_kwargs)
+        else:
+            predict_veracity(**job_kwargs)
\ No newline at end of file
@@ -0,0 +1,49 @@
+import os
+import json
+
+class PredictionJournal:
+    '''
+    Append-only journal of per-sample predictions, keyed by sample id.
+    Each prediction is written as one json line and flushed to disk directly, such that a run that is killed
+    can be resumed from the samples that are already done.
+    Args:
+    journal_path: Path to the journal file (.jsonl)
+    '''
+    def __init__(self, journal_path:str):
+        self.journal_path = journal_path
+        self.f = None
+
+    def read(self)-> dict:
+        results = {}
+        if not os.path.exists(self.journal_path):
+            return results
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be incomplete if the run was killed while writing
+                    continue
+                results[entry["id"]] = entry["result"]
+        return results
+
+    def write(self, sample_id, result:dict)-> None:
+        if self.f is None:
+            self.f = open(self.journal_path, "a")
+        self.f.write(json.dumps({"id": sample_id, "result": result}) + "\n")
+        self.f.flush()
+
+    def close(self)-> None:
+        if self.f is not None:
+            os.fsync(self.f.fileno())
+            self.f.close()
+            self.f = None
+
+    def remove(self)-> None:
+        # called once the journal has been compacted to the final results file
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+def get_journal_path(results_path:str)-> str:
+    return os.path.splitext(results_path)[0] + ".journal.jsonl"
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+import hashlib
+
+def hash_text(text:str)-> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def hash_settings(settings:dict)-> str:
+    return hash_text(json.dumps(settings, sort_keys=True, default=str))
+
+class PredictionCache:
+    '''
+    Persistent on-disk (SQLite) cache of model predictions, shared across runs and datasets.
+    Predictions are keyed by (model id, model revision, prompt template hash, rendered prompt hash, generation settings hash),
+    such that only prompts that have not been seen before with the same model and settings need to be run.
+    Args:
+    db_path: Path to the SQLite database, created if it does not exist
+    model_id: Name or path of the model
+    revision: Revision (commit hash) of the model weights
+    commit_every: Number of stored predictions kept in memory before they are written to the database
+    timeout: Number of seconds to wait for the write lock of another process
+    '''
+    def __init__(self, db_path:str, model_id:str, revision:str, commit_every:int=100, timeout:float=60):
+        self.model_id = model_id
+        self.revision = revision
+        self.commit_every = commit_every
+        # several worker processes may share the cache, so wait for locks rather than failing.
+        # The stored predictions are buffered and written in one short transaction, such that the write lock
+        # is not held across model calls and the other workers do not wait for it
+        self.conn = sqlite3.connect(db_path, timeout=timeout)
+        # write-ahead logging, such that a killed run does not corrupt the cache
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                model_id TEXT, revision TEXT, template_hash TEXT, prompt_hash TEXT, settings_hash TEXT, result TEXT,
+                                PRIMARY KEY (model_id, revision, template_hash, prompt_hash, settings_hash))""")
+        self.conn.commit()
+        self.pending = []
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def _key(self, prompt_template:str, settings:dict, prompt:str):
+        return (self.model_id, self.revision, hash_text(prompt_template), hash_text(prompt), hash_settings(settings))
+
+    def lookup(self, prompt_template:str, settings:dict, prompts:list)-> dict:
+        '''
+        Returns a dict from prompt to cached result for the prompts found in the cache
+        '''
+        template_hash = hash_text(prompt_template)
+        settings_hash = hash_settings(settings)
+        cached = {}
+        for prompt in set(prompts):
+            row = self.conn.execute("""SELECT result FROM predictions WHERE model_id=? AND revision=? AND template_hash=?
+                                       AND prompt_hash=? AND settings_hash=?""",
+                                    (self.model_id, self.revision, template_hash, hash_text(prompt), settings_hash)).fetchone()
+            if row is not None:
+                cached[prompt] = json.loads(row[0])
+        self.num_hits += sum(prompt in cached for prompt in prompts)
+        self.num_misses += sum(prompt not in cached for prompt in prompts)
+        return cached
+
+    def store(self, prompt_template:str, settings:dict, prompt:str, result:dict)-> None:
+        self.pending.append((*self._key(prompt_template, settings, prompt), json.dumps(result)))
+        if len(self.pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self)-> None:
+        if len(self.pending) > 0:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def get_stats(self)-> dict:
+        return {"hits": self.num_hits,
+                "misses": self.num_misses,
+                "hit_rate": self.num_hits/max(self.num_hits + self.num_misses, 1)}
+
+    def close(self)-> None:
+        self.commit()
+        self.conn.close()
+
+def get_model_revision(model)-> str:
+    # the commit hash is set when the model is loaded from the Hugging Face hub
+    revision = getattr(model.config, "_commit_hash", None)
+    return revision if revision is not None else "unknown"
@@ -0,0 +1,172 @@
+import heapq
+import torch
+from transformers import DynamicCache
+
+
+def to_legacy_cache(past_key_values):
+    # past_key_values can be returned either as a Cache object or as a tuple of (key, value) tuples, one per layer
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+class RadixNode:
+    def __init__(self, key=(), kv=None, parent=None):
+        # token ids on the edge leading to this node and the corresponding keys and values (one (key, value) tuple per layer)
+        self.key = key
+        self.kv = kv
+        self.parent = parent
+        self.children = {}
+        self.last_access = 0
+
+    def nbytes(self):
+        if self.kv is None:
+            return 0
+        return sum(k.numel()*k.element_size() + v.numel()*v.element_size() for k, v in self.kv)
+
+def slice_kv(kv, start, end):
+    # clone the slices so that they do not keep the memory of the full tensors alive
+    return tuple((k[:, :, start:end].clone(), v[:, :, start:end].clone()) for k, v in kv)
+
+class RadixPrefixCache:
+    '''
+    Cache of past key values for token prefixes, stored in a radix tree keyed by token ids.
+    Each node only stores the keys and values for the tokens on its edge, such that shared prefixes
+    (e.g. the few-shot examples of a prompt) are stored once. Leaves are evicted in least-recently-used
+    order when the cache exceeds its memory limit.
+    Args:
+    max_memory_mb: Maximum memory used for the cached keys and values (in MB)
+    '''
+    def __init__(self, max_memory_mb=2048):
+        self.max_bytes = int(max_memory_mb * 1024**2)
+        self.root = RadixNode()
+        self.nbytes = 0
+        self.clock = 0
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.num_hit_tokens = 0
+        self.num_lookup_tokens = 0
+
+    def _touch(self, node):
+        self.clock += 1
+        while node is not None:
+            node.last_access = self.clock
+            node = node.parent
+
+    def match(self, token_ids):
+        '''
+        Get the past key values for the longest cached prefix of token_ids.
+        Returns the length of the matched prefix and the corresponding DynamicCache (None if nothing matched).
+        '''
+        token_ids = tuple(token_ids)
+        node = self.root
+        pos = 0
+        kv_slices = []
+        while pos < len(token_ids) and token_ids[pos] in node.children:
+            child = node.children[token_ids[pos]]
+            common = 0
+            while common < len(child.key) and pos+common < len(token_ids) and child.key[common] == token_ids[pos+common]:
+                common += 1
+            kv_slices.append(child.kv if common == len(child.key) else slice_kv(child.kv, 0, common))
+            node = child
+            pos += common
+            if common < len(child.key):
+                break
+        self._touch(node)
+
+        self.num_lookups += 1
+        self.num_lookup_tokens += len(token_ids)
+        if pos == 0:
+            return 0, None
+        self.num_hits += 1
+        self.num_hit_tokens += pos
+        legacy_cache = tuple((torch.cat([kv[layer][0] for kv in kv_slices], dim=2), torch.cat([kv[layer][1] for kv in kv_slices], dim=2))
+                             for layer in range(len(kv_slices[0])))
+        return pos, DynamicCache.from_legacy_cache(legacy_cache)
+
+    def _split(self, node, ix):
+        # split the edge of node at ix, such that node keeps the first ix tokens and a new child the rest
+        child = RadixNode(node.key[ix:], slice_kv(node.kv, ix, len(node.key)), node)
+        child.children = node.children
+        for grandchild in child.children.values():
+            grandchild.parent = child
+        child.last_access = node.last_access
+        old_nbytes = node.nbytes()
+        node.key = node.key[:ix]
+        node.kv = slice_kv(node.kv, 0, ix)
+        node.children = {child.key[0]: child}
+        self.nbytes += node.nbytes() + child.nbytes() - old_nbytes
+
+    def insert(self, token_ids, past_key_values):
+        '''
+        Add the past key values for token_ids to the cache. past_key_values should cover all of token_ids.
+        '''
+        token_ids = tuple(token_ids)
+        kv = to_legacy_cache(past_key_values)
+        node = self.root
+        pos = 0
+        while pos < len(token_ids):
+            if token_ids[pos] not in node.children:
+                leaf = RadixNode(token_ids[pos:], slice_kv(kv, pos, len(token_ids)), node)
+                node.children[token_ids[pos]] = leaf
+                self.nbytes += leaf.nbytes()
+                node = leaf
+                break
+            child = node.children[token_ids[pos]]
+            common = 0
+            while common < len(child.key) and pos+common < len(token_ids) and child.key[common] == token_ids[pos+common]:
+                common += 1
+            if common < len(child.key):
+                self._split(child, common)
+            node = child
+            pos += common
+        self._touch(node)
+        self._evict()
+
+    def _merge_with_child(self, node):
+        # a node left with a single child after an eviction is merged with it, such that the edge is one node again
+        child = next(iter(node.children.values()))
+        node.key = node.key + child.key
+        node.kv = tuple((torch.cat([k, child_k], dim=2), torch.cat([v, child_v], dim=2)) for (k, v), (child_k, child_v) in zip(node.kv, child.kv))
+        node.children = child.children
+        for grandchild in node.children.values():
+            grandchild.parent = node
+        node.last_access = max(node.last_access, child.last_access)
+        child.parent = None
+
+    def _evict(self):
+        if self.nbytes <= self.max_bytes:
+            return
+        # the leaves are collected in one scan and evicted in least-recently-used order from a heap,
+        # to which the parents are added once their last child is evicted
+        heap = [(node.last_access, id(node), node) for node in self._iter_nodes() if len(node.children) == 0 and node is not self.root]
+        heapq.heapify(heap)
+        while self.nbytes > self.max_bytes and len(heap) > 0:
+            _, _, leaf = heapq.heappop(heap)
+            if leaf.parent is None or len(leaf.children) > 0:
+                # merged into its parent, or no longer a leaf
+                continue
+            parent = leaf.parent
+            del parent.children[leaf.key[0]]
+            leaf.parent = None
+            self.nbytes -= leaf.nbytes()
+            if parent is self.root:
+                continue
+            if len(parent.children) == 0:
+                heapq.heappush(heap, (parent.last_access, id(parent), parent))
+            elif len(parent.children) == 1:
+                self._merge_with_child(parent)
+                if len(parent.children) == 0:
+                    heapq.heappush(heap, (parent.last_access, id(parent), parent))
+
+    def _iter_nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def get_stats(self):
+        return {"lookups": self.num_lookups,
+                "hits": self.num_hits,
+                "hit_token_rate": self.num_hit_tokens/max(self.num_lookup_tokens, 1),
+                "memory_mb": self.nbytes/1024**2}
@@ -0,0 +1,152 @@
+import re
+
+from src.get_model_predictions.prompts import get_prompt
+
+# bump when the assembly of the input ids changes, such that stored prompts are tokenised again
+COMPILER_VERSION = 1
+PLACEHOLDER_PATTERN = re.compile("<claim>|<claimant>|<evidence>")
+# rendered with the template at compile time, to check that the assembled input ids match the full tokenisation
+PROBE_ROW = {"claim": "Probe claim, with 'quotes' and 1.5 numbers.", "claimant": "Probe Claimant", "evidence": 'Probe "evidence".\nSecond line.'}
+
+class CompiledPrompt:
+    '''
+    Prompt template compiled for one tokenizer into static segments, tokenised once, and dynamic segments holding the
+    placeholders (<claim>, <claimant> and, with evidence, <evidence>), such that only the dynamic segments are tokenised for each row
+    and the input ids are assembled by concatenation.
+    As BPE merges can cross the placeholder boundaries (e.g. a claim ending with '.' followed by '"'), each dynamic segment
+    also holds context_pre_tokens pre-tokens of the static text around its placeholders. For each row, the rendered dynamic segment
+    is tokenised together with one more pre-token of static context on each side, and its ids are only used if the context
+    is tokenised as on its own, i.e. if the full string is split at both edges of the segment in the same way as the static segments.
+    Rows for which this does not hold are tokenised in full.
+    Tokenizers for which the assembled ids of a probe row do not match the full tokenisation (e.g. without a pre-tokenizer,
+    or with a normalizer that prepends a space to each string) are not compiled, and all prompts are tokenised in full.
+    Args:
+    prompt_template: Prompt from PROMPT_DICT
+    use_evidence: Whether the <evidence> placeholder is filled in, as for get_prompt
+    context_pre_tokens: Number of pre-tokens of static text on each side of a placeholder that are tokenised with it (at least 1)
+    '''
+    def __init__(self, prompt_template:str, tokenizer, use_evidence:bool, context_pre_tokens:int=2):
+        if context_pre_tokens < 1:
+            raise ValueError(f"context_pre_tokens should be at least 1, got {context_pre_tokens}.")
+        self.prompt_template = prompt_template
+        self.tokenizer = tokenizer
+        self.use_evidence = use_evidence
+        self.context_pre_tokens = context_pre_tokens
+        self.pre_tokenizer = tokenizer.backend_tokenizer.pre_tokenizer if tokenizer.is_fast else None
+        # special tokens added in front of the prompt, e.g. the BOS token
+        self.prefix_ids = tokenizer("")["input_ids"]
+        self.num_assembled = 0
+        self.num_tokenised = 0
+        self.segments = []
+        self.is_compiled = False
+        if self.pre_tokenizer is not None:
+            self.segments = self._compile()
+            probe_prompt = get_prompt(PROBE_ROW, prompt_template, use_evidence)
+            probe_ids = self._get_assembled_ids([probe_prompt], [PROBE_ROW])[0]
+            self.is_compiled = self.num_tokenised == 0 and probe_ids == tokenizer(probe_prompt)["input_ids"]
+            self.num_assembled = 0
+            self.num_tokenised = 0
+        if not self.is_compiled:
+            print("Warning: the prompt template could not be compiled for this tokenizer, the prompts will be tokenised in full.")
+
+    def _get_pre_token_offsets(self, text:str)-> list:
+        return [offsets for _, offsets in self.pre_tokenizer.pre_tokenize_str(text)]
+
+    def _compile(self)-> list:
+        '''
+        Function to split the template into static and dynamic segments. Static segments are dicts with the 'text' and the 'input_ids',
+        dynamic segments hold the template 'text' with the placeholders and the static 'left_context' and 'right_context'
+        (with their 'left_ids' and 'right_ids') used for the boundary check.
+        '''
+        slots = [match.span() for match in PLACEHOLDER_PATTERN.finditer(self.prompt_template)
+                 if self.use_evidence or match.group() != "<evidence>"]
+        # static text between the placeholders, from the start to the end of the template
+        static_bounds = [0] + [bound for span in slots for bound in span] + [len(self.prompt_template)]
+        static_bounds = list(zip(static_bounds[0::2], static_bounds[1::2]))
+        intervals = []
+        for slot_ix, (slot_start, slot_end) in enumerate(slots):
+            # extend the placeholder to context_pre_tokens pre-tokens of the static text on both sides, and keep one more pre-token as check context
+            before_start, before_end = static_bounds[slot_ix]
+            before_offsets = self._get_pre_token_offsets(self.prompt_template[before_start:before_end])
+            left = before_start + (before_offsets[-self.context_pre_tokens][0] if len(before_offsets) > self.context_pre_tokens else 0)
+            check_left = before_start + (before_offsets[-self.context_pre_tokens-1][0] if len(before_offsets) > self.context_pre_tokens+1 else 0)
+            after_start, after_end = static_bounds[slot_ix+1]
+            after_offsets = self._get_pre_token_offsets(self.prompt_template[after_start:after_end])
+            right = after_start + (after_offsets[self.context_pre_tokens-1][1] if len(after_offsets) > self.context_pre_tokens else after_end - after_start)
+            check_right = after_start + (after_offsets[self.context_pre_tokens][1] if len(after_offsets) > self.context_pre_tokens+1 else after_end - after_start)
+            if len(intervals) > 0 and left <= intervals[-1][1]:
+                # placeholders with little static text between them share a dynamic segment
+                intervals[-1] = (intervals[-1][0], right, intervals[-1][2], check_right)
+            else:
+                intervals.append((left, right, check_left, check_right))
+
+        segments = []
+        prev_end = 0
+        for left, right, check_left, check_right in intervals:
+            segments.append({"text": self.prompt_template[prev_end:left]})
+            segments.append({"text": self.prompt_template[left:right], "dynamic": True,
+                             "left_context": self.prompt_template[check_left:left], "right_context": self.prompt_template[right:check_right]})
+            prev_end = right
+        segments.append({"text": self.prompt_template[prev_end:]})
+        segments = [segment for segment in segments if len(segment["text"]) > 0]
+        for segment in segments:
+            if segment.get("dynamic", False):
+                segment["left_ids"] = self.tokenizer(segment["left_context"], add_special_tokens=False)["input_ids"]
+                segment["right_ids"] = self.tokenizer(segment["right_context"], add_special_tokens=False)["input_ids"]
+            else:
+                segment["input_ids"] = self.tokenizer(segment["text"], add_special_tokens=False)["input_ids"]
+        return segments
+
+    def _get_segment_ids(self, segment:dict, context_ids:list)-> list:
+        '''
+        Function to get the ids of a dynamic segment from the ids of the segment tokenised with its static context,
+        None if the context is not tokenised as on its own (BPE merges across the edges of the segment)
+        '''
+        num_left, num_right = len(segment["left_ids"]), len(segment["right_ids"])
+        if context_ids[:num_left] != segment["left_ids"] or context_ids[len(context_ids)-num_right:] != segment["right_ids"]:
+            return None
+        return context_ids[num_left:len(context_ids)-num_right]
+
+    def _get_assembled_ids(self, prompts:list, rows:list)-> list:
+        # the dynamic segments of all rows are tokenised together with their static context, one batch per segment
+        context_ids = {}
+        for segment_ix, segment in enumerate(self.segments):
+            if segment.get("dynamic", False):
+                texts = [segment["left_context"] + get_prompt(row, segment["text"], self.use_evidence) + segment["right_context"] for row in rows]
+                context_ids[segment_ix] = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+        input_ids = []
+        fallback_ixs = []
+        for row_ix in range(len(rows)):
+            row_ids = list(self.prefix_ids)
+            for segment_ix, segment in enumerate(self.segments):
+                segment_ids = segment["input_ids"] if not segment.get("dynamic", False) else self._get_segment_ids(segment, context_ids[segment_ix][row_ix])
+                if segment_ids is None:
+                    row_ids = None
+                    break
+                row_ids.extend(segment_ids)
+            if row_ids is None:
+                fallback_ixs.append(row_ix)
+            input_ids.append(row_ids)
+        if len(fallback_ixs) > 0:
+            # rows with BPE merges across the edges of a dynamic segment are tokenised in full
+            for row_ix, row_ids in zip(fallback_ixs, self.tokenizer([prompts[row_ix] for row_ix in fallback_ixs])["input_ids"]):
+                input_ids[row_ix] = row_ids
+        self.num_assembled += len(rows) - len(fallback_ixs)
+        self.num_tokenised += len(fallback_ixs)
+        return input_ids
+
+    def get_input_ids(self, prompts:list, rows:list)-> list:
+        '''
+        Function to get the input ids of the prompts rendered from rows with get_prompt
+        Args:
+        prompts: The rendered prompts, tokenised in full for rows for which the ids cannot be assembled
+        rows: Dicts (or pandas rows) with the 'claim', 'claimant' and 'evidence' fields
+        '''
+        if not self.is_compiled:
+            self.num_tokenised += len(prompts)
+            return self.tokenizer(prompts)["input_ids"]
+        return self._get_assembled_ids(prompts, rows)
+
+    def get_stats(self)-> dict:
+        return {"assembled": self.num_assembled, "tokenised_in_full": self.num_tokenised}
@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from datasets import Dataset
+
+from src.get_model_predictions.prompts import PROMPT_DICT, get_prompt
+from src.get_model_predictions.prompt_compiler import CompiledPrompt, COMPILER_VERSION
+from src.get_model_predictions.prediction_cache import hash_text
+
+try:
+    from torch.utils.data import Dataset as TorchDataset
+except ImportError:
+    TorchDataset = object
+
+PROMPT_FIELDS = ["claim", "claimant", "evidence"]
+
+def get_tokenizer_hash(tokenizer)-> str:
+    # models with the same tokenizer (e.g. the Pythia models) get the same hash and share the stored prompts
+    if tokenizer.is_fast:
+        serialized = tokenizer.backend_tokenizer.to_str()
+    else:
+        serialized = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    serialized += json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+
+def get_data_hash(data:pd.DataFrame, use_evidence:bool)-> str:
+    fields = [field for field in PROMPT_FIELDS if field in data.columns and (use_evidence or field != "evidence")]
+    row_hashes = pd.util.hash_pandas_object(data[fields], index=True).values
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()[:16]
+
+def get_prompt_dataset(data:pd.DataFrame, tokenizer, prompt_name:str, use_evidence:bool, store_folder:str=None)-> Dataset:
+    '''
+    Function to render and tokenise the prompts for all samples in data, with batched Dataset.map calls using the fast tokenizer.
+    The prompt template is compiled for the tokenizer (see prompt_compiler.py), such that only the claims and evidence are tokenised.
+    Returns a Dataset with the columns 'id', 'prompt', 'input_ids' and 'num_tokens'.
+    Args:
+    store_folder: Folder in which the tokenised prompts are stored as Arrow files, keyed by tokenizer hash, prompt name, template hash
+                  (with the compiler version) and data hash.
+                  Stored prompts are loaded (memory-mapped) instead of tokenised again. Nothing is stored if None.
+    '''
+    prompt_template = PROMPT_DICT[prompt_name]
+    if store_folder is not None:
+        # prompts stored for an earlier version of the template or of the compiler are not used
+        template_key = f"{hash_text(prompt_template)[:16]}-v{COMPILER_VERSION}"
+        store_path = os.path.join(store_folder, get_tokenizer_hash(tokenizer), prompt_name, template_key, get_data_hash(data, use_evidence))
+        if os.path.exists(store_path):
+            print(f"Loading tokenised prompts from '{store_path}'.")
+            return Dataset.load_from_disk(store_path)
+
+    compiled_prompt = CompiledPrompt(prompt_template, tokenizer, use_evidence)
+    fields = [field for field in PROMPT_FIELDS if field in data.columns]
+    dataset = Dataset.from_pandas(data[fields])
+
+    def render_and_tokenise(batch):
+        rows = [dict(zip(fields, values)) for values in zip(*[batch[field] for field in fields])]
+        prompts = [get_prompt(row, prompt_template, use_evidence) for row in rows]
+        input_ids = compiled_prompt.get_input_ids(prompts, rows)
+        return {"prompt": prompts, "input_ids": input_ids, "num_tokens": [len(ids) for ids in input_ids]}
+
+    dataset = dataset.map(render_and_tokenise, batched=True, batch_size=1000, remove_columns=fields)
+    print(f"Compiled prompt statistics: {compiled_prompt.get_stats()}")
+    if store_folder is not None:
+        dataset.save_to_disk(store_path)
+        print(f"Saved tokenised prompts to '{store_path}'.")
+    return dataset
+
+class PromptIdsDataset(TorchDataset):
+    '''
+    Pipeline input yielding the prompts together with their input ids, such that the pipeline does not tokenise them again
+    '''
+    def __init__(self, dataset:Dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        sample = self.dataset[i]
+        return {"prompt": sample["prompt"], "input_ids": sample["input_ids"]}
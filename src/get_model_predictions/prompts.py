@@ -459,4 +459,13 @@ PROMPT_DICT = {"pythia_claim_prompt_0_shot": PYTHIA_CLAIM_PROMPT_0_SHOT,
                "pythia_evidence_prompt_3_shot_alt_5": PYTHIA_EVIDENCE_PROMPT_3_SHOT_ALT_5,
                "pythia_evidence_prompt_3_shot_alt_6": PYTHIA_EVIDENCE_PROMPT_3_SHOT_ALT_6,
                "pythia_evidence_prompt_3_shot_alt_7": PYTHIA_EVIDENCE_PROMPT_3_SHOT_ALT_7,
-               "pythia_evidence_prompt_3_shot_alt_7_no_claimant": PYTHIA_EVIDENCE_PROMPT_3_SHOT_ALT_7_NO_CLAIMANT}
\ No newline at end of file
+               "pythia_evidence_prompt_3_shot_alt_7_no_claimant": PYTHIA_EVIDENCE_PROMPT_3_SHOT_ALT_7_NO_CLAIMANT}
+
+def get_prompt(row, prompt_template, use_evidence):
+    prompt = prompt_template.replace("<claim>", row['claim'])
+    if "<claimant>" in prompt:
+        prompt = prompt.replace("<claimant>", row['claimant'])
+        
+    if use_evidence:
+        prompt = prompt.replace("<evidence>", row['evidence'])
+    return prompt
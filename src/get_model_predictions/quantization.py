@@ -0,0 +1,158 @@
+import json
+import argparse
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANTIZATIONS = ["fp32", "bf16", "int8_dynamic", "int8_weight", "int4_weight", "bnb_4bit"]
+DRIFT_COLUMNS = ["p_True", "p_False", "p_None"]
+
+def get_bnb_config():
+    # bitsandbytes 4-bit quantisation needs a GPU, the config is only built when it is selected
+    from transformers import BitsAndBytesConfig
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+    )
+
+class WeightOnlyQuantLinear(nn.Module):
+    '''
+    Linear layer with weights stored as int8 or packed int4 values with one scale per group of input features.
+    The weights are dequantised in the forward pass, such that only the memory of the weights is reduced
+    while the activations stay in the original precision.
+    Args:
+    linear: Linear layer to quantise
+    bits: 8 or 4
+    group_size: Number of input features sharing a scale, one scale per output feature if None
+    '''
+    def __init__(self, linear:nn.Linear, bits:int=8, group_size:int=None):
+        super().__init__()
+        if bits not in [4, 8]:
+            raise ValueError(f"Can only quantise weights to 8 or 4 bits, got {bits}.")
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.bits = bits
+        if group_size is None or self.in_features % group_size != 0:
+            group_size = self.in_features
+        self.group_size = group_size
+
+        weight = linear.weight.detach().float().reshape(self.out_features, -1, group_size)
+        qmax = 2**(bits-1) - 1
+        scales = weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+        qweight = torch.round(weight / scales).clamp(-qmax-1, qmax).to(torch.int8).reshape(self.out_features, self.in_features)
+        if bits == 4:
+            if self.in_features % 2 != 0:
+                raise ValueError(f"Can only pack int4 weights with an even number of input features, got {self.in_features}.")
+            # two 4-bit values per byte, shifted to the unsigned range [0, 15]
+            unsigned = (qweight + 8).to(torch.uint8)
+            qweight = unsigned[:, 0::2] | (unsigned[:, 1::2] << 4)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scales", scales.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def dequantize(self)-> torch.Tensor:
+        qweight = self.qweight
+        if self.bits == 4:
+            qweight = torch.stack([qweight & 0x0F, qweight >> 4], dim=-1).reshape(self.out_features, self.in_features).to(torch.int8) - 8
+        weight = qweight.reshape(self.out_features, -1, self.group_size).to(self.scales.dtype) * self.scales
+        return weight.reshape(self.out_features, self.in_features)
+
+    def forward(self, x):
+        return F.linear(x, self.dequantize().to(x.dtype), self.bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+def get_quantizable_linear_names(model)-> list:
+    # the output embeddings (LM head) are kept in full precision, as the tracked token probabilities are computed from them
+    output_embeddings = model.get_output_embeddings()
+    return [name for name, module in model.named_modules() if isinstance(module, nn.Linear) and module is not output_embeddings]
+
+def quantize_model(model, quantization:str, group_size:int=128):
+    '''
+    Function to quantise the linear layers of a loaded causal LM for CPU inference
+    Args:
+    quantization: 'fp32' (no quantisation), 'bf16', 'int8_dynamic' (int8 weights and dynamically quantised int8 activations),
+                  'int8_weight' or 'int4_weight' (weight-only quantisation)
+    group_size: Number of input features sharing a scale for 'int4_weight'. 'int8_weight' uses one scale per output feature.
+    '''
+    if quantization == "fp32":
+        return model
+    if quantization == "bf16":
+        return model.to(torch.bfloat16)
+    linear_names = get_quantizable_linear_names(model)
+    if quantization == "int8_dynamic":
+        qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in linear_names}
+        # in place, as a copy of the fp32 model would double the memory needed to load it
+        return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    if quantization in ["int8_weight", "int4_weight"]:
+        bits = 8 if quantization == "int8_weight" else 4
+        for name in linear_names:
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name)
+            setattr(parent, child_name, WeightOnlyQuantLinear(getattr(parent, child_name), bits, group_size if bits == 4 else None))
+        return model
+    raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}.")
+
+def get_model_size_mb(model)-> float:
+    num_bytes = 0
+    for value in model.state_dict().values():
+        # dynamically quantised linear layers store their packed weight and bias as a tuple
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(tensor, torch.Tensor):
+                num_bytes += tensor.numel()*tensor.element_size()
+    return num_bytes/1024**2
+
+def get_drift_report(reference:pd.DataFrame, quantized:pd.DataFrame, columns:list=DRIFT_COLUMNS)-> dict:
+    '''
+    Function to compare the token probabilities of a quantised run against the fp32 run on the same samples
+    Args:
+    reference: Predictions of the fp32 run, indexed by id
+    quantized: Predictions of the quantised run, indexed by id
+    Returns the absolute differences and correlations per probability column and the agreement of the predictions
+    '''
+    common_ids = reference.index.intersection(quantized.index)
+    if len(common_ids) == 0:
+        raise ValueError("The reference and quantised predictions have no samples in common.")
+    reference = reference.loc[common_ids]
+    quantized = quantized.loc[common_ids]
+    report = {"num_samples": len(common_ids), "columns": {}}
+    for col in columns:
+        if col not in reference.columns or col not in quantized.columns:
+            print(f"Warning: column {col} is missing, will not be compared.")
+            continue
+        abs_diff = (reference[col] - quantized[col]).abs()
+        report["columns"][col] = {"mean_abs_diff": float(abs_diff.mean()),
+                                  "p95_abs_diff": float(abs_diff.quantile(0.95)),
+                                  "max_abs_diff": float(abs_diff.max()),
+                                  "pearson": float(reference[col].corr(quantized[col])),
+                                  "spearman": float(reference[col].rank().corr(quantized[col].rank()))}
+    compared_columns = list(report["columns"].keys())
+    if len(compared_columns) > 1:
+        # agreement of the most probable label among the compared columns
+        report["argmax_agreement"] = float((reference[compared_columns].values.argmax(axis=1) == quantized[compared_columns].values.argmax(axis=1)).mean())
+    pred_cols = [col for col in reference.columns if col.startswith("prediction_") and col in quantized.columns]
+    for col in pred_cols:
+        report[f"{col}_agreement"] = float((reference[col].fillna("") == quantized[col].fillna("")).mean())
+    return report
+
+def load_predictions(file_path:str)-> pd.DataFrame:
+    sep = "\t" if file_path.endswith(".tsv") else ","
+    return pd.read_csv(file_path, sep=sep, keep_default_na=False, na_values=[" ", ""]).set_index("id")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report the drift of the token probabilities of a quantised run against the fp32 run.")
+    parser.add_argument("--reference_file", type=str, required=True, help="Path to the predictions of the fp32 run")
+    parser.add_argument("--quantized_file", type=str, required=True, help="Path to the predictions of the quantised run")
+    parser.add_argument("--columns", type=str, nargs="+", default=DRIFT_COLUMNS, help="Probability columns to compare")
+    parser.add_argument("--output_file", type=str, default=None, help="Path to save the report to as json")
+
+    args = parser.parse_args()
+    report = get_drift_report(load_predictions(args.reference_file), load_predictions(args.quantized_file), args.columns)
+    print(json.dumps(report, indent=2))
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved drift report to '{args.output_file}'.")
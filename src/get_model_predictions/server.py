@@ -0,0 +1,296 @@
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from src.get_model_predictions.get_model_predictions import (enforce_reproducibility, load_model_and_tokenizer, get_eos_token_ids,
+                                                             get_logit_ixs, get_label_token_ids)
+from src.get_model_predictions.prompts import PROMPT_DICT, get_prompt
+from src.get_model_predictions.prompt_compiler import CompiledPrompt
+from src.get_model_predictions.utils import LabelTrie
+from src.get_model_predictions.prefix_cache import to_legacy_cache
+from src.get_model_predictions.quantization import QUANTIZATIONS
+
+class Sequence:
+    def __init__(self, input_ids:list, future:asyncio.Future):
+        self.input_ids = input_ids
+        self.future = future
+        # keys and values of the prompt and the generated tokens apart from the last one, one (key, value) tuple per layer
+        self.kv = None
+        self.generated = []
+        self.first_step_logits = None
+        self.done = False
+        self.start_time = time.perf_counter()
+
+class ContinuousBatchScheduler:
+    '''
+    Scheduler that decodes the running sequences one token at a time in a shared batch, and admits queued requests
+    after every step, such that new requests do not wait for the whole batch to finish.
+    Newly admitted sequences are prefilled together, left padded to the longest prompt, and then join the decoding batch.
+    Each sequence keeps its own past key values, which are left padded to a common length for the batched decoding steps.
+    Args:
+    mode: 'generate', 'constrained' (only generate the labels) or 'score' (only the first-token probabilities)
+    max_batch_size: Maximum number of sequences decoded together
+    max_new_tokens: Maximum number of generated tokens per sequence
+    '''
+    def __init__(self, model, tokenizer, mode:str="generate", max_batch_size:int=8, max_new_tokens:int=10):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.mode = mode
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = set(get_eos_token_ids(tokenizer))
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else (tokenizer.eos_token_id or 0)
+        self.logit_ixs = get_logit_ixs(tokenizer)
+        self.trie = LabelTrie(get_label_token_ids(tokenizer)) if mode == "constrained" else None
+        self.queue = asyncio.Queue()
+        self.active = []
+        # the model runs in a separate thread, such that the server keeps accepting requests during a step
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # the prompts are tokenised and the results decoded in another single thread, such that the tokenizer
+        # is only used from one thread and the event loop keeps accepting requests
+        self.tokenizer_executor = ThreadPoolExecutor(max_workers=1)
+        self.num_requests = 0
+        self.num_done = 0
+        self.num_steps = 0
+        self.batch_sizes = Counter()
+        self.prefill_batch_sizes = Counter()
+        self.total_latency = 0.
+
+    async def submit(self, input_ids:list)-> dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.num_requests += 1
+        await self.queue.put(Sequence(input_ids, future))
+        seq = await future
+        return await loop.run_in_executor(self.tokenizer_executor, self.get_result, seq)
+
+    async def run(self)-> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            admitted = []
+            if len(self.active) == 0:
+                admitted.append(await self.queue.get())
+            while len(self.active) + len(admitted) < self.max_batch_size and not self.queue.empty():
+                admitted.append(self.queue.get_nowait())
+            try:
+                finished = await loop.run_in_executor(self.executor, self.step, admitted)
+            except Exception as e:
+                for seq in self.active + admitted:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+                self.active = []
+                continue
+            for seq in finished:
+                self.num_done += 1
+                self.total_latency += time.perf_counter() - seq.start_time
+                if not seq.future.done():
+                    seq.future.set_result(seq)
+
+    def _forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None):
+        # only the hidden state of the last position is projected to the vocabulary
+        outputs = self.model.base_model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                        past_key_values=past_key_values, use_cache=True)
+        logits = self.model.get_output_embeddings()(outputs[0][:, -1]).float()
+        return logits, to_legacy_cache(outputs.past_key_values)
+
+    def _prefill(self, seqs:list):
+        lengths = [len(seq.input_ids) for seq in seqs]
+        max_len = max(lengths)
+        # left padded, such that the last position of each row is the last prompt token
+        input_ids = torch.full((len(seqs), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(seqs), max_len), dtype=torch.long)
+        for row, (seq, length) in enumerate(zip(seqs, lengths)):
+            input_ids[row, max_len-length:] = torch.tensor(seq.input_ids)
+            attention_mask[row, max_len-length:] = 1
+        # the positions of each prompt start at 0 after its padding, as in generate
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        logits, kv = self._forward(input_ids.to(self.model.device), attention_mask.to(self.model.device), position_ids.to(self.model.device))
+        # the padding is removed from the past key values of each sequence, and added back as needed in the decoding steps
+        for row, (seq, length) in enumerate(zip(seqs, lengths)):
+            seq.kv = tuple((k[row:row+1, :, max_len-length:], v[row:row+1, :, max_len-length:]) for k, v in kv)
+        return logits
+
+    def _decode(self, seqs:list):
+        lengths = [seq.kv[0][0].shape[2] for seq in seqs]
+        max_len = max(lengths)
+        # left pad the past key values of the sequences to the same length and mask the padding
+        legacy_cache = tuple((torch.cat([F.pad(seq.kv[layer][0], (0, 0, max_len-length, 0)) for seq, length in zip(seqs, lengths)]),
+                              torch.cat([F.pad(seq.kv[layer][1], (0, 0, max_len-length, 0)) for seq, length in zip(seqs, lengths)]))
+                             for layer in range(len(seqs[0].kv)))
+        attention_mask = torch.zeros((len(seqs), max_len+1), dtype=torch.long, device=self.model.device)
+        for row, length in enumerate(lengths):
+            attention_mask[row, max_len-length:] = 1
+        input_ids = torch.tensor([[seq.generated[-1]] for seq in seqs], device=self.model.device)
+        position_ids = torch.tensor(lengths, device=self.model.device).unsqueeze(1)
+        logits, kv = self._forward(input_ids, attention_mask, position_ids, DynamicCache.from_legacy_cache(legacy_cache))
+        for row, (seq, length) in enumerate(zip(seqs, lengths)):
+            seq.kv = tuple((k[row:row+1, :, max_len-length:], v[row:row+1, :, max_len-length:]) for k, v in kv)
+        return logits
+
+    def _add_token(self, seq:Sequence, logits:torch.Tensor)-> None:
+        if seq.first_step_logits is None:
+            # log-softmax normaliser followed by the logits of the tracked tokens, as recorded by the pipeline
+            seq.first_step_logits = torch.cat([torch.logsumexp(logits, dim=-1, keepdim=True), logits[list(self.logit_ixs.values())]])
+            if self.mode == "score":
+                seq.done = True
+                return
+        if self.trie is not None:
+            allowed = list(self.trie.get_node(seq.generated)["children"].keys())
+            mask = torch.ones_like(logits, dtype=torch.bool)
+            mask[allowed] = False
+            logits = logits.masked_fill(mask, -float("inf"))
+        token_id = logits.argmax().item()
+        seq.generated.append(token_id)
+        if self.trie is not None:
+            seq.done = self.trie.get_node(seq.generated)["is_label"]
+        else:
+            seq.done = token_id in self.eos_token_ids
+        seq.done = seq.done or len(seq.generated) >= self.max_new_tokens
+
+    @torch.no_grad()
+    def step(self, admitted:list)-> list:
+        '''
+        Decodes one token for the running sequences and prefills the newly admitted ones in one batch. Returns the finished sequences.
+        '''
+        if len(self.active) > 0:
+            logits = self._decode(self.active)
+            for seq, seq_logits in zip(self.active, logits):
+                self._add_token(seq, seq_logits)
+        if len(admitted) > 0:
+            logits = self._prefill(admitted)
+            for seq, seq_logits in zip(admitted, logits):
+                self._add_token(seq, seq_logits)
+            self.prefill_batch_sizes[len(admitted)] += 1
+        self.num_steps += 1
+        self.batch_sizes[len(self.active) + len(admitted)] += 1
+        self.active = self.active + admitted
+        finished = [seq for seq in self.active if seq.done]
+        self.active = [seq for seq in self.active if not seq.done]
+        for seq in finished:
+            seq.kv = None
+        return finished
+
+    def get_result(self, seq:Sequence)-> dict:
+        probs = (seq.first_step_logits[1:] - seq.first_step_logits[0]).exp()
+        if self.mode == "score":
+            # the prediction is the label with the highest probability, " True" and "True" both map to "True"
+            pred = list(self.logit_ixs.keys())[probs.argmax().item()].strip()
+        else:
+            pred = self.tokenizer.decode(seq.generated, skip_special_tokens=True).strip()
+        return {"prediction": pred, "probs": dict(zip(self.logit_ixs.keys(), probs.tolist()))}
+
+    def get_metrics(self)-> dict:
+        num_steps = max(self.num_steps, 1)
+        return {"queue_depth": self.queue.qsize(),
+                "active_sequences": len(self.active),
+                "requests": self.num_requests,
+                "requests_done": self.num_done,
+                "steps": self.num_steps,
+                "mean_batch_size": sum(size*count for size, count in self.batch_sizes.items())/num_steps,
+                "batch_size_counts": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "prefill_batch_size_counts": {str(size): count for size, count in sorted(self.prefill_batch_sizes.items())},
+                "mean_latency_ms": 1000*self.total_latency/max(self.num_done, 1)}
+
+class ScoringServer:
+    '''
+    Minimal HTTP server for veracity predictions. POST /predict takes a json object with 'claim', 'claimant', 'evidence'
+    and 'prompt_name' (evidence is only needed for evidence prompts) and returns the prediction and the tracked token probabilities.
+    GET /metrics returns the queue depth and batch size metrics of the scheduler.
+    '''
+    def __init__(self, scheduler:ContinuousBatchScheduler, tokenizer):
+        self.scheduler = scheduler
+        self.tokenizer = tokenizer
+        # prompt templates are compiled for the tokenizer on first use, such that only the request fields are tokenised
+        self.compiled_prompts = {}
+
+    def get_input_ids(self, request:dict, prompt_name:str, use_evidence:bool)-> list:
+        prompt_template = PROMPT_DICT[prompt_name]
+        if prompt_name not in self.compiled_prompts:
+            self.compiled_prompts[prompt_name] = CompiledPrompt(prompt_template, self.tokenizer, use_evidence)
+        prompt = get_prompt(request, prompt_template, use_evidence)
+        return self.compiled_prompts[prompt_name].get_input_ids([prompt], [request])[0]
+
+    async def predict(self, request:dict)-> dict:
+        prompt_name = request.get("prompt_name")
+        if prompt_name not in PROMPT_DICT:
+            raise ValueError(f"Unknown prompt_name '{prompt_name}'.")
+        prompt_template = PROMPT_DICT[prompt_name]
+        use_evidence = "<evidence>" in prompt_template
+        required_fields = ["claim"] + (["claimant"] if "<claimant>" in prompt_template else []) + (["evidence"] if use_evidence else [])
+        missing_fields = [field for field in required_fields if not isinstance(request.get(field), str)]
+        if len(missing_fields) > 0:
+            raise ValueError(f"Missing fields {missing_fields} for prompt '{prompt_name}'.")
+        input_ids = await asyncio.get_running_loop().run_in_executor(self.scheduler.tokenizer_executor, self.get_input_ids, request, prompt_name, use_evidence)
+        result = await self.scheduler.submit(input_ids)
+        return {"prompt_name": prompt_name, **result}
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter)-> None:
+        try:
+            request_line = (await reader.readline()).decode()
+            if not request_line:
+                return
+            method, path = request_line.split(" ")[:2]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode()
+                if line in ["\r\n", "\n", ""]:
+                    break
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/metrics":
+                status, payload = 200, self.scheduler.get_metrics()
+            elif method == "GET" and path == "/health":
+                status, payload = 200, {"status": "ok"}
+            elif method == "POST" and path == "/predict":
+                try:
+                    status, payload = 200, await self.predict(json.loads(body))
+                except (ValueError, AttributeError) as e:
+                    status, payload = 400, {"error": str(e)}
+            else:
+                status, payload = 404, {"error": f"Unknown endpoint {method} {path}."}
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+        response = json.dumps(payload).encode()
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(response)}\r\nConnection: close\r\n\r\n".encode() + response)
+        await writer.drain()
+        writer.close()
+
+async def serve(model, tokenizer, host:str, port:int, mode:str="generate", max_batch_size:int=8)-> None:
+    scheduler = ContinuousBatchScheduler(model, tokenizer, mode, max_batch_size)
+    server = ScoringServer(scheduler, tokenizer)
+    http_server = await asyncio.start_server(server.handle, host, port)
+    scheduler_task = asyncio.create_task(scheduler.run())
+    print(f"Serving predictions on http://{host}:{port} (POST /predict, GET /metrics).")
+    async with http_server:
+        await http_server.serve_forever()
+    scheduler_task.cancel()
+
+if __name__ == '__main__':
+    enforce_reproducibility()
+    parser = argparse.ArgumentParser(description="Serve veracity predictions of a loaded model over HTTP, with continuous batching.")
+    parser.add_argument("--model_name", type=str, required=True, help="Path to Huggingface model")
+    parser.add_argument("--cache_folder", type=str, default=None, help="Path to cache folder")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--mode", type=str, default="generate", choices=['generate','score','constrained'], help="'generate' to generate the answer, 'score' to only run one forward pass per prompt and predict the tracked label token with the highest probability, 'constrained' to only generate the labels and stop once a full label is generated.")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum number of sequences decoded together")
+    parser.add_argument("--quantization", type=str, default="fp32", choices=QUANTIZATIONS, help="Quantisation of the model. Not quantised by default.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of torch threads, the torch default if not set")
+
+    args = parser.parse_args()
+    print(args)
+    print()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    model, tokenizer = load_model_and_tokenizer(args.model_name, args.cache_folder, args.quantization)
+    model.eval()
+    asyncio.run(serve(model, tokenizer, args.host, args.port, args.mode, args.max_batch_size))
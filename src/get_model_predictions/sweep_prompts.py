@@ -0,0 +1,111 @@
+import os
+import argparse
+from fnmatch import fnmatch
+
+from src.get_model_predictions.get_model_predictions import (enforce_reproducibility, load_model_and_tokenizer, load_data,
+                                                             run_predictions, get_predictions_filename, get_model_id)
+from src.get_model_predictions.utils import TextWithLogitsGenerationPipeline
+from src.get_model_predictions.prompts import PROMPT_DICT
+from src.get_model_predictions.prefix_cache import RadixPrefixCache
+from src.get_model_predictions.journal import PredictionJournal, get_journal_path
+from src.get_model_predictions.prediction_cache import PredictionCache, get_model_revision
+from src.get_model_predictions.quantization import QUANTIZATIONS
+from src.get_model_predictions.batch_scheduler import TokenBudgetScheduler, get_budget_key
+from src.model_worker import submit_job
+
+def expand_prompt_names(prompt_names:list)-> list:
+    '''
+    Function to expand a list of prompt names and glob patterns (e.g. 'pythia_evidence_prompt_3_shot_alt_*') to PROMPT_DICT keys
+    '''
+    expanded_names = []
+    for pattern in prompt_names:
+        matches = [name for name in PROMPT_DICT.keys() if fnmatch(name, pattern)]
+        if len(matches) == 0:
+            raise ValueError(f"No prompt in PROMPT_DICT matches '{pattern}'.")
+        expanded_names.extend([name for name in matches if name not in expanded_names])
+    return expanded_names
+
+def sweep_prompts(file_path:str, save_folder:str, model_code:str, prompt_names:list, use_evidence:list, cache_folder:str, prefix_cache_mb:int=None, mode:str="generate", batch_size:int=1, prediction_cache_path:str=None, prompt_store_folder:str=None, quantization:str="fp32", max_batch_tokens:int=None, budget_file:str=None, model=None, tokenizer=None)-> None:
+    '''
+    Function to collect predictions for several prompts with one model load
+    Args:
+    prompt_names: Prompt names or glob patterns matching keys in PROMPT_DICT
+    use_evidence: Evidence conditions to run ('yes' and/or 'no'). Evidence prompts are run for 'yes' and claim prompts for 'no'.
+    model, tokenizer: Already loaded model and tokenizer of model_code (e.g. in a model worker, see src/model_worker.py), loaded if None
+    '''
+    if prefix_cache_mb and (batch_size > 1 or max_batch_tokens):
+        raise ValueError("The prefix cache can only be used with a batch size of 1.")
+    jobs = []
+    for prompt_name in expand_prompt_names(prompt_names):
+        prompt_use_evidence = "<evidence>" in PROMPT_DICT[prompt_name]
+        if ("yes" if prompt_use_evidence else "no") in use_evidence:
+            jobs.append((prompt_name, prompt_use_evidence))
+    if len(jobs) == 0:
+        raise ValueError(f"None of the prompts {prompt_names} match the evidence conditions {use_evidence}.")
+    print(f"Will collect predictions for {len(jobs)} prompts: {[prompt_name for prompt_name, _ in jobs]}")
+    print()
+
+    if model is None:
+        model, tokenizer = load_model_and_tokenizer(model_code, cache_folder, quantization)
+    data = load_data(file_path)
+    prediction_cache = PredictionCache(prediction_cache_path, get_model_id(model_code, quantization), get_model_revision(model)) if prediction_cache_path else None
+    # the prefix cache is shared between the prompts, as they often start with the same instructions and few-shot examples
+    prefix_cache = RadixPrefixCache(prefix_cache_mb) if prefix_cache_mb else None
+    pipe = TextWithLogitsGenerationPipeline(model=model, tokenizer=tokenizer, prefix_cache=prefix_cache)
+    # the token budget is shared between the prompts, such that a budget lowered for one prompt is kept for the next ones
+    batch_scheduler = TokenBudgetScheduler(max_batch_tokens, budget_file, get_budget_key(get_model_id(model_code, quantization), model.device, mode)) if max_batch_tokens else None
+
+    for prompt_name, prompt_use_evidence in jobs:
+        print(f"Collecting predictions for prompt '{prompt_name}'...")
+        filename = get_predictions_filename(model_code, prompt_use_evidence, prompt_name, quantization)
+        journal_path = get_journal_path(os.path.join(save_folder, filename))
+        preds = run_predictions(data, pipe, prompt_name, prompt_use_evidence, mode=mode, batch_size=batch_size, journal_path=journal_path, prediction_cache=prediction_cache, prompt_store_folder=prompt_store_folder, batch_scheduler=batch_scheduler)
+        preds.to_csv(os.path.join(save_folder, filename), sep='\t')
+        PredictionJournal(journal_path).remove()
+        print(f"Saved predictions to '{os.path.join(save_folder, filename)}'.")
+        print()
+    if prediction_cache is not None:
+        prediction_cache.close()
+
+if __name__ == '__main__':
+    enforce_reproducibility()
+    parser = argparse.ArgumentParser(description="Collect model predictions for several prompts with one model load.")
+    parser.add_argument("--data_file", type=str, help="Path to the data file")
+    parser.add_argument("--save_folder", type=str, help="Path to folder to save results to")
+    parser.add_argument("--use_evidence", type=str, nargs="+", default=['yes','no'], choices=['yes','no'], help="Evidence conditions to run. Evidence prompts are used with evidence and claim prompts without.")
+    parser.add_argument("--model_name", type=str, default="no", help="Path to Huggingface model")
+    parser.add_argument("--prompt_names", type=str, nargs="+", required=True, help="Prompts to use for the evaluation, glob patterns such as 'pythia_evidence_prompt_3_shot_alt_*' are allowed.")
+    parser.add_argument("--cache_folder", type=str, default=None, help="Path to cache folder")
+    parser.add_argument("--prefix_cache_mb", type=int, default=None, help="Reuse the past key values of shared prompt prefixes (e.g. few-shot examples), with a memory limit in MB. Disabled by default.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of prompts per batch. Prompts are sorted by length to reduce padding.")
+    parser.add_argument("--max_batch_tokens", type=int, default=None, help="Form batches under a budget of prompt and generated tokens instead of using --batch_size. The budget is lowered when a batch runs out of memory.")
+    parser.add_argument("--budget_file", type=str, default=None, help="Path to a json file recording the token budgets that fit in memory per model, device and mode, used as the starting budget of later runs.")
+    parser.add_argument("--prediction_cache", type=str, default=None, help="Path to a SQLite database caching predictions across runs and datasets. Disabled by default.")
+    parser.add_argument("--prompt_store", type=str, default=None, help="Path to a folder storing the tokenised prompts, shared between runs and models with the same tokenizer. Disabled by default.")
+    parser.add_argument("--quantization", type=str, default="fp32", choices=QUANTIZATIONS, help="Quantisation of the model. 'int8_dynamic', 'int8_weight', 'int4_weight' and 'bf16' run on CPUs, 'bnb_4bit' needs a GPU. Not quantised by default.")
+    parser.add_argument("--mode", type=str, default="generate", choices=['generate','score','constrained'], help="'generate' to generate the answer, 'score' to only run one forward pass per prompt and predict the tracked label token with the highest probability, 'constrained' to only generate the labels and stop once a full label is generated.")
+    parser.add_argument("--worker", type=str, default=None, help="Path to the Unix socket of a model worker (src/model_worker.py) with the model already loaded, to run the predictions on instead of loading the model.")
+
+    args = parser.parse_args()
+    os.makedirs(args.save_folder, exist_ok=True)
+    print(args)
+    print()
+
+    job_kwargs = dict(file_path=args.data_file,
+                      save_folder=args.save_folder,
+                      model_code=args.model_name,
+                      prompt_names=args.prompt_names,
+                      use_evidence=args.use_evidence,
+                      cache_folder=args.cache_folder,
+                      prefix_cache_mb=args.prefix_cache_mb,
+                      mode=args.mode,
+                      batch_size=args.batch_size,
+                      prediction_cache_path=args.prediction_cache,
+                      prompt_store_folder=args.prompt_store,
+                      quantization=args.quantization,
+                      max_batch_tokens=args.max_batch_tokens,
+                      budget_file=args.budget_file)
+    if args.worker is not None:
+        submit_job(args.worker, "sweep", **job_kwargs)
+    else:
+        sweep_prompts(**job_kwargs)
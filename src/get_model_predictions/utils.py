@@ -1,10 +1,14 @@
 from transformers.pipelines.text_generation import TextGenerationPipeline, ReturnType
 from transformers.utils import is_tf_available, is_torch_available
 
+from src.get_model_predictions.prefix_cache import to_legacy_cache
+
 
 if is_torch_available():
+    import torch
     from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
     from transformers.pipelines.pt_utils import KeyDataset
+    from transformers import DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
 
 if is_tf_available():
     import tensorflow as tf
@@ -12,6 +16,100 @@ if is_tf_available():
     from transformers.models.auto.modeling_tf_auto import TF_MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
 
 
+class RestrictedLogitsRecorder(LogitsProcessor):
+    """
+    Logits processor that records the log-softmax normaliser and the logits of a fixed set of token ids (and optionally the top-k logits)
+    for each generation step, instead of keeping the full-vocabulary logits. The scores are returned unchanged.
+    The recorded logits are the scores as passed to the processor, which are the raw logits for greedy decoding without penalties.
+
+    """
+
+    def __init__(self, token_ids, top_k=0):
+        self.token_ids = list(token_ids)
+        self.top_k = top_k
+        self.steps = []
+        self.top_k_ids = []
+
+    def __call__(self, input_ids, scores):
+        scores_fp32 = scores.float()
+        step = [torch.logsumexp(scores_fp32, dim=-1, keepdim=True), scores_fp32[:, self.token_ids]]
+        if self.top_k > 0:
+            top_k_values, top_k_ids = scores_fp32.topk(self.top_k, dim=-1)
+            step.append(top_k_values)
+            self.top_k_ids.append(top_k_ids)
+        self.steps.append(torch.cat(step, dim=-1))
+        return scores
+
+    def get_captured_logits(self):
+        # captured_logits has shape (batch size, steps, 1 + number of token ids + top_k) with the normaliser in the first column
+        captured = {"captured_logits": torch.stack(self.steps, dim=1)}
+        if self.top_k > 0:
+            captured["captured_top_k_ids"] = torch.stack(self.top_k_ids, dim=1)
+        return captured
+
+
+class LabelTrie:
+    """
+    Prefix trie over the token ids of the label words (e.g. "True" and " True"), such that labels that are split
+    into several tokens can be followed token by token.
+
+    """
+
+    def __init__(self, label_token_ids):
+        self.root = {"children": {}, "is_label": False}
+        for token_ids in label_token_ids:
+            node = self.root
+            for token_id in token_ids:
+                node = node["children"].setdefault(token_id, {"children": {}, "is_label": False})
+            node["is_label"] = True
+
+    def get_node(self, token_ids):
+        # returns None if token_ids is not a prefix of any label
+        node = self.root
+        for token_id in token_ids:
+            node = node["children"].get(token_id)
+            if node is None:
+                return None
+        return node
+
+
+class LabelConstraintLogitsProcessor(LogitsProcessor):
+    """
+    Logits processor that only allows the continuations of the generated tokens in the label trie,
+    such that only full labels can be generated. Rows that have left the trie (finished rows padded by generate) are not changed.
+
+    """
+
+    def __init__(self, trie, prompt_length):
+        self.trie = trie
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores):
+        mask = torch.zeros_like(scores, dtype=torch.bool)
+        for row, token_ids in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            node = self.trie.get_node(token_ids)
+            if node is None or len(node["children"]) == 0:
+                continue
+            mask[row] = True
+            mask[row, list(node["children"].keys())] = False
+        return scores.masked_fill(mask, -float("inf"))
+
+
+class LabelStoppingCriteria(StoppingCriteria):
+    """
+    Stops the generation of a row once its generated tokens form a full label.
+
+    """
+
+    def __init__(self, trie, prompt_length):
+        self.trie = trie
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        is_done = [node is None or node["is_label"] for node in
+                   [self.trie.get_node(token_ids) for token_ids in input_ids[:, self.prompt_length:].tolist()]]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
 
 class TextWithLogitsGenerationPipeline(TextGenerationPipeline):
     """
@@ -19,8 +117,54 @@ class TextWithLogitsGenerationPipeline(TextGenerationPipeline):
 
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, prefix_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # optional RadixPrefixCache used to reuse the past key values of shared prompt prefixes (e.g. few-shot examples)
+        self.prefix_cache = prefix_cache
+
+    def _get_prefix_past_key_values(self, input_ids):
+        # the last prompt token is left for generate, such that the logits of the first generated token are computed as usual
+        prompt_ids = input_ids[0, :-1].tolist()
+        match_len, past_key_values = self.prefix_cache.match(prompt_ids)
+        if match_len < len(prompt_ids):
+            # only run the model on the suffix of the prompt that is not cached
+            outputs = self.model(input_ids=input_ids[:, match_len:-1],
+                                 attention_mask=input_ids.new_ones((1, len(prompt_ids))),
+                                 past_key_values=past_key_values,
+                                 use_cache=True)
+            past_key_values = outputs.past_key_values
+            self.prefix_cache.insert(prompt_ids, past_key_values)
+        # generate expects a Cache object that it can extend in place, the tree only holds copies of the cached tensors
+        return DynamicCache.from_legacy_cache(to_legacy_cache(past_key_values))
+
+    def _score(self, input_ids, attention_mask, score_token_ids, top_k=0):
+        # single forward pass, only the hidden state of the last position is projected to the vocabulary
+        # such that no full-vocabulary logits are kept for the prompt
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        # prompts are left padded in batches, so the position ids need to be computed from the attention mask
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        past_key_values = None
+        if self.prefix_cache is not None and input_ids.shape[0] == 1 and input_ids.shape[1] > 1:
+            past_key_values = self._get_prefix_past_key_values(input_ids)
+            input_ids = input_ids[:, -1:]
+            position_ids = position_ids[:, -1:]
+        outputs = self.model.base_model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=past_key_values)
+        logits = self.model.get_output_embeddings()(outputs[0][:, -1]).float()
+        log_norm = torch.logsumexp(logits, dim=-1, keepdim=True)
+        scores = {"token_probs": (logits[:, score_token_ids] - log_norm).exp()}
+        if top_k > 0:
+            top_k_logits, scores["top_k_ids"] = logits.topk(top_k, dim=-1)
+            scores["top_k_logprobs"] = top_k_logits - log_norm
+        return scores
+
+    def preprocess(self, prompt_text, **kwargs):
+        # pre-tokenised prompts (see prompt_store.py) are passed as dicts with the prompt and its input ids,
+        # such that the pipeline does not need to tokenise them again
+        if isinstance(prompt_text, dict) and "input_ids" in prompt_text:
+            input_ids = torch.tensor([prompt_text["input_ids"]])
+            return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "prompt_text": prompt_text["prompt"]}
+        return super().preprocess(prompt_text, **kwargs)
 
     def _forward(self, model_inputs, **generate_kwargs):
         input_ids = model_inputs["input_ids"]
@@ -34,6 +178,12 @@ class TextWithLogitsGenerationPipeline(TextGenerationPipeline):
             in_b = input_ids.shape[0]
         prompt_text = model_inputs.pop("prompt_text")
 
+        # score-only mode: return the probabilities of the tracked token ids for the next token instead of generating
+        score_token_ids = generate_kwargs.pop("score_token_ids", None)
+        if score_token_ids is not None:
+            scores = self._score(input_ids, attention_mask, score_token_ids, generate_kwargs.pop("score_top_k", 0))
+            return {**scores, "input_ids": input_ids, "prompt_text": prompt_text}
+
         # If there is a prefix, we may need to adjust the generation length. Do so without permanently modifying
         # generate_kwargs, as some of the parameterization may come from the initialization of the pipeline.
         prefix_length = generate_kwargs.pop("prefix_length", 0)
@@ -56,15 +206,41 @@ class TextWithLogitsGenerationPipeline(TextGenerationPipeline):
         if "generation_config" not in generate_kwargs:
             generate_kwargs["generation_config"] = self.generation_config
 
+        if self.prefix_cache is not None and input_ids is not None and in_b == 1 and input_ids.shape[1] > 1:
+            generate_kwargs["past_key_values"] = self._get_prefix_past_key_values(input_ids)
+
+        # restricted logit capture: only keep the normaliser and the logits of the given token ids (and optionally the top-k)
+        capture_token_ids = generate_kwargs.pop("capture_token_ids", None)
+        capture_top_k = generate_kwargs.pop("capture_top_k", 0)
+        logits_processors = []
+        if capture_token_ids is not None:
+            recorder = RestrictedLogitsRecorder(capture_token_ids, capture_top_k)
+            logits_processors.append(recorder)
+
+        # label-constrained decoding: only generate the labels and stop once a full label is generated.
+        # The constraint is applied after the recorder, such that the recorded logits are not masked.
+        label_token_ids = generate_kwargs.pop("label_token_ids", None)
+        if label_token_ids is not None and input_ids is not None:
+            trie = LabelTrie(label_token_ids)
+            logits_processors.append(LabelConstraintLogitsProcessor(trie, input_ids.shape[1]))
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([LabelStoppingCriteria(trie, input_ids.shape[1])])
+        if len(logits_processors) > 0:
+            generate_kwargs["logits_processor"] = LogitsProcessorList(logits_processors)
+
         generate_output = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
-        logits = generate_output["logits"]
+        if capture_token_ids is not None:
+            logit_outputs = recorder.get_captured_logits()
+        else:
+            # stack the logits of the generation steps to shape (batch size, steps, vocabulary size), such that the
+            # pipeline can unbatch them per row (it would otherwise index the tuple of steps by the row index)
+            logit_outputs = {"logits": torch.stack(generate_output["logits"], dim=1)}
         generated_sequence = generate_output["sequences"]
         out_b = generated_sequence.shape[0]
         if self.framework == "pt":
             generated_sequence = generated_sequence.reshape(in_b, out_b // in_b, *generated_sequence.shape[1:])
         elif self.framework == "tf":
             generated_sequence = tf.reshape(generated_sequence, (in_b, out_b // in_b, *generated_sequence.shape[1:]))
-        return {"generated_sequence": generated_sequence, "input_ids": input_ids, "prompt_text": prompt_text, "logits": logits}
+        return {"generated_sequence": generated_sequence, "input_ids": input_ids, "prompt_text": prompt_text, **logit_outputs}
 
     def postprocess(
         self,
@@ -73,15 +249,17 @@ class TextWithLogitsGenerationPipeline(TextGenerationPipeline):
         clean_up_tokenization_spaces=True,
         continue_final_message=None,
     ):
+        if "token_probs" in model_outputs:
+            return [{key: model_outputs[key][0] for key in ["token_probs", "top_k_ids", "top_k_logprobs"] if key in model_outputs}]
         generated_sequence = model_outputs["generated_sequence"][0]
         input_ids = model_outputs["input_ids"]
         prompt_text = model_outputs["prompt_text"]
-        logits = model_outputs["logits"]
+        logit_outputs = {key: model_outputs[key] for key in ["logits", "captured_logits", "captured_top_k_ids"] if key in model_outputs}
         generated_sequence = generated_sequence.numpy().tolist()
         records = []
         for sequence in generated_sequence:
             if return_type == ReturnType.TENSORS:
-                record = {"generated_token_ids": sequence, "logits": logits}
+                record = {"generated_token_ids": sequence, **logit_outputs}
             elif return_type in {ReturnType.NEW_TEXT, ReturnType.FULL_TEXT}:
                 # Decode text
                 text = self.tokenizer.decode(
@@ -122,7 +300,7 @@ class TextWithLogitsGenerationPipeline(TextGenerationPipeline):
                         else:
                             # When we're not starting from a prefill, the output is a new assistant message
                             all_text = list(prompt_text.messages) + [{"role": "assistant", "content": all_text}]
-                record = {"generated_text": all_text, "logits": logits}
+                record = {"generated_text": all_text, **logit_outputs}
             records.append(record)
 
         return records
\ No newline at end of file
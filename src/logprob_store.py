@@ -0,0 +1,117 @@
+import os
+import json
+import shutil
+import numpy as np
+
+INDEX_FILENAME = "index.jsonl"
+
+def get_shard_filename(field:str, shard_ix:int)-> str:
+    return f"{field}.{shard_ix:05d}.npy"
+
+class LogprobStoreWriter:
+    '''
+    Writer of per-sample arrays (e.g. per-token log-probabilities or top-k distributions) to a chunked binary store.
+    Each field is written to .npy shards in which the arrays of the samples are concatenated along the first axis,
+    and an index (index.jsonl) holds the shard and the offsets of each sample by id, such that single samples can be
+    read without loading the shards (see LogprobStoreReader).
+    The store is written to a temporary folder and replaces an existing store at store_folder on close.
+    Args:
+    store_folder: Folder to save the store to
+    samples_per_shard: Number of samples per shard
+    '''
+    def __init__(self, store_folder:str, samples_per_shard:int=10000):
+        self.store_folder = store_folder
+        self.tmp_folder = store_folder.rstrip("/") + ".tmp"
+        self.samples_per_shard = samples_per_shard
+        if os.path.exists(self.tmp_folder):
+            shutil.rmtree(self.tmp_folder)
+        os.makedirs(self.tmp_folder)
+        self.index_file = open(os.path.join(self.tmp_folder, INDEX_FILENAME), "w")
+        self.shard_ix = 0
+        self.buffer = {}
+        self.buffer_ids = []
+        self.num_samples = 0
+
+    def add(self, sample_id, arrays:dict)-> None:
+        '''
+        Args:
+        sample_id: Id of the sample (a json serialisable value, e.g. a string)
+        arrays: Dict from field name to array. Arrays of the same field should have the same dtype and trailing dimensions for all samples.
+        '''
+        if len(self.buffer_ids) > 0 and set(arrays.keys()) != set(self.buffer.keys()):
+            raise ValueError(f"Expected the fields {sorted(self.buffer.keys())} for sample {sample_id}, got {sorted(arrays.keys())}.")
+        for field, array in arrays.items():
+            self.buffer.setdefault(field, []).append(np.asarray(array))
+        self.buffer_ids.append(sample_id)
+        if len(self.buffer_ids) == self.samples_per_shard:
+            self.flush()
+
+    def flush(self)-> None:
+        if len(self.buffer_ids) == 0:
+            return
+        # boundaries of the arrays of the samples in the concatenated shard of each field
+        bounds = {}
+        for field, arrays in self.buffer.items():
+            np.save(os.path.join(self.tmp_folder, get_shard_filename(field, self.shard_ix)), np.concatenate(arrays, axis=0))
+            bounds[field] = np.cumsum([0] + [len(array) for array in arrays]).tolist()
+        for ix, sample_id in enumerate(self.buffer_ids):
+            offsets = {field: [field_bounds[ix], field_bounds[ix+1]] for field, field_bounds in bounds.items()}
+            self.index_file.write(json.dumps({"id": sample_id, "shard": self.shard_ix, "offsets": offsets}) + "\n")
+        self.num_samples += len(self.buffer_ids)
+        self.shard_ix += 1
+        self.buffer = {}
+        self.buffer_ids = []
+
+    def close(self)-> None:
+        self.flush()
+        self.index_file.close()
+        if os.path.exists(self.store_folder):
+            shutil.rmtree(self.store_folder)
+        os.replace(self.tmp_folder, self.store_folder)
+        print(f"Saved the arrays of {self.num_samples} samples to '{self.store_folder}'.")
+
+class LogprobStoreReader:
+    '''
+    Reader of a store written with LogprobStoreWriter. The shards are memory-mapped when first needed,
+    such that reading one sample only reads its slices from disk.
+    Args:
+    store_folder: Folder of the store
+    '''
+    def __init__(self, store_folder:str):
+        self.store_folder = store_folder
+        self.index = {}
+        with open(os.path.join(store_folder, INDEX_FILENAME), "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.index[entry["id"]] = entry
+        self.shards = {}
+
+    def _get_shard(self, field:str, shard_ix:int)-> np.ndarray:
+        if (field, shard_ix) not in self.shards:
+            self.shards[(field, shard_ix)] = np.load(os.path.join(self.store_folder, get_shard_filename(field, shard_ix)), mmap_mode="r")
+        return self.shards[(field, shard_ix)]
+
+    def get(self, sample_id, fields:list=None)-> dict:
+        '''
+        Function to get the arrays of one sample
+        Args:
+        fields: Fields to read, all fields if None
+        Returns a dict from field name to array
+        '''
+        if sample_id not in self.index:
+            raise KeyError(f"Sample {sample_id} is not in the store '{self.store_folder}'.")
+        entry = self.index[sample_id]
+        fields = fields if fields is not None else list(entry["offsets"].keys())
+        return {field: np.array(self._get_shard(field, entry["shard"])[slice(*entry["offsets"][field])]) for field in fields}
+
+    def __getitem__(self, sample_id)-> dict:
+        return self.get(sample_id)
+
+    def __contains__(self, sample_id)-> bool:
+        return sample_id in self.index
+
+    def __len__(self)-> int:
+        return len(self.index)
+
+    def ids(self)-> list:
+        return list(self.index.keys())
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import traceback
+import socketserver
+from contextlib import redirect_stdout
+
+import torch
+
+from src.get_model_predictions.quantization import QUANTIZATIONS
+
+# job arguments holding paths, made absolute by the client as the worker may run in another working directory
+PATH_ARGS = ["file_path", "data_path", "save_folder", "cache_folder", "prediction_cache_path", "prompt_store_folder", "logprob_store_folder", "budget_file"]
+JOB_TYPES = ["predict", "paired", "sweep", "perplexity", "status", "shutdown"]
+
+def submit_job(socket_path:str, job_type:str, **job_kwargs):
+    '''
+    Function to run a job on a model worker listening on socket_path, printing the output of the job as it runs
+    Args:
+    job_type: 'predict' (predict_veracity), 'paired' (predict_paired), 'sweep' (sweep_prompts), 'perplexity' (save_perplexities),
+              'status' or 'shutdown'
+    job_kwargs: Arguments of the job function, apart from the model and tokenizer
+    Returns the result of the job (the status for 'status')
+    '''
+    if job_type not in JOB_TYPES:
+        raise ValueError(f"Unknown job type '{job_type}', expected one of {JOB_TYPES}.")
+    job_kwargs = {key: os.path.abspath(value) if key in PATH_ARGS and value is not None else value for key, value in job_kwargs.items()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise RuntimeError(f"No model worker is listening on '{socket_path}', start one with 'python -m src.model_worker'.") from e
+        sock.sendall((json.dumps({"type": job_type, "kwargs": job_kwargs}) + "\n").encode())
+        with sock.makefile("r") as f:
+            for line in f:
+                message = json.loads(line)
+                if "log" in message:
+                    print(message["log"], end="", flush=True)
+                elif message["status"] == "error":
+                    raise RuntimeError(f"The job failed in the model worker:\n{message['traceback']}")
+                else:
+                    return message.get("result")
+    raise RuntimeError("The model worker closed the connection before the job was done.")
+
+class JobLog:
+    '''
+    Stream to which the output of a job is redirected, sending each write to the client and echoing it on the worker's stdout
+    '''
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text:str)-> int:
+        sys.__stdout__.write(text)
+        if len(text) > 0:
+            try:
+                self.wfile.write((json.dumps({"log": text}) + "\n").encode())
+            except OSError:
+                # the client is gone, the job still runs to completion
+                pass
+        return len(text)
+
+    def flush(self)-> None:
+        sys.__stdout__.flush()
+
+class ModelWorker:
+    '''
+    Long-lived process holding one loaded model and tokenizer, running prediction and perplexity jobs submitted over a Unix socket
+    one at a time, such that a series of runs (e.g. a sweep of prompts over several datasets) loads the model once.
+    Jobs run in the worker's process with the arguments of the CLIs, and write their results to the same files as runs without a worker.
+    Args:
+    model_code: Name or path of the model, jobs have to give the same name
+    quantization: Quantisation of the model, as for get_model_predictions
+    '''
+    def __init__(self, model_code:str, cache_folder:str=None, quantization:str="fp32"):
+        # the job functions are only imported by the worker, as the CLIs submitting jobs import this module
+        from src.get_model_predictions.get_model_predictions import load_model_and_tokenizer
+        self.model_code = model_code
+        self.quantization = quantization
+        start_time = time.perf_counter()
+        # safetensors checkpoints are memory-mapped by from_pretrained, the weights are only read once for all jobs
+        self.model, self.tokenizer = load_model_and_tokenizer(model_code, cache_folder, quantization)
+        self.model.eval()
+        self.load_seconds = time.perf_counter() - start_time
+        self.start_time = time.time()
+        self.num_jobs = 0
+        self.stopped = False
+        print(f"Loaded '{model_code}' ({quantization}) in {self.load_seconds:.1f} seconds.")
+
+    def check_model(self, model_code:str, quantization:str="fp32")-> None:
+        if model_code != self.model_code or quantization != self.quantization:
+            raise ValueError(f"The worker serves '{self.model_code}' ({self.quantization}), the job asks for '{model_code}' ({quantization}).")
+
+    def get_status(self)-> dict:
+        return {"model_code": self.model_code, "quantization": self.quantization, "device": str(self.model.device),
+                "load_seconds": self.load_seconds, "uptime_seconds": time.time() - self.start_time, "jobs": self.num_jobs}
+
+    def run_job(self, job_type:str, job_kwargs:dict):
+        from src.get_model_predictions.get_model_predictions import enforce_reproducibility, predict_veracity, predict_paired
+        from src.get_model_predictions.sweep_prompts import sweep_prompts
+        from src.property_detection.get_perplexity import save_perplexities
+
+        if job_type == "status":
+            return self.get_status()
+        if job_type == "shutdown":
+            self.stopped = True
+            return self.get_status()
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"Unknown job type '{job_type}', expected one of {JOB_TYPES}.")
+        if job_type == "perplexity":
+            self.check_model(job_kwargs["model_name"])
+        else:
+            self.check_model(job_kwargs["model_code"], job_kwargs.get("quantization", "fp32"))
+        job_function = {"predict": predict_veracity, "paired": predict_paired, "sweep": sweep_prompts, "perplexity": save_perplexities}[job_type]
+        # each job starts from the same seeds as a fresh process
+        enforce_reproducibility()
+        job_function(**job_kwargs, model=self.model, tokenizer=self.tokenizer)
+        self.num_jobs += 1
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            job = json.loads(line)
+            print(f"Running {job['type']} job {job.get('kwargs', {})}")
+            with redirect_stdout(JobLog(self.wfile)):
+                result = self.server.worker.run_job(job["type"], job.get("kwargs", {}))
+            message = {"status": "ok", "result": result}
+        except Exception as e:
+            traceback.print_exc()
+            message = {"status": "error", "error": str(e), "traceback": traceback.format_exc()}
+        try:
+            self.wfile.write((json.dumps(message) + "\n").encode())
+        except OSError:
+            print("The client disconnected before the job was done.")
+
+def remove_stale_socket(socket_path:str)-> None:
+    if os.path.exists(socket_path):
+        # a socket file left behind by a killed worker is replaced, a running worker is not
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(socket_path) == 0:
+                raise RuntimeError(f"A model worker is already listening on '{socket_path}'.")
+        os.remove(socket_path)
+
+def serve(worker:ModelWorker, socket_path:str)-> None:
+    remove_stale_socket(socket_path)
+    server = socketserver.UnixStreamServer(socket_path, JobHandler)
+    server.worker = worker
+    print(f"Model worker listening on '{socket_path}'.")
+    try:
+        # jobs are run one at a time, as they share the model
+        while not worker.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+    print(f"Model worker stopped after {worker.num_jobs} jobs.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load a model once and run prediction and perplexity jobs submitted with --worker over a Unix socket.")
+    parser.add_argument("--socket", type=str, required=True, help="Path of the Unix socket to listen on")
+    parser.add_argument("--model_name", type=str, default=None, help="Path to Huggingface model, jobs have to use the same --model_name")
+    parser.add_argument("--cache_folder", type=str, default=None, help="Path to cache folder")
+    parser.add_argument("--quantization", type=str, default="fp32", choices=QUANTIZATIONS, help="Quantisation of the model, as for get_model_predictions. Not quantised by default.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of torch threads, the torch default if not set")
+    parser.add_argument("--status", action="store_true", help="Print the status of the worker listening on --socket")
+    parser.add_argument("--stop", action="store_true", help="Stop the worker listening on --socket")
+
+    args = parser.parse_args()
+    if args.status or args.stop:
+        print(json.dumps(submit_job(args.socket, "shutdown" if args.stop else "status"), indent=2))
+    else:
+        if args.model_name is None:
+            parser.error("--model_name is required to start a worker.")
+        print(args)
+        print()
+        # checked before loading the model
+        remove_stale_socket(args.socket)
+        if args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
+        serve(ModelWorker(args.model_name, args.cache_folder, args.quantization), args.socket)
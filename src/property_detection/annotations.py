@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+import hashlib
+from importlib.metadata import version, PackageNotFoundError
+from urllib.parse import urlparse
+from string import punctuation
+import spacy
+from textstat import flesch_reading_ease
+from nltk.tokenize import word_tokenize
+from tqdm import tqdm
+
+from src.property_detection.property_detectors import HEDGE_DETECTION_DATA_FOLDER, detect_hedges
+
+SKIPLIST = set(list(punctuation) + ["”", "“", "—", "’", "``", "''"])
+SPACY_MODEL = "en_core_web_trf"
+# bump when an annotation function changes, such that cached annotations are recomputed
+ANNOTATION_VERSION = 1
+
+def hash_text(text:str)-> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def get_package_version(package:str)-> str:
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return "unknown"
+
+def get_hedge_lexicon_hash()-> str:
+    # the hedge flags depend on the discourse marker, hedge word and booster word lists
+    lexicon = ""
+    for filename in sorted(os.listdir(HEDGE_DETECTION_DATA_FOLDER)):
+        with open(os.path.join(HEDGE_DETECTION_DATA_FOLDER, filename), "r") as f:
+            lexicon += filename + f.read()
+    return hash_text(lexicon)[:16]
+
+def annotate_words(texts:list)-> list:
+    # lowercased tokens without punctuation, in order
+    return [[w.lower() for w in word_tokenize(text) if w.lower() not in SKIPLIST] for text in texts]
+
+def annotate_domains(urls:list)-> list:
+    return [urlparse(url).netloc for url in urls]
+
+def annotate_entities(texts:list, spacy_model:str=SPACY_MODEL, batch_size:int=64, n_process:int=1)-> list:
+    '''
+    Function to get the lowercased named entities of the texts, streamed through the spaCy pipeline in batches of batch_size texts
+    Args:
+    spacy_model: Name of the spaCy model, e.g. 'en_core_web_trf' (best on a GPU) or 'en_core_web_sm' (fast on CPUs)
+    n_process: Number of processes running the model, on CPUs if larger than 1
+    '''
+    # the GPU is used if there is one, otherwise the model runs on CPUs
+    if n_process == 1 and spacy.prefer_gpu():
+        print("Running the NER on the GPU.")
+    ner = spacy.load(spacy_model)
+    # texts of similar lengths are batched together to reduce padding, and the entities are put back in the order of the texts
+    order = sorted(range(len(texts)), key=lambda ix: len(texts[ix]))
+    entities = [None]*len(texts)
+    docs = ner.pipe([texts[ix] for ix in order], batch_size=batch_size, n_process=n_process)
+    for doc, ix in zip(tqdm(docs, total=len(texts)), order):
+        entities[ix] = sorted(set([ent.text.lower() for ent in doc.ents]))
+    return entities
+
+def annotate_flesch_reading_ease(texts:list)-> list:
+    return [flesch_reading_ease(text) for text in texts]
+
+def annotate_hedges(texts:list, num_workers:int=1, batch_size:int=32)-> list:
+    # (discourse markers, hedge terms, boosters preceeded by negation) flags of HedgeDetector.is_hedged_text
+    return [list(flags) for flags in detect_hedges(texts, num_workers, batch_size)]
+
+# annotation functions by name, taking a list of unique texts and returning one json serialisable annotation per text.
+# The version holds the versions of the libraries and models used, only annotations with the current version are read from the cache.
+# It is given as a function of the settings of the annotation function if they change the annotations (e.g. the spaCy model),
+# or if it reads files (e.g. the hedge lexicon), such that they are only read when the annotator is used.
+ANNOTATORS = {"words": {"function": annotate_words, "version": f"nltk-{get_package_version('nltk')}"},
+              "domains": {"function": annotate_domains, "version": "urllib", "persist": False},
+              "entities": {"function": annotate_entities, "version": lambda spacy_model=SPACY_MODEL, **kwargs: f"spacy-{get_package_version('spacy')}-{spacy_model}-{get_package_version(spacy_model)}"},
+              "flesch_reading_ease": {"function": annotate_flesch_reading_ease, "version": f"textstat-{get_package_version('textstat')}"},
+              "hedges": {"function": annotate_hedges, "version": lambda **kwargs: f"stanza-{get_package_version('stanza')}-{get_hedge_lexicon_hash()}"}}
+
+class AnnotationStore:
+    '''
+    Layer computing the linguistic annotations (tokens, entities, hedge flags, domains, ...) of the texts used by the property functions
+    once per unique text. Annotations are kept in memory for the run and, if db_path is given, in an on-disk (SQLite) cache keyed by
+    annotator, annotator version and text hash, shared across runs and datasets (e.g. the claims and evidences shared by DRUID and DRUID+).
+    Args:
+    db_path: Path to the SQLite database, created if it does not exist. Annotations are only kept in memory if None.
+    '''
+    def __init__(self, db_path:str=None, commit_every:int=1000):
+        self.commit_every = commit_every
+        # annotations of the run by annotator name and version
+        self.memory = {}
+        self.stats = {name: {"texts": 0, "cached": 0, "computed": 0} for name in ANNOTATORS}
+        self.conn = None
+        if db_path is not None:
+            self.conn = sqlite3.connect(db_path, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS annotations (
+                                    annotator TEXT, version TEXT, text_hash TEXT, annotation TEXT,
+                                    PRIMARY KEY (annotator, version, text_hash))""")
+            self.conn.commit()
+        self.num_uncommitted = 0
+
+    def _get_version(self, name:str, annotator_kwargs:dict)-> str:
+        version = ANNOTATORS[name]["version"]
+        if callable(version):
+            version = version(**annotator_kwargs)
+        return f"{ANNOTATION_VERSION}-{version}"
+
+    def _lookup(self, name:str, version:str, texts:list)-> dict:
+        cached = {}
+        if self.conn is None or not ANNOTATORS[name].get("persist", True):
+            return cached
+        for text in texts:
+            row = self.conn.execute("SELECT annotation FROM annotations WHERE annotator=? AND version=? AND text_hash=?",
+                                    (name, version, hash_text(text))).fetchone()
+            if row is not None:
+                cached[text] = json.loads(row[0])
+        return cached
+
+    def _store(self, name:str, version:str, annotations:dict)-> None:
+        if self.conn is None or not ANNOTATORS[name].get("persist", True):
+            return
+        for text, annotation in annotations.items():
+            self.conn.execute("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+                              (name, version, hash_text(text), json.dumps(annotation)))
+            self.num_uncommitted += 1
+            if self.num_uncommitted >= self.commit_every:
+                self.commit()
+        self.commit()
+
+    def get(self, name:str, texts:list, **annotator_kwargs)-> list:
+        '''
+        Function to get the annotations of the texts by the annotator name (in ANNOTATORS)
+        Args:
+        annotator_kwargs: Settings of the annotation function (e.g. the number of workers)
+        Returns a list with the annotation of each text
+        '''
+        if name not in ANNOTATORS:
+            raise ValueError(f"Unknown annotator '{name}', expected one of {list(ANNOTATORS.keys())}.")
+        texts = list(texts)
+        version = self._get_version(name, annotator_kwargs)
+        memory = self.memory.setdefault((name, version), {})
+        todo = [text for text in dict.fromkeys(texts) if text not in memory]
+        cached = self._lookup(name, version, todo)
+        memory.update(cached)
+        todo = [text for text in todo if text not in cached]
+        if len(todo) > 0:
+            computed = dict(zip(todo, ANNOTATORS[name]["function"](todo, **annotator_kwargs)))
+            self._store(name, version, computed)
+            memory.update(computed)
+        self.stats[name]["texts"] += len(texts)
+        self.stats[name]["cached"] += len(cached)
+        self.stats[name]["computed"] += len(todo)
+        return [memory[text] for text in texts]
+
+    def commit(self)-> None:
+        if self.conn is not None:
+            self.conn.commit()
+        self.num_uncommitted = 0
+
+    def get_stats(self)-> dict:
+        # number of annotated texts, and of unique texts read from the cache or computed (the others were in memory), by annotator
+        return {name: stats for name, stats in self.stats.items() if stats["texts"] > 0}
+
+    def close(self)-> None:
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
@@ -1,76 +1,321 @@
 ## from https://huggingface.co/docs/transformers/perplexity
+import os
+import argparse
+import numpy as np
 import pandas as pd
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from tqdm import tqdm
-import sys
-import os
 
-if __name__ == '__main__':
+from src.logprob_store import LogprobStoreWriter
+from src.model_worker import submit_job
 
-    MODEL_NAME = sys.argv[1]
-    DATASET_NAME = sys.argv[2]
-    include_eos = False #bool(sys.argv[2])
-    
-    # create the save folder if it does not exist
-    SAVEFOLDER = "data/property_detection/ppl"
-    os.makedirs(SAVEFOLDER, exist_ok=True)
+# models for which perplexity values were collected
+PPL_MODELS = ['openai-community/gpt2', 'EleutherAI/pythia-6.9b', 'meta-llama/Llama-3.1-8B-Instruct']
 
-    stride = 512
+def load_model_and_tokenizer(model_name:str, cache_folder:str=None):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_folder)
+    model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir=cache_folder)
+    model = model.to(device).eval()
+    return model, tokenizer
 
-    assert MODEL_NAME in ['openai-community/gpt2','EleutherAI/pythia-6.9b','meta-llama/Llama-3.1-8B-Instruct']
+def get_max_length(model)-> int:
+    # GPT-2 models define n_positions, the other models max_position_embeddings
+    return getattr(model.config, "n_positions", None) or model.config.max_position_embeddings
 
-    MODEL_SHORT = MODEL_NAME.split('/')[1].split('-')[0]
-    print(MODEL_SHORT)
+def get_windows(seq_len:int, max_length:int, stride:int)-> list:
+    '''
+    Function to get the strided windows over a sequence of seq_len tokens, as (begin, end, target length) tuples.
+    Only the last target length tokens of a window are scored, such that each token is scored once.
+    '''
+    windows = []
+    prev_end_loc = 0
+    for begin_loc in range(0, seq_len, stride):
+        end_loc = min(begin_loc + max_length, seq_len)
+        trg_len = end_loc - prev_end_loc  # may be different from stride on last loop
+        windows.append((begin_loc, end_loc, trg_len))
+        prev_end_loc = end_loc
+        if end_loc == seq_len:
+            break
+    return windows
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-    model = AutoModelForCausalLM.from_pretrained(MODEL_NAME)
-    model = model.to(device)
+def get_window_labels(input_ids:list, trg_len:int)-> torch.Tensor:
+    # only the last trg_len tokens of a window are scored, the labels of the context tokens are masked
+    labels = torch.full((len(input_ids),), -100, dtype=torch.long)
+    labels[len(input_ids)-trg_len:] = torch.tensor(input_ids[len(input_ids)-trg_len:])
+    # the first token of a sequence is never scored, as nothing precedes it
+    labels[0] = -100
+    return labels
+
+def get_token_logprobs(model, hidden_states:torch.Tensor, labels:torch.Tensor)-> tuple:
+    '''
+    Function to get the log-probabilities of the labels of one sequence from its last hidden states
+    Returns the token ids and the log-probabilities of the scored (not masked) labels as numpy arrays
+    '''
+    # the logits of a position predict the next token, so the labels are shifted by one
+    targets = labels[1:]
+    scored = targets != -100
+    # only the scored positions are projected to the vocabulary, to avoid keeping (batch, length, vocabulary) logits
+    logits = model.get_output_embeddings()(hidden_states[:-1][scored]).float()
+    logprobs = -F.cross_entropy(logits, targets[scored], reduction="none")
+    return targets[scored].cpu().numpy().astype(np.int32), logprobs.cpu().numpy()
+
+@torch.no_grad()
+def get_window_logprobs(model, windows:list, pad_token_id:int)-> list:
+    '''
+    Function to get the log-probabilities of the target tokens of each window (see get_token_logprobs), with all windows in one forward pass.
+    The windows are right padded, and the labels of the padding and of the context tokens before the targets are masked.
+    Args:
+    windows: List of (input ids, target length) tuples
+    '''
+    device = model.device
+    max_len = max(len(input_ids) for input_ids, _ in windows)
+    batch_input_ids = torch.full((len(windows), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(windows), max_len), dtype=torch.long)
+    for row, (input_ids, _) in enumerate(windows):
+        batch_input_ids[row, :len(input_ids)] = torch.tensor(input_ids)
+        attention_mask[row, :len(input_ids)] = 1
+    hidden_states = model.base_model(input_ids=batch_input_ids.to(device), attention_mask=attention_mask.to(device))[0]
+    return [get_token_logprobs(model, hidden_states[row, :len(input_ids)], get_window_labels(input_ids, trg_len).to(device))
+            for row, (input_ids, trg_len) in enumerate(windows)]
+
+@torch.no_grad()
+def supports_packing(model)-> bool:
+    '''
+    Function to check whether the model uses a custom 4D attention mask as is, as needed for packed rows.
+    Probed with two tokens that may not attend to each other: the second one has to get the same hidden state as on its own,
+    which is not the case if the model ignores the mask (or builds its own causal mask), and models rejecting 4D masks raise an error.
+    '''
+    device = model.device
+    allowed = torch.eye(2, dtype=torch.bool)
+    attention_mask = torch.zeros((1, 1, 2, 2), dtype=model.dtype).masked_fill(~allowed, torch.finfo(model.dtype).min)
+    try:
+        packed = model.base_model(input_ids=torch.tensor([[0, 1]], device=device),
+                                  attention_mask=attention_mask.to(device),
+                                  position_ids=torch.zeros((1, 2), dtype=torch.long, device=device))[0][0, 1]
+    except Exception:
+        # e.g. a shape error for models expecting a 2D padding mask, or a flash attention error
+        return False
+    alone = model.base_model(input_ids=torch.tensor([[1]], device=device))[0][0, 0]
+    # the tolerance allows for the rounding of half precision models, ignoring the mask changes the hidden state far more
+    tolerance = max(1e-3, 16*torch.finfo(model.dtype).eps)
+    return torch.allclose(packed.float(), alone.float(), rtol=tolerance, atol=tolerance)
+
+def get_packed_rows(lengths:list, pack_length:int)-> list:
+    '''
+    Function to pack sequences into rows of at most pack_length tokens, with first-fit decreasing.
+    Sequences longer than pack_length get a row of their own.
+    Returns a list of rows, each a list of sequence indices
+    '''
+    rows = []
+    row_lengths = []
+    for ix in np.argsort(lengths, kind="stable")[::-1]:
+        for row_ix, row_length in enumerate(row_lengths):
+            if row_length + lengths[ix] <= pack_length:
+                rows[row_ix].append(ix)
+                row_lengths[row_ix] += lengths[ix]
+                break
+        else:
+            rows.append([ix])
+            row_lengths.append(lengths[ix])
+    return rows
 
-    if 'gpt' in MODEL_NAME: #### UNSURE FOR PYTHIA
-        max_length = model.config.n_positions ## for GPT models
+@torch.no_grad()
+def get_packed_window_logprobs(model, windows:list, rows:list, pad_token_id:int)-> dict:
+    '''
+    Function to get the log-probabilities of the target tokens of each window (see get_token_logprobs), with several windows packed per row.
+    Each token only attends to the preceding tokens of its own window (block-diagonal causal mask), and the position ids
+    restart at 0 for each window, such that each window is scored as if it was on its own.
+    Args:
+    windows: List of (input ids, target length) tuples
+    rows: List of rows, each a list of indices of the windows packed in the row
+    Returns a dict from window index to token ids and log-probabilities
+    '''
+    device = model.device
+    row_lengths = [sum(len(windows[ix][0]) for ix in row) for row in rows]
+    max_len = max(row_lengths)
+    input_ids = torch.full((len(rows), max_len), pad_token_id, dtype=torch.long)
+    position_ids = torch.zeros((len(rows), max_len), dtype=torch.long)
+    # padding positions get document id -1, such that they never attend to or are attended by a window
+    document_ids = torch.full((len(rows), max_len), -1, dtype=torch.long)
+    offsets = {}
+    for row_ix, row in enumerate(rows):
+        offset = 0
+        for ix in row:
+            window_ids = windows[ix][0]
+            input_ids[row_ix, offset:offset+len(window_ids)] = torch.tensor(window_ids)
+            position_ids[row_ix, offset:offset+len(window_ids)] = torch.arange(len(window_ids))
+            document_ids[row_ix, offset:offset+len(window_ids)] = ix
+            offsets[ix] = (row_ix, offset)
+            offset += len(window_ids)
+    causal = torch.ones((max_len, max_len), dtype=torch.bool).tril()
+    allowed = (document_ids[:, :, None] == document_ids[:, None, :]) & causal
+    # the 4D mask is used as is by the model, so it has to be in inverted form: 0 to attend and the minimum value to mask
+    attention_mask = torch.zeros(allowed.shape, dtype=model.dtype).masked_fill(~allowed, torch.finfo(model.dtype).min)
+    hidden_states = model.base_model(input_ids=input_ids.to(device),
+                                     attention_mask=attention_mask[:, None].to(device),
+                                     position_ids=position_ids.to(device))[0]
+    logprobs = {}
+    for ix, (row_ix, offset) in offsets.items():
+        window_ids, trg_len = windows[ix]
+        logprobs[ix] = get_token_logprobs(model, hidden_states[row_ix, offset:offset+len(window_ids)], get_window_labels(window_ids, trg_len).to(device))
+    return logprobs
+
+def get_batches(lengths:list, batch_size:int, max_batch_tokens:int)-> list:
+    '''
+    Function to group items into batches of at most batch_size items and max_batch_tokens (padded) tokens, sorted by length
+    such that items of similar lengths are batched together
+    '''
+    order = np.argsort(lengths, kind="stable")[::-1]
+    batches = []
+    batch = []
+    for ix in order:
+        # the first item of a batch is the longest one
+        if len(batch) > 0 and (len(batch) == batch_size or (len(batch)+1)*lengths[batch[0]] > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(ix)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def compute_perplexities(texts:list, model, tokenizer, batch_size:int=16, max_batch_tokens:int=16384, stride:int=512,
+                         include_eos:bool=False, max_length:int=None, packing:bool=False, pack_length:int=2048,
+                         return_token_logprobs:bool=False):
+    '''
+    Function to compute the perplexity of each text, with the strided windows of all texts batched together.
+    The perplexity of a text is the exponential of the mean window negative log-likelihood, as in the single-text loop
+    of https://huggingface.co/docs/transformers/perplexity.
+    Args:
+    texts: Texts to compute the perplexity for
+    batch_size: Maximum number of windows per forward pass
+    max_batch_tokens: Maximum number of (padded) tokens per forward pass
+    include_eos: Whether to score the last token of each text
+    max_length: Window length, the maximum model length if None
+    packing: Whether to pack several windows into rows of pack_length tokens instead of padding them
+    pack_length: Number of tokens per packed row (capped at the window length)
+    return_token_logprobs: Whether to also return the scored token ids and their log-probabilities for each text
+    Returns a list with one perplexity per text (nan for texts without tokens to score), and if return_token_logprobs
+    a list with one dict per text with the 'token_ids' and 'logprobs' arrays
+    '''
+    if max_length is None:
+        max_length = get_max_length(model)
+    if packing and not supports_packing(model):
+        raise ValueError(f"Packing needs a model that uses custom 4D attention masks as is, which {model.config.model_type} (with {model.config._attn_implementation} attention) does not.")
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else (tokenizer.eos_token_id or 0)
+    encodings = tokenizer(list(texts))["input_ids"]
+
+    windows = []
+    text_window_ixs = []
+    for input_ids in encodings:
+        seq_len = len(input_ids) if include_eos else len(input_ids) - 1
+        text_window_ixs.append([])
+        for begin_loc, end_loc, trg_len in get_windows(seq_len, max_length, stride):
+            text_window_ixs[-1].append(len(windows))
+            windows.append((input_ids[begin_loc:end_loc], trg_len))
+
+    window_logprobs = {}
+    lengths = [len(input_ids) for input_ids, _ in windows]
+    if packing:
+        rows = get_packed_rows(lengths, min(pack_length, max_length))
+        # the rows are batched by their number of tokens, with at most max_batch_tokens per forward pass
+        row_batches = get_batches([sum(lengths[ix] for ix in row) for row in rows], len(rows), max_batch_tokens)
+        for row_batch in tqdm(row_batches):
+            window_logprobs.update(get_packed_window_logprobs(model, windows, [rows[row_ix] for row_ix in row_batch], pad_token_id))
     else:
-        max_length = model.config.max_position_embeddings ## for LLAMA
+        for batch in tqdm(get_batches(lengths, batch_size, max_batch_tokens)):
+            window_logprobs.update(zip(batch, get_window_logprobs(model, [windows[ix] for ix in batch], pad_token_id)))
 
     ppls = []
+    token_logprobs = []
+    for window_ixs in text_window_ixs:
+        # windows without scored tokens (a single token) have a nan negative log-likelihood, as in the single-text loop
+        nlls = [-window_logprobs[ix][1].mean() if len(window_logprobs[ix][1]) > 0 else float("nan") for ix in window_ixs]
+        ppls.append(float(np.exp(np.mean(nlls))) if len(nlls) > 0 else float("nan"))
+        if return_token_logprobs:
+            # each token is scored in exactly one window, so the windows are concatenated in order
+            token_logprobs.append({"token_ids": np.concatenate([window_logprobs[ix][0] for ix in window_ixs] + [np.zeros(0, dtype=np.int32)]),
+                                   "logprobs": np.concatenate([window_logprobs[ix][1] for ix in window_ixs] + [np.zeros(0, dtype=np.float32)])})
+    if return_token_logprobs:
+        return ppls, token_logprobs
+    return ppls
 
-    ## LOAD DATASET
-    ds = pd.read_csv(DATASET_NAME,sep="\t")
-
-    for index, row in tqdm(ds.iterrows()):
-        encodings = tokenizer(row['evidence'], return_tensors="pt")
+def save_perplexities(model_name:str, data_path:str, save_folder:str="data/property_detection/ppl", cache_folder:str=None, batch_size:int=16,
+                      max_batch_tokens:int=16384, stride:int=512, include_eos:bool=False, packing:bool=False, pack_length:int=2048,
+                      logprob_store_folder:str=None, model=None, tokenizer=None)-> None:
+    '''
+    Function to compute the perplexity of the evidence in data_path and save it to save_folder (see compute_perplexities for the arguments)
+    Args:
+    logprob_store_folder: Folder to save the per-token log-probabilities to, in a binary store named after the perplexity file. Not saved if None.
+    model, tokenizer: Already loaded model and tokenizer of model_name (e.g. in a model worker, see src/model_worker.py), loaded if None
+    '''
+    # create the save folder if it does not exist
+    os.makedirs(save_folder, exist_ok=True)
 
-        seq_len = encodings.input_ids.size(1) #- 1
-        if not include_eos:
-            seq_len -= 1
+    MODEL_SHORT = model_name.split('/')[-1].split('-')[0]
+    DATASET_NAME = os.path.basename(data_path)
+    print(MODEL_SHORT)
 
-        nlls = []
-        prev_end_loc = 0
-        for begin_loc in tqdm(range(0, seq_len, stride)):
-            end_loc = min(begin_loc + max_length, seq_len)
-            trg_len = end_loc - prev_end_loc  # may be different from stride on last loop
-            input_ids = encodings.input_ids[:, begin_loc:end_loc].to(device)
-            target_ids = input_ids.clone()
-            target_ids[:, :-trg_len] = -100
+    if model is None:
+        model, tokenizer = load_model_and_tokenizer(model_name, cache_folder)
 
-            with torch.no_grad():
-                outputs = model(input_ids, labels=target_ids)
+    ## LOAD DATASET
+    ds = pd.read_csv(data_path, sep="\t")
+    ds['ppl'], token_logprobs = compute_perplexities(ds['evidence'].tolist(), model, tokenizer,
+                                                     batch_size=batch_size,
+                                                     max_batch_tokens=max_batch_tokens,
+                                                     stride=stride,
+                                                     include_eos=include_eos,
+                                                     packing=packing,
+                                                     pack_length=pack_length,
+                                                     return_token_logprobs=True)
 
-                # loss is calculated using CrossEntropyLoss which averages over valid labels
-                # N.B. the model only calculates loss over trg_len - 1 labels, because it internally shifts the labels
-                # to the left by 1.
-                neg_log_likelihood = outputs.loss
+    save_name = f'ppl_{MODEL_SHORT}_{DATASET_NAME}_{include_eos}'
+    save_file = os.path.join(save_folder, f'{save_name}.csv')
+    ds.to_csv(save_file)
+    print(f"Saved perplexity values to '{save_file}'.")
 
-            nlls.append(neg_log_likelihood)
+    if logprob_store_folder is not None:
+        # samples are keyed by their id, or by their row if the data has no id column
+        sample_ids = ds['id'].tolist() if 'id' in ds.columns else ds.index.tolist()
+        writer = LogprobStoreWriter(os.path.join(logprob_store_folder, save_name))
+        for sample_id, sample_logprobs in zip(sample_ids, token_logprobs):
+            writer.add(sample_id, sample_logprobs)
+        writer.close()
 
-            prev_end_loc = end_loc
-            if end_loc == seq_len:
-                break
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the perplexity of the evidence for a model.")
+    parser.add_argument("--model_name", type=str, required=True, help=f"Path to Huggingface model, we used {PPL_MODELS}")
+    parser.add_argument("--data_path", type=str, required=True, help="Path to .tsv file with an 'evidence' column")
+    parser.add_argument("--save_folder", type=str, default="data/property_detection/ppl", help="Folder to save the results to")
+    parser.add_argument("--cache_folder", type=str, default=None, help="Path to cache folder")
+    parser.add_argument("--batch_size", type=int, default=16, help="Maximum number of windows per forward pass")
+    parser.add_argument("--max_batch_tokens", type=int, default=16384, help="Maximum number of (padded) tokens per forward pass")
+    parser.add_argument("--stride", type=int, default=512, help="Stride of the windows over texts longer than the model length")
+    parser.add_argument("--include_eos", action="store_true", help="Also score the last token of each text")
+    parser.add_argument("--packing", action="store_true", help="Pack several texts per row with block-diagonal attention masks instead of padding")
+    parser.add_argument("--pack_length", type=int, default=2048, help="Number of tokens per packed row")
+    parser.add_argument("--logprob_store", type=str, default=None, help="Path to a folder to save the per-token log-probabilities to, in a memory-mapped binary store keyed by id. Disabled by default.")
+    parser.add_argument("--worker", type=str, default=None, help="Path to the Unix socket of a model worker (src/model_worker.py) with the model already loaded, to run the job on instead of loading the model.")
 
-        ppl = torch.exp(torch.stack(nlls).mean()).cpu().item()
-        ppls.append(ppl)
-        
-    ds['ppl'] = ppls
+    args = parser.parse_args()
+    print(args)
+    print()
 
-    ds.to_csv(os.path.join(SAVEFOLDER, f'ppl_{MODEL_SHORT}_{DATASET_NAME}_{include_eos}.csv'))
\ No newline at end of file
+    job_kwargs = dict(model_name=args.model_name,
+                      data_path=args.data_path,
+                      save_folder=args.save_folder,
+                      cache_folder=args.cache_folder,
+                      batch_size=args.batch_size,
+                      max_batch_tokens=args.max_batch_tokens,
+                      stride=args.stride,
+                      include_eos=args.include_eos,
+                      packing=args.packing,
+                      pack_length=args.pack_length,
+                      logprob_store_folder=args.logprob_store)
+    if args.worker is not None:
+        submit_job(args.worker, "perplexity", **job_kwargs)
+    else:
+        save_perplexities(**job_kwargs)
@@ -1,41 +1,34 @@
 # move stuff from notebook to here
 from pathlib import Path
 import os
-from urllib.parse import urlparse
 import pandas as pd
 import numpy as np
-import spacy
 from matplotlib import pyplot as plt
-from textstat import flesch_reading_ease
 from nltk.metrics.distance import jaccard_distance
-from nltk.tokenize import word_tokenize
-from string import punctuation
-from tqdm import tqdm
 
-from src.property_detection.property_detectors import FactCheckDetector, UnreliableDetector, HedgeDetector
+from src.property_detection.property_detectors import FactCheckDetector, UnreliableDetector
+from src.property_detection.annotations import AnnotationStore, SPACY_MODEL
 from src.utils import print_data_to_txt_file
 
-SKIPLIST = set(list(punctuation) + ["”", "“", "—", "’", "``", "''"])
+# the property functions get the annotations of the texts from an AnnotationStore, an in-memory one if none is given
 
-def get_unreliable_mbfc(data):
+def get_unreliable_mbfc(data, annotations=None):
+    annotations = annotations if annotations is not None else AnnotationStore()
     evidence_sources = data.evidence_source.tolist()
     
     unreliable_detector = UnreliableDetector()
     mbfc_bias_cat = list(map(unreliable_detector.get_bias_cat, evidence_sources))
     mbfc_fact_cat = list(map(unreliable_detector.get_fact_cat, evidence_sources))
 
-    def get_domain(evidence_source):
-        return urlparse(evidence_source).netloc
+    domains = annotations.get("domains", evidence_sources)
 
-    def is_gov_page(evidence_source):
-        domain = get_domain(evidence_source)
+    def is_gov_page(domain):
         return domain.endswith(".gov") or ".gov." in domain
-    is_gov_pages = list(map(is_gov_page, evidence_sources))
+    is_gov_pages = list(map(is_gov_page, domains))
 
-    def is_edu_page(evidence_source):
-        domain = get_domain(evidence_source)
+    def is_edu_page(domain):
         return domain.endswith(".edu")
-    is_edu_pages = list(map(is_edu_page, evidence_sources))
+    is_edu_pages = list(map(is_edu_page, domains))
 
     def is_unreliable_mbfc_gov_edu(mbfc_bias_cat, mbfc_fact_cat, is_gov_page, is_edu_page):
         if (mbfc_bias_cat is None) and (mbfc_fact_cat is None):
@@ -51,7 +44,8 @@ def get_unreliable_mbfc(data):
 
     return list(map(is_unreliable_mbfc_gov_edu, mbfc_bias_cat, mbfc_fact_cat, is_gov_pages, is_edu_pages))
 
-def get_is_factcheck_article(data):
+def get_is_factcheck_article(data, annotations=None):
+    annotations = annotations if annotations is not None else AnnotationStore()
     evidence_sources = data.evidence_source.tolist()
     fact_check_detector = FactCheckDetector()
     
@@ -60,7 +54,7 @@ def get_is_factcheck_article(data):
     # Check if any fact-check sites have been missed
     url_sites_fact = data[~(np.array(is_factcheck_article))]\
         .evidence_source[data.evidence_source.apply(lambda val: "fact" in val)].unique()
-    check_url_sites_fact = list(set([urlparse(url).netloc.replace("www.","") for url in url_sites_fact]))
+    check_url_sites_fact = list(set([domain.replace("www.","") for domain in annotations.get("domains", url_sites_fact)]))
     check_url_sites_fact.extend(list(set([url.replace("www.","") for url in url_sites_fact])))
     missed_fact_filepath = "tmp_potentially_missed_fc_sites.txt"
     print_data_to_txt_file(check_url_sites_fact, missed_fact_filepath)
@@ -69,7 +63,8 @@ def get_is_factcheck_article(data):
     
     return is_factcheck_article
 
-def get_claim_entity_overlap(data):
+def get_claim_entity_overlap(data, annotations=None, spacy_model=SPACY_MODEL, batch_size=64, n_process=1):
+    annotations = annotations if annotations is not None else AnnotationStore()
     # a rate of 0 equals not implicit
     # a rate of 1 equals fully implicit
     def get_implicit_level(e1, e2):
@@ -78,43 +73,42 @@ def get_claim_entity_overlap(data):
         # calculate how many of e1 entities can be found in e2
         return len(e1.intersection(e2))/len(e1)
         
-    spacy.require_gpu() # TODO: uncomment for GPU
-    ner = spacy.load("en_core_web_trf") # TODO: set to 'en_core_web_trf' for GPU (roberta-base for NER)
-    claim_entities = list(map(lambda val: set([ent.text.lower() for ent in ner(val).ents]), data.claim.tolist()))
-    evidence_entities = list(map(lambda val: set([ent.text.lower() for ent in ner(val).ents]), data.evidence.tolist()))
+    # the claims and evidences are annotated together, such that the model is loaded once and each unique text is only parsed once
+    entities = annotations.get("entities", data.claim.tolist() + data.evidence.tolist(), spacy_model=spacy_model, batch_size=batch_size, n_process=n_process)
+    claim_entities = list(map(set, entities[:len(data)]))
+    evidence_entities = list(map(set, entities[len(data):]))
     return list(map(get_implicit_level, claim_entities, evidence_entities))
 
-def get_flesch_reading_ease_score(data):
-    return data.evidence.apply(flesch_reading_ease)
+def get_flesch_reading_ease_score(data, annotations=None):
+    annotations = annotations if annotations is not None else AnnotationStore()
+    return annotations.get("flesch_reading_ease", data.evidence.tolist())
 
-def get_uncertain_rate_lexicon(data):
-    hedge_detector = HedgeDetector()
-    tqdm.pandas() # to get a progress bar
-    data[["uncertain_discourse_markers", "uncertain_hedge_terms", "uncertain_boosters_preceeded_by_negation"]] = data.evidence.progress_apply(hedge_detector.is_hedged_text).tolist()
+def get_uncertain_rate_lexicon(data, annotations=None, num_workers=1, batch_size=32):
+    annotations = annotations if annotations is not None else AnnotationStore()
+    # the evidences are processed by stanza in batches of batch_size documents, spread over num_workers processes
+    data[["uncertain_discourse_markers", "uncertain_hedge_terms", "uncertain_boosters_preceeded_by_negation"]] = annotations.get("hedges", data.evidence.tolist(), num_workers=num_workers, batch_size=batch_size)
     return {"uncertain_discourse_markers": data["uncertain_discourse_markers"].tolist(),
             "uncertain_hedge_terms": data["uncertain_hedge_terms"].tolist(),
             "uncertain_boosters_preceeded_by_negation": data["uncertain_boosters_preceeded_by_negation"].tolist()}
 
-def get_jaccard_sim(data):
-    def get_jaccard_index(s1, s2):
-        words_1 = set([w.lower() for w in word_tokenize(s1) if w.lower() not in SKIPLIST])
-        words_2 = set([w.lower() for w in word_tokenize(s2) if w.lower() not in SKIPLIST])
-        return 1-jaccard_distance(words_1, words_2)
+def get_jaccard_sim(data, annotations=None):
+    annotations = annotations if annotations is not None else AnnotationStore()
+    def get_jaccard_index(words_1, words_2):
+        return 1-jaccard_distance(set(words_1), set(words_2))
 
-    return list(map(get_jaccard_index, data.claim, data.evidence))
+    return list(map(get_jaccard_index, annotations.get("words", data.claim.tolist()), annotations.get("words", data.evidence.tolist())))
 
-def get_claim_repeated_in_evidence(data):
-    def string_in_doc(s, doc):
-        s_words = (" ").join([w.lower() for w in word_tokenize(s) if w.lower() not in SKIPLIST])
-        doc_words = (" ").join([w.lower() for w in word_tokenize(doc) if w.lower() not in SKIPLIST])
-        return s_words in doc_words
+def get_claim_repeated_in_evidence(data, annotations=None):
+    annotations = annotations if annotations is not None else AnnotationStore()
+    def string_in_doc(s_words, doc_words):
+        return (" ").join(s_words) in (" ").join(doc_words)
         
-    return list(map(string_in_doc, data.claim, data.evidence))
+    return list(map(string_in_doc, annotations.get("words", data.claim.tolist()), annotations.get("words", data.evidence.tolist())))
 
-def get_evidence_length(data):
+def get_evidence_length(data, annotations=None):
     return data.evidence.apply(len)
 
-def get_claim_length(data):
+def get_claim_length(data, annotations=None):
     return data.claim.apply(len)
 
 PROPERTY_FUNS = {"unreliable_mbfc": get_unreliable_mbfc,
@@ -133,6 +127,12 @@ if __name__ == "__main__":
     parser.add_argument("--data_path", type=str, help="Path to .tsv file with data to detect properties for. Should contain the columns 'evidence', 'claim' and 'evidence_source'.")
     parser.add_argument("--save_folder", type=str, help="Folder to save the results (data with properties) to.")
     parser.add_argument("--properties", type=str, help="String with properties to detect, separated by spaces. Choose either 'all' or a set of properties (from PROPERTY_FUNS in the code).")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of worker processes for the hedge detection (uncertain_rate_lexicon), each with its own stanza pipeline and a share of the CPU cores.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Number of evidences processed together by stanza for the hedge detection.")
+    parser.add_argument("--spacy_model", type=str, default=SPACY_MODEL, help="spaCy model for the named entities (claim_entity_overlap), e.g. 'en_core_web_sm' for CPUs. Runs on the GPU if there is one.")
+    parser.add_argument("--ner_batch_size", type=int, default=64, help="Number of texts per batch for the named entity recognition.")
+    parser.add_argument("--ner_processes", type=int, default=1, help="Number of processes for the named entity recognition on CPUs.")
+    parser.add_argument("--annotation_cache", type=str, default=None, help="Path to a SQLite database caching the linguistic annotations (tokens, entities, hedge flags, ...) of the texts across runs and datasets. Disabled by default.")
     
     args = parser.parse_args()
     
@@ -142,6 +142,11 @@ if __name__ == "__main__":
     print(f"{len(data)} samples loaded.")
     print()
 
+    annotations = AnnotationStore(args.annotation_cache)
+    # settings of the properties that take more than the data and the annotations
+    property_kwargs = {"uncertain_rate_lexicon": {"num_workers": args.num_workers, "batch_size": args.batch_size},
+                       "claim_entity_overlap": {"spacy_model": args.spacy_model, "batch_size": args.ner_batch_size, "n_process": args.ner_processes}}
+
     if args.properties == "all":
         properties = PROPERTY_FUNS.keys()
     else:
@@ -150,7 +155,7 @@ if __name__ == "__main__":
     for prop in properties:
         print(f"Processing property {prop}...")
         save_file = os.path.join(args.save_folder, f"tmp_{prop}.tsv")
-        res = PROPERTY_FUNS[prop](data)
+        res = PROPERTY_FUNS[prop](data, annotations=annotations, **property_kwargs.get(prop, {}))
         if isinstance(res, dict):
             for key, val in res.items():
                 data[key] = val
@@ -175,6 +180,8 @@ if __name__ == "__main__":
             print(f"Statistics saved to {filename}.")
         print()
     
+    print(f"Annotation statistics: {annotations.get_stats()}")
+    annotations.close()
     save_file = os.path.join(args.save_folder, "data_with_properties.tsv")
     data.to_csv(save_file, sep="\t")
     print(f"Done! Saved data with properties to '{save_file}'.")
\ No newline at end of file
@@ -1,7 +1,10 @@
 import os
+import multiprocessing
+from collections import defaultdict, Counter
 from nltk import ngrams
-from nltk.metrics.distance import jaccard_distance
+from tqdm import tqdm
 import stanza
+import torch
 
 from src.utils import read_txt_file
 
@@ -9,6 +12,8 @@ FACT_CHECK_SITES_FILEPATH = "data/property_detection/fact_check_sites.txt"
 MBFC_FOLDER = "data/property_detection/mbfc/"
 
 HEDGE_DETECTION_DATA_FOLDER = "data/property_detection/hedge_detection"
+# hedge terms for which HedgeDetector.is_true_hedge_term uses the dependency heads and relations
+DEPPARSE_HEDGE_TERMS = ["feel", "suggest", "believe", "consider", "doubt", "guess", "hope", "assume", "suppose", "tend", "appear"]
 
 class FactCheckDetector:
     def __init__(self):
@@ -79,20 +84,85 @@ def read_hedge_detector_file(filename):
             if (not "#" in line) and (len(line)>0):
                 res.append(line)
     return res
+class DiscourseMarkerMatcher():
+    '''
+    Matcher of the n-grams of a sentence against discourse markers given as sets of lemmas. An n-gram matches a marker if
+    the Jaccard similarity of their lemma sets is at least min_similarity. As a match needs at least one shared lemma,
+    an inverted index from lemma to markers is used to only compare each n-gram to the markers it shares lemmas with,
+    with the shared lemmas counted from the index instead of intersecting the sets.
+    '''
+    def __init__(self, marker_sets, min_similarity=0.8):
+        self.min_similarity = min_similarity
+        self.marker_sizes = [len(marker_set) for marker_set in marker_sets]
+        self.index = defaultdict(list)
+        for marker_ix, marker_set in enumerate(marker_sets):
+            for lemma in marker_set:
+                self.index[lemma].append(marker_ix)
+
+    def matches_gram(self, gram_set):
+        num_shared = Counter()
+        for lemma in gram_set:
+            for marker_ix in self.index.get(lemma, []):
+                num_shared[marker_ix] += 1
+        for marker_ix, shared in num_shared.items():
+            union = self.marker_sizes[marker_ix] + len(gram_set) - shared
+            # same expression as 1-nltk's jaccard_distance, such that the threshold is applied to the same float values
+            if 1-(union-shared)/union >= self.min_similarity:
+                return True
+        return False
+
+    def matches_sentence(self, words, max_num_grams):
+        '''
+        Function to check whether any 1- to max_num_grams-gram of the words (lemmas) matches a discourse marker
+        '''
+        checked = set()
+        for i in range(1, min(len(words), max_num_grams)+1):
+            for ng in ngrams(words, i):
+                gram_set = frozenset(ng)
+                # n-grams with the same lemmas give the same result
+                if gram_set in checked or not any(lemma in self.index for lemma in gram_set):
+                    continue
+                checked.add(gram_set)
+                if self.matches_gram(gram_set):
+                    return True
+        return False
+
 # implementation based on "A Lexicon-Based Approach for Detecting Hedges in Informal Text"
 # https://aclanthology.org/2020.lrec-1.380.pdf
 class HedgeDetector():
-    def __init__(self):
+    '''
+    Args:
+    lazy_depparse: Whether to only run the dependency parser on the sentences with a hedge term for which the dependencies are checked
+                   (DEPPARSE_HEDGE_TERMS), instead of on all sentences. The results are the same.
+    '''
+    def __init__(self, lazy_depparse=True):
         self.discourse_markers = read_hedge_detector_file(os.path.join(HEDGE_DETECTION_DATA_FOLDER, "discourse_markers.txt"))
         self.hedge_words = read_hedge_detector_file(os.path.join(HEDGE_DETECTION_DATA_FOLDER, "hedge_words.txt"))
         self.booster_words = read_hedge_detector_file(os.path.join(HEDGE_DETECTION_DATA_FOLDER, "booster_words.txt"))
         # consider up to 7-grams
         self.max_num_grams = 7
         
-        self.nlp_pipeline = stanza.Pipeline(lang='en', processors='tokenize,mwt,pos,lemma,depparse', download_method=None)
+        self.lazy_depparse = lazy_depparse
+        if lazy_depparse:
+            # the POS tags are still needed for all sentences, as the lemmatizer uses them
+            self.nlp_tag_pipeline = stanza.Pipeline(lang='en', processors='tokenize,mwt,pos,lemma', download_method=None)
+            self.nlp_depparse_pipeline = stanza.Pipeline(lang='en', processors='depparse', depparse_pretagged=True, download_method=None)
+        else:
+            self.nlp_pipeline = stanza.Pipeline(lang='en', processors='tokenize,mwt,pos,lemma,depparse', download_method=None)
         self.nlp_tokenize_pipeline = stanza.Pipeline(lang='en', processors='tokenize,mwt,lemma', download_method=None)
         
         self.processed_discourse_markers = [set([w.lemma.lower() for w in self.nlp_tokenize_pipeline(dm).sentences[0].words]) for dm in self.discourse_markers]
+        self.build_lexicon_indices()
+
+    def build_lexicon_indices(self):
+        # indices of the processed discourse markers, hedge words and booster words used by is_hedged_doc
+        self.discourse_marker_matcher = DiscourseMarkerMatcher(self.processed_discourse_markers, min_similarity=0.8)
+        # rank of each hedge word, such that the hedge words in a sentence are checked in the order of the list
+        self.hedge_word_ranks = {}
+        for rank, hw in enumerate(self.hedge_words):
+            self.hedge_word_ranks.setdefault(hw, rank)
+        self.booster_word_set = set(self.booster_words)
+        self.depparse_hedge_words = set(DEPPARSE_HEDGE_TERMS).intersection(self.hedge_words)
         
     def is_true_hedge_term(self, t, word_ix, sent):
         # TODO: check effect of stemming compared to tokens!
@@ -156,30 +226,59 @@ class HedgeDetector():
         
         return True
         
+    def process_texts(self, texts):
+        '''
+        Function to get the stanza documents of the texts. With lazy_depparse, the texts are tagged and lemmatised,
+        and only the sentences with a hedge term in DEPPARSE_HEDGE_TERMS are parsed and replace the unparsed sentences.
+        '''
+        if not self.lazy_depparse:
+            return self.nlp_pipeline([stanza.Document([], text=text) for text in texts])
+        docs = self.nlp_tag_pipeline([stanza.Document([], text=text) for text in texts])
+        parse_ixs = [(doc_ix, sent_ix) for doc_ix, doc in enumerate(docs) for sent_ix, sent in enumerate(doc.sentences)
+                     if any(w.lemma.lower() in self.depparse_hedge_words for w in sent.words)]
+        if len(parse_ixs) > 0:
+            # the sentences of all texts are parsed together, from their tagged words
+            parsed_doc = self.nlp_depparse_pipeline(stanza.Document([docs[doc_ix].sentences[sent_ix].to_dict() for doc_ix, sent_ix in parse_ixs]))
+            for (doc_ix, sent_ix), parsed_sent in zip(parse_ixs, parsed_doc.sentences):
+                docs[doc_ix].sentences[sent_ix] = parsed_sent
+        return docs
+        
     def is_hedged_text(self, text):
-        doc = self.nlp_pipeline(text)
+        return self.is_hedged_doc(self.process_texts([text])[0], text)
+    
+    def is_hedged_texts(self, texts, batch_size=32):
+        '''
+        Function to detect hedges in several texts, passing batch_size texts at a time to stanza as a multi-document input
+        Returns a list with the result of is_hedged_text for each text
+        '''
+        results = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start+batch_size]
+            docs = self.process_texts(batch)
+            results.extend([self.is_hedged_doc(doc, text) for doc, text in zip(docs, batch)])
+        return results
         
+    def is_hedged_doc(self, doc, text):
+        # doc is the stanza document of text
         found_discourse_markers = False
         found_hedge_terms = False
         found_boosters_preceeded_by_negation = False
         
         for sent in doc.sentences:
             words = [w.lemma.lower() for w in sent.words]
+            # index of the first occurrence of each word, as given by words.index
+            first_ixs = {}
+            for word_ix, word in enumerate(words):
+                first_ixs.setdefault(word, word_ix)
             # hedge detection based on discourse markers
-            max_num_grams = min(len(words), self.max_num_grams)
-            grams = []
-            for i in range(1, max_num_grams+1):
-                grams.extend(ngrams(words, i))
-            for dm_set in self.processed_discourse_markers:
-                for ng in grams:
-                    if 1-jaccard_distance(dm_set, set(ng)) >= 0.8:
-                        found_discourse_markers = True
-                        break
+            if not found_discourse_markers:
+                found_discourse_markers = self.discourse_marker_matcher.matches_sentence(words, self.max_num_grams)
                     
             # hedge detection based on hedge terms
-            for hw in self.hedge_words:
+            sent_hedge_words = sorted([hw for hw in first_ixs if hw in self.hedge_word_ranks], key=self.hedge_word_ranks.get)
+            for hw in sent_hedge_words:
                 try:
-                    if hw in words and self.is_true_hedge_term(hw, words.index(hw), sent):
+                    if self.is_true_hedge_term(hw, first_ixs[hw], sent):
                         found_hedge_terms = True
                         break
                 except Exception as e:
@@ -189,13 +288,42 @@ class HedgeDetector():
                     break
             
             # hedge detection based on boosters preceeded by negation
-            for bw in self.booster_words:
-                if bw in words:
-                    bw_index = words.index(bw)
-                    if bw_index > 0:
-                        prev_word = words[bw_index-1]
-                        if prev_word == "not" or prev_word == "without":
-                            found_boosters_preceeded_by_negation = True
-                            break
+            for bw in [word for word in first_ixs if word in self.booster_word_set]:
+                bw_index = first_ixs[bw]
+                if bw_index > 0:
+                    prev_word = words[bw_index-1]
+                    if prev_word == "not" or prev_word == "without":
+                        found_boosters_preceeded_by_negation = True
+                        break
             
         return found_discourse_markers, found_hedge_terms, found_boosters_preceeded_by_negation
+
+# hedge detector of a worker process of detect_hedges, loaded once per worker
+worker_hedge_detector = None
+
+def init_hedge_worker(num_threads):
+    global worker_hedge_detector
+    torch.set_num_threads(num_threads)
+    worker_hedge_detector = HedgeDetector()
+
+def run_hedge_worker(texts):
+    return worker_hedge_detector.is_hedged_texts(texts, batch_size=len(texts))
+
+def detect_hedges(texts, num_workers=1, batch_size=32):
+    '''
+    Function to get the result of HedgeDetector.is_hedged_text for many texts, with batch_size texts per stanza call
+    and the batches spread over num_workers processes, each with its own stanza pipelines and a share of the CPU cores
+    Returns the results in the order of the texts
+    '''
+    texts = list(texts)
+    batches = [texts[start:start+batch_size] for start in range(0, len(texts), batch_size)]
+    if num_workers > 1:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(num_workers, initializer=init_hedge_worker, initargs=(num_threads,)) as pool:
+            # imap returns the batches in order
+            batch_results = list(tqdm(pool.imap(run_hedge_worker, batches), total=len(batches)))
+    else:
+        hedge_detector = HedgeDetector()
+        batch_results = [hedge_detector.is_hedged_texts(batch, batch_size) for batch in tqdm(batches)]
+    return [res for results in batch_results for res in results]
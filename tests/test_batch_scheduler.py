@@ -0,0 +1,50 @@
+import json
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.get_model_predictions.batch_scheduler import TokenBudgetScheduler, is_oom_error
+
+CPU_OOM_MESSAGE = "[enforce fail at alloc_cpu.cpp:114] data. DefaultCPUAllocator: not enough memory: you tried to allocate 1073741824 bytes."
+
+def run_with_memory_limit(scheduler:TokenBudgetScheduler, lengths:list, memory_tokens:int)-> list:
+    # batches of more than memory_tokens (padded) tokens fail as the CPU allocator does
+    def run_batch(batch:list)-> list:
+        if len(batch)*max(lengths[ix] for ix in batch) > memory_tokens:
+            raise RuntimeError(CPU_OOM_MESSAGE)
+        return batch
+    return list(scheduler.run(lengths, run_batch))
+
+def test_is_oom_error():
+    assert is_oom_error(RuntimeError(CPU_OOM_MESSAGE))
+    assert is_oom_error(RuntimeError("[enforce fail at alloc_cpu.cpp:83] err == 0. DefaultCPUAllocator: can't allocate memory: you tried to allocate 4096 bytes. Error code 12 (Cannot allocate memory)"))
+    assert is_oom_error(RuntimeError("CUDA out of memory. Tried to allocate 20.00 MiB"))
+    assert is_oom_error(MemoryError())
+    assert not is_oom_error(RuntimeError("shape mismatch"))
+    assert not is_oom_error(ValueError("not enough memory"))
+
+def test_cpu_oom_backoff(tmp_path):
+    budget_file = str(tmp_path / "budgets.json")
+    lengths = [10]*16
+    scheduler = TokenBudgetScheduler(160, budget_file, "model|cpu|score")
+    assert run_with_memory_limit(scheduler, lengths, 50) == list(range(16))
+    assert scheduler.num_oom == 2
+    assert scheduler.max_batch_tokens == 40
+    with open(budget_file, "r") as f:
+        assert json.load(f)["model|cpu|score"] == {"max_batch_tokens": 40, "num_oom": 2, "source": "oom"}
+    # later runs start from the budget lowered after running out of memory
+    assert TokenBudgetScheduler(160, budget_file, "model|cpu|score").max_batch_tokens == 40
+
+def test_budget_not_recorded_without_oom(tmp_path):
+    budget_file = str(tmp_path / "budgets.json")
+    scheduler = TokenBudgetScheduler(20, budget_file, "model|cpu|score")
+    assert run_with_memory_limit(scheduler, [10]*4, 1000) == list(range(4))
+    scheduler.record_budget()
+    # a small budget without running out of memory does not cap later runs
+    assert TokenBudgetScheduler(160, budget_file, "model|cpu|score").max_batch_tokens == 160
+
+def test_budget_without_oom_source_ignored(tmp_path):
+    budget_file = str(tmp_path / "budgets.json")
+    with open(budget_file, "w") as f:
+        json.dump({"model|cpu|score": {"max_batch_tokens": 20, "num_oom": 0}}, f)
+    assert TokenBudgetScheduler(160, budget_file, "model|cpu|score").max_batch_tokens == 160
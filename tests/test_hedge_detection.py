@@ -0,0 +1,136 @@
+import os
+import random
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("stanza")
+pytest.importorskip("torch")
+from nltk import ngrams
+from nltk.metrics.distance import jaccard_distance
+
+from src.property_detection.property_detectors import HedgeDetector, HEDGE_DETECTION_DATA_FOLDER, read_hedge_detector_file
+
+DEPRELS = ["root", "nsubj", "ccomp", "xcomp", "mark", "advmod", "obj", "det"]
+XPOS = ["VB", "VBD", "VBZ", "IN", "TO", "NN", "PRP", "RB"]
+FILLER_WORDS = ["the", "claim", "we", "i", "that", "to", "be", "not", "without", "than", "it", "is", "a", "report", "say", "of"]
+
+def get_detector()-> HedgeDetector:
+    # detector with the lexicons of the data folder and without stanza pipelines, the discourse markers are split on spaces instead of lemmatised
+    detector = HedgeDetector.__new__(HedgeDetector)
+    detector.discourse_markers = read_hedge_detector_file(os.path.join(HEDGE_DETECTION_DATA_FOLDER, "discourse_markers.txt"))
+    detector.hedge_words = read_hedge_detector_file(os.path.join(HEDGE_DETECTION_DATA_FOLDER, "hedge_words.txt"))
+    detector.booster_words = read_hedge_detector_file(os.path.join(HEDGE_DETECTION_DATA_FOLDER, "booster_words.txt"))
+    detector.max_num_grams = 7
+    detector.processed_discourse_markers = [set(dm.lower().split()) for dm in detector.discourse_markers]
+    detector.build_lexicon_indices()
+    return detector
+
+def is_hedged_doc_reference(detector:HedgeDetector, doc)-> tuple:
+    # previous implementation, comparing each discourse marker to each n-gram with nltk's jaccard_distance and scanning the full word lists
+    found_discourse_markers = False
+    found_hedge_terms = False
+    found_boosters_preceeded_by_negation = False
+    for sent in doc.sentences:
+        words = [w.lemma.lower() for w in sent.words]
+        max_num_grams = min(len(words), detector.max_num_grams)
+        grams = []
+        for i in range(1, max_num_grams+1):
+            grams.extend(ngrams(words, i))
+        for dm_set in detector.processed_discourse_markers:
+            for ng in grams:
+                if 1-jaccard_distance(dm_set, set(ng)) >= 0.8:
+                    found_discourse_markers = True
+                    break
+        for hw in detector.hedge_words:
+            try:
+                if hw in words and detector.is_true_hedge_term(hw, words.index(hw), sent):
+                    found_hedge_terms = True
+                    break
+            except Exception:
+                found_hedge_terms = None
+                break
+        for bw in detector.booster_words:
+            if bw in words:
+                bw_index = words.index(bw)
+                if bw_index > 0:
+                    prev_word = words[bw_index-1]
+                    if prev_word == "not" or prev_word == "without":
+                        found_boosters_preceeded_by_negation = True
+                        break
+    return found_discourse_markers, found_hedge_terms, found_boosters_preceeded_by_negation
+
+def get_sentence(lemmas:list, rng:random.Random)-> SimpleNamespace:
+    # stanza-like sentence with random dependencies, such that the syntactic checks of the hedge terms take both branches
+    words = [SimpleNamespace(text=lemma, lemma=lemma, head=rng.randint(0, len(lemmas)), deprel=rng.choice(DEPRELS), xpos=rng.choice(XPOS))
+             for lemma in lemmas]
+    return SimpleNamespace(words=words)
+
+def get_doc(sentences:list, rng:random.Random)-> SimpleNamespace:
+    return SimpleNamespace(sentences=[get_sentence(lemmas, rng) for lemmas in sentences])
+
+def get_random_docs(detector:HedgeDetector, num_docs:int, seed:int=0)-> list:
+    rng = random.Random(seed)
+    marker_words = sorted(set(word for dm_set in detector.processed_discourse_markers for word in dm_set))
+    vocabulary = {"marker": marker_words, "hedge": detector.hedge_words, "booster": detector.booster_words, "filler": FILLER_WORDS}
+    docs = []
+    for _ in range(num_docs):
+        sentences = []
+        for _ in range(rng.randint(1, 3)):
+            lemmas = []
+            for _ in range(rng.randint(1, 14)):
+                if rng.random() < 0.15:
+                    # whole multi-word discourse markers
+                    lemmas.extend(rng.choice(detector.discourse_markers).lower().split())
+                else:
+                    lemmas.append(rng.choice(vocabulary[rng.choice(["marker", "hedge", "booster", "filler", "filler"])]))
+            sentences.append(lemmas)
+        docs.append(get_doc(sentences, rng))
+    return docs
+
+def test_edge_cases():
+    detector = get_detector()
+    rng = random.Random(0)
+    cases = [[["on", "the", "other", "hand", "it", "is", "a", "claim"]],
+             [["the", "other", "hand", "on"]],
+             [["it", "is", "not", "clearly", "a", "claim"]],
+             [["without", "doubt"], ["clearly", "not"]],
+             # hedge terms whose syntactic check fails on the last word of a sentence give None
+             [["i", "think"]],
+             [["we", "rather"]],
+             [["i", "think", "that"], ["the", "claim", "think"]],
+             [[]],
+             [["claim"]]]
+    results = []
+    for sentences in cases:
+        doc = get_doc(sentences, rng)
+        result = detector.is_hedged_doc(doc, " ".join(" ".join(lemmas) for lemmas in sentences))
+        assert result == is_hedged_doc_reference(detector, doc)
+        results.append(result)
+    assert results[0][0] and results[1][0]
+    assert results[2][2]
+    assert results[4][1] is None and results[5][1] is None
+
+def test_random_docs_match_reference():
+    detector = get_detector()
+    docs = get_random_docs(detector, 300)
+    results = [detector.is_hedged_doc(doc, "") for doc in docs]
+    assert results == [is_hedged_doc_reference(detector, doc) for doc in docs]
+    # all outcomes of each flag are covered
+    for flag_ix, outcomes in enumerate([{True, False}, {True, False, None}, {True, False}]):
+        assert set(result[flag_ix] for result in results) == outcomes
+
+def test_partial_discourse_markers():
+    # n-grams missing a word of a multi-word discourse marker, or with an extra word, are around the similarity threshold
+    detector = get_detector()
+    rng = random.Random(0)
+    docs = []
+    for dm in detector.discourse_markers:
+        dm_words = dm.lower().split()
+        if len(set(dm_words)) < 2:
+            continue
+        docs.append(get_doc([[word for word in dm_words if word != dm_words[-1]] + ["claim"]], rng))
+        docs.append(get_doc([["report"] + dm_words + ["claim"]], rng))
+        docs.append(get_doc([dm_words[1:] + ["not"]], rng))
+    results = [detector.is_hedged_doc(doc, "")[0] for doc in docs]
+    assert results == [is_hedged_doc_reference(detector, doc)[0] for doc in docs]
+    assert True in results and False in results
@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from src.property_detection.get_perplexity import (get_windows, get_packed_rows, get_window_logprobs, get_packed_window_logprobs,
+                                                   supports_packing, compute_perplexities)
+
+def get_tiny_model(model_type:str):
+    torch.manual_seed(0)
+    if model_type == "gpt_neox":
+        config = transformers.GPTNeoXConfig(vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                                            intermediate_size=64, max_position_embeddings=128)
+        model = transformers.GPTNeoXForCausalLM(config)
+    else:
+        config = transformers.LlamaConfig(vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                                          intermediate_size=64, max_position_embeddings=128)
+        model = transformers.LlamaForCausalLM(config)
+    return model.eval()
+
+def get_windows_of_texts(num_texts:int, max_length:int=32, stride:int=16)-> list:
+    rng = np.random.default_rng(0)
+    windows = []
+    for seq_len in rng.integers(2, 80, size=num_texts):
+        input_ids = rng.integers(0, 64, size=seq_len).tolist()
+        windows.extend((input_ids[begin:end], trg_len) for begin, end, trg_len in get_windows(len(input_ids) - 1, max_length, stride))
+    return windows
+
+@pytest.mark.parametrize("model_type", ["gpt_neox", "llama"])
+def test_packed_logprobs_match_unpacked(model_type):
+    model = get_tiny_model(model_type)
+    assert supports_packing(model)
+    windows = get_windows_of_texts(12)
+    unpacked = get_window_logprobs(model, windows, pad_token_id=0)
+    rows = get_packed_rows([len(input_ids) for input_ids, _ in windows], 64)
+    assert len(rows) < len(windows)
+    packed = get_packed_window_logprobs(model, windows, rows, pad_token_id=0)
+    for ix, (token_ids, logprobs) in enumerate(unpacked):
+        np.testing.assert_array_equal(packed[ix][0], token_ids)
+        np.testing.assert_allclose(packed[ix][1], logprobs, rtol=1e-4, atol=1e-5)
+
+class CharTokenizer:
+    # one token per character, enough for compute_perplexities
+    pad_token_id = 0
+    eos_token_id = 0
+
+    def __call__(self, texts:list)-> dict:
+        return {"input_ids": [[1 + ord(char) % 63 for char in text] for text in texts]}
+
+@pytest.mark.parametrize("model_type", ["gpt_neox", "llama"])
+def test_packed_perplexities_match_unpacked(model_type):
+    model = get_tiny_model(model_type)
+    texts = ["a short text", "x", "", "a somewhat longer text that is split into several strided windows " * 2]
+    ppls = compute_perplexities(texts, model, CharTokenizer(), max_length=32, stride=16)
+    packed_ppls = compute_perplexities(texts, model, CharTokenizer(), max_length=32, stride=16, packing=True, pack_length=64)
+    np.testing.assert_allclose(packed_ppls, ppls, rtol=1e-4, equal_nan=True)
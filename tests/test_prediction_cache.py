@@ -0,0 +1,41 @@
+import time
+import multiprocessing
+
+from src.get_model_predictions.prediction_cache import PredictionCache
+
+SETTINGS = {"mode": "score"}
+
+def store_predictions(db_path:str, worker_ix:int, num_predictions:int)-> None:
+    # a short lock timeout, such that a worker holding the write lock across model calls makes the other one fail
+    cache = PredictionCache(db_path, "model", "revision", commit_every=20, timeout=0.2)
+    for ix in range(num_predictions):
+        # model call
+        time.sleep(0.02)
+        cache.store("template", SETTINGS, f"prompt {worker_ix} {ix}", {"prediction": str(ix)})
+    cache.close()
+
+def test_store_and_lookup(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = PredictionCache(db_path, "model", "revision", commit_every=2)
+    cache.store("template", SETTINGS, "prompt", {"prediction": "True"})
+    cache.close()
+    cache = PredictionCache(db_path, "model", "revision")
+    assert cache.lookup("template", SETTINGS, ["prompt", "other prompt"]) == {"prompt": {"prediction": "True"}}
+    assert cache.lookup("other template", SETTINGS, ["prompt"]) == {}
+    assert cache.get_stats()["hits"] == 1
+    cache.close()
+
+def test_concurrent_workers(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    PredictionCache(db_path, "model", "revision").close()
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=store_predictions, args=(db_path, worker_ix, 60)) for worker_ix in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0, 0]
+    cache = PredictionCache(db_path, "model", "revision")
+    prompts = [f"prompt {worker_ix} {ix}" for worker_ix in range(2) for ix in range(60)]
+    assert len(cache.lookup("template", SETTINGS, prompts)) == len(prompts)
+    cache.close()
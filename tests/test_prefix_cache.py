@@ -0,0 +1,80 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from src.get_model_predictions.prefix_cache import RadixPrefixCache, to_legacy_cache
+
+NUM_LAYERS = 2
+
+def get_kv(token_ids:list)-> tuple:
+    # fake keys and values of shape (batch, heads, length, head dim), holding the token id at each position (negated for the values)
+    keys = torch.tensor(token_ids, dtype=torch.float32).reshape(1, 1, -1, 1).repeat(1, 1, 1, 4)
+    return tuple((keys + layer, -keys - layer) for layer in range(NUM_LAYERS))
+
+def get_kv_nbytes(token_ids:list)-> int:
+    return sum(k.numel()*k.element_size() + v.numel()*v.element_size() for k, v in get_kv(token_ids))
+
+def check_match(cache:RadixPrefixCache, token_ids:list, expected_len:int)-> None:
+    match_len, past_key_values = cache.match(token_ids)
+    assert match_len == expected_len
+    if expected_len == 0:
+        assert past_key_values is None
+        return
+    for (k, v), (expected_k, expected_v) in zip(to_legacy_cache(past_key_values), get_kv(token_ids[:expected_len])):
+        assert torch.equal(k, expected_k) and torch.equal(v, expected_v)
+
+def get_edges(node, prefix=())-> set:
+    edges = set()
+    for child in node.children.values():
+        assert child.parent is node and len(child.key) == child.kv[0][0].shape[2]
+        edges.add(prefix + (child.key,))
+        edges |= get_edges(child, prefix + (child.key,))
+    return edges
+
+def test_match_and_split():
+    cache = RadixPrefixCache(max_memory_mb=1)
+    check_match(cache, [1, 2, 3], 0)
+    cache.insert([1, 2, 3, 4, 5], get_kv([1, 2, 3, 4, 5]))
+    # a match ending inside an edge only returns the matched part of the edge
+    check_match(cache, [1, 2, 3, 9], 3)
+    check_match(cache, [1, 2, 3, 4, 5, 6], 5)
+    check_match(cache, [2, 3], 0)
+    # a prompt diverging inside the edge splits it
+    cache.insert([1, 2, 3, 7, 8], get_kv([1, 2, 3, 7, 8]))
+    assert get_edges(cache.root) == {((1, 2, 3),), ((1, 2, 3), (4, 5)), ((1, 2, 3), (7, 8))}
+    check_match(cache, [1, 2, 3, 4, 5], 5)
+    check_match(cache, [1, 2, 3, 7, 8, 9], 5)
+    # shared prefixes are stored once
+    assert cache.nbytes == get_kv_nbytes([1, 2, 3, 4, 5, 7, 8])
+    assert cache.get_stats()["lookups"] == 6 and cache.get_stats()["hits"] == 4
+
+def test_evict_to_budget():
+    max_bytes = get_kv_nbytes(list(range(10)))
+    cache = RadixPrefixCache(max_memory_mb=max_bytes/1024**2)
+    for prompt in [[1, 2, 3, 4, 5], [1, 2, 3, 7, 8], [1, 2, 9]]:
+        cache.insert(prompt, get_kv(prompt))
+    assert get_edges(cache.root) == {((1, 2),), ((1, 2), (3,)), ((1, 2), (3,), (4, 5)), ((1, 2), (3,), (7, 8)), ((1, 2), (9,))}
+    assert cache.nbytes == get_kv_nbytes(list(range(8)))
+    check_match(cache, [1, 2, 9], 3)
+    check_match(cache, [1, 2, 3, 7, 8], 5)
+    # the least recently used leaf ([4, 5]) is evicted to get back to the budget, and its parent is merged with its remaining child
+    cache.insert([6, 6, 6, 6], get_kv([6, 6, 6, 6]))
+    assert cache.nbytes == max_bytes
+    assert get_edges(cache.root) == {((1, 2),), ((1, 2), (3, 7, 8)), ((1, 2), (9,)), ((6, 6, 6, 6),)}
+    check_match(cache, [1, 2, 3, 4, 5], 3)
+    check_match(cache, [1, 2, 3, 7, 8], 5)
+    check_match(cache, [1, 2, 9], 3)
+    check_match(cache, [6, 6, 6, 6], 4)
+
+def test_evict_merged_branch():
+    max_bytes = get_kv_nbytes([1, 2, 3, 4])
+    cache = RadixPrefixCache(max_memory_mb=max_bytes/1024**2)
+    cache.insert([1, 2, 3], get_kv([1, 2, 3]))
+    cache.insert([1, 2, 4], get_kv([1, 2, 4]))
+    # evicting [3] merges [1, 2] with [4], which is evicted next as the least recently used leaf
+    cache.insert([5, 6, 7, 8], get_kv([5, 6, 7, 8]))
+    assert cache.nbytes == max_bytes
+    assert get_edges(cache.root) == {((5, 6, 7, 8),)}
+    check_match(cache, [1, 2, 4], 0)
+    check_match(cache, [5, 6, 7, 8], 4)
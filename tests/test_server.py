@@ -0,0 +1,93 @@
+import json
+import asyncio
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+from src.get_model_predictions.prompts import PROMPT_DICT
+from src.get_model_predictions.server import ContinuousBatchScheduler, ScoringServer, Sequence
+
+PROMPT_NAME = "pythia_claim_prompt_0_shot"
+REQUESTS = [{"prompt_name": PROMPT_NAME, "claimant": "Joe Biden", "claim": "Inflation went down in 2023."},
+            {"prompt_name": PROMPT_NAME, "claimant": "A blog", "claim": "The moon is made of cheese, according to a study from 1969 by NASA."}]
+
+def get_tiny_model_and_tokenizer():
+    # byte-level BPE tokenizer trained on the prompt templates and a random GPT-NeoX model, small enough for CPUs
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.BPE())
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = tokenizers.decoders.ByteLevel()
+    trainer = tokenizers.trainers.BpeTrainer(vocab_size=400, special_tokens=["<|endoftext|>"],
+                                             initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(list(PROMPT_DICT.values()) + [" True False None Support Refute"], trainer)
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", pad_token="<|endoftext|>")
+    tokenizer.padding_side = "left"
+    torch.manual_seed(0)
+    config = transformers.GPTNeoXConfig(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                                        intermediate_size=64, max_position_embeddings=512)
+    return transformers.GPTNeoXForCausalLM(config).eval(), tokenizer
+
+async def send_request(port:int, method:str, path:str, payload:dict=None)-> tuple:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status_line = (await reader.readline()).decode()
+    response = await reader.read()
+    writer.close()
+    return int(status_line.split(" ")[1]), json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+async def run_requests(model, tokenizer, mode:str, requests:list)-> tuple:
+    scheduler = ContinuousBatchScheduler(model, tokenizer, mode, max_batch_size=4, max_new_tokens=5)
+    server = ScoringServer(scheduler, tokenizer)
+    http_server = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    port = http_server.sockets[0].getsockname()[1]
+    scheduler_task = asyncio.create_task(scheduler.run())
+    responses = await asyncio.gather(*[send_request(port, "POST", "/predict", request) for request in requests])
+    metrics = await send_request(port, "GET", "/metrics")
+    scheduler_task.cancel()
+    http_server.close()
+    await http_server.wait_closed()
+    return responses, metrics
+
+@pytest.mark.parametrize("mode", ["generate", "score", "constrained"])
+def test_concurrent_requests(mode):
+    model, tokenizer = get_tiny_model_and_tokenizer()
+    responses, (metrics_status, metrics) = asyncio.run(run_requests(model, tokenizer, mode, REQUESTS))
+    for status, response in responses:
+        assert status == 200
+        assert response["prompt_name"] == PROMPT_NAME and isinstance(response["prediction"], str)
+        assert set(["True", "False", "None"]).issubset(response["probs"].keys())
+    assert metrics_status == 200
+    assert metrics["requests"] == 2 and metrics["requests_done"] == 2
+    assert metrics["queue_depth"] == 0 and metrics["active_sequences"] == 0
+    assert sum(metrics["prefill_batch_size_counts"].values()) >= 1
+    # each request gets the same result as on its own
+    for request, (_, response) in zip(REQUESTS, responses):
+        [(_, single_response)], _ = asyncio.run(run_requests(model, tokenizer, mode, [request]))
+        for label, prob in single_response["probs"].items():
+            assert response["probs"][label] == pytest.approx(prob, rel=1e-4, abs=1e-7)
+
+def test_invalid_request():
+    model, tokenizer = get_tiny_model_and_tokenizer()
+    [(status, response)], _ = asyncio.run(run_requests(model, tokenizer, "score", [{"prompt_name": PROMPT_NAME, "claim": "No claimant."}]))
+    assert status == 400 and "claimant" in response["error"]
+
+def test_batched_prefill_matches_single():
+    model, tokenizer = get_tiny_model_and_tokenizer()
+    prompts = ["Claim: short", "Claimant: someone\nClaim: a much longer claim, such that the first prompt is left padded\nAnswer:"]
+    batched = [Sequence(tokenizer(prompt)["input_ids"], None) for prompt in prompts]
+    scheduler = ContinuousBatchScheduler(model, tokenizer, "generate", max_batch_size=4, max_new_tokens=3)
+    scheduler.step(batched)
+    # decoding steps with sequences of different lengths
+    while len(scheduler.active) > 0:
+        scheduler.step([])
+    for prompt, batched_seq in zip(prompts, batched):
+        single_seq = Sequence(tokenizer(prompt)["input_ids"], None)
+        scheduler = ContinuousBatchScheduler(model, tokenizer, "generate", max_batch_size=4, max_new_tokens=3)
+        scheduler.step([single_seq])
+        while len(scheduler.active) > 0:
+            scheduler.step([])
+        torch.testing.assert_close(batched_seq.first_step_logits, single_seq.first_step_logits, rtol=1e-4, atol=1e-4)
+        assert batched_seq.generated == single_seq.generated